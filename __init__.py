@@ -1,28 +1,16 @@
 import bpy
-import subprocess
-import sys
-import os
 
-def install_pillow():
-    try:
-        # Attempt to import Pillow
-        import PIL
-    except ImportError:
-        # Pillow not installed, install it
-        # Find Blender's Python executable
-        python_exe = sys.executable
-        # Ensure pip is installed and then install Pillow
-        subprocess.call([python_exe, "-m", "ensurepip"])
-        subprocess.call([python_exe, "-m", "pip", "install", "Pillow"])
-
-
-# Call the install function before importing other modules
-install_pillow()
-
-
-# Now import other modules that might depend on Pillow
-from .operators import SnapshotOperator, ApplyGreebleTextureOperator, ApplyDepthMapOperator, ScaleUVOperator, SaveTexturesOperator
+# Only light modules are imported while the add-on is enabled. requests and
+# Pillow are imported on first use, missing packages are installed from the
+# add-on preferences (see dependencies.py).
+from .operators import SnapshotOperator, ApplyGreebleTextureOperator, ApplyDepthMapOperator, ScaleUVOperator, SaveTexturesOperator, CancelGreebleJobOperator, ClearGenerationCacheOperator, ClearGreebleTraceOperator, BatchGreebleOperator, PurgeGreebleDataOperator, RefreshGreebleMemoryReportOperator, AddGreebleEndpointOperator, RemoveGreebleEndpointOperator, InstallGreebleDependenciesOperator, GenerateGreebleVariationsOperator, ApplyGreebleVariationOperator
 from .ui import GreebleGeneratorPanel
+from .preferences import GreebleEndpoint, GreebleGeneratorPreferences, get_preferences, apply_client_settings, apply_cache_settings, apply_trace_settings
+from .imagebuffers import pack_generated_images
+from .sdclient import close_client
+from .profiling import configure_trace
+from . import variations
+from . import export
 from bpy.props import StringProperty
 
 bl_info = {
@@ -71,12 +59,31 @@ bpy.types.Scene.greeble_denoising_strength = bpy.props.FloatProperty(
 
 
 def register():
+    bpy.utils.register_class(GreebleEndpoint)
+    bpy.utils.register_class(GreebleGeneratorPreferences)
+    prefs = get_preferences()
+    if prefs:
+        apply_client_settings(prefs)
+        apply_cache_settings(prefs)
+        apply_trace_settings(prefs)
     bpy.utils.register_class(SnapshotOperator)
     bpy.utils.register_class(GreebleGeneratorPanel)
     bpy.utils.register_class(ApplyGreebleTextureOperator)
+    bpy.utils.register_class(GenerateGreebleVariationsOperator)
+    bpy.utils.register_class(ApplyGreebleVariationOperator)
     bpy.utils.register_class(ApplyDepthMapOperator)
     bpy.utils.register_class(ScaleUVOperator)
     bpy.utils.register_class(SaveTexturesOperator)
+    bpy.utils.register_class(CancelGreebleJobOperator)
+    bpy.utils.register_class(ClearGenerationCacheOperator)
+    bpy.utils.register_class(ClearGreebleTraceOperator)
+    bpy.utils.register_class(BatchGreebleOperator)
+    bpy.utils.register_class(PurgeGreebleDataOperator)
+    bpy.utils.register_class(RefreshGreebleMemoryReportOperator)
+    bpy.utils.register_class(AddGreebleEndpointOperator)
+    bpy.utils.register_class(RemoveGreebleEndpointOperator)
+    bpy.utils.register_class(InstallGreebleDependenciesOperator)
+    bpy.app.handlers.save_pre.append(pack_generated_images)
     bpy.types.Scene.greeble_generator_snapshot_path = StringProperty(
         name="Snapshot Path",
         description="Path to the snapshot image",
@@ -87,6 +94,197 @@ def register():
         description="Enter the prompt for the Greeble Generator",
         default="grb, mechanical parts, mechanical pistons and parts, hard surface, rigorous detail, precise detail, ultra realistic, highly detailed, sophisticated Generate a high-resolution, detailed texture-like image filled with intricate greebles and sci-fi details. The image should showcase a complex array of mechanical and futuristic elements, with a focus on metallic textures, interlocking geometric shapes, and a monochromatic color scheme with hints of neon blue. The overall mood is futuristic and high-tech, resembling the surface of a sci-fi spaceship or machinery, with a fine balance of shadows and light to enhance the 3D effect of the greebles."
     )
+    bpy.types.Scene.greeble_depth_source = bpy.props.EnumProperty(
+        name="Depth Source",
+        description="How the depth map is estimated",
+        items=[
+            ('DETECT', "Preprocessor", "Run only the ControlNet depth preprocessor on the texture, no diffusion"),
+            ('TEXTURE', "With Texture", "Estimate depth of the snapshot in the same request as the texture"),
+            ('IMG2IMG', "Full img2img", "Run a second img2img job and keep its depth annotation (slow)"),
+        ],
+        default='DETECT'
+    )
+    bpy.types.Scene.greeble_depth_mode = bpy.props.EnumProperty(
+        name="Depth Mode",
+        description="How the depth map shapes the surface",
+        items=[
+            ('DISPLACEMENT', "Displacement", "Displace the surface in the shader, needs Cycles and subdivided geometry"),
+            ('NORMAL', "Normal Map", "Bake the depth into a tangent-space normal map, cheap in any engine"),
+            ('BUMP', "Bump", "Use the depth as a bump map, evaluated per pixel at render time"),
+        ],
+        default='DISPLACEMENT'
+    )
+    bpy.types.Scene.greeble_depth_strength = bpy.props.FloatProperty(
+        name="Depth Strength",
+        description="Strength of the normal map or bump",
+        default=1.0,
+        min=0.0,
+        soft_max=4.0
+    )
+    bpy.types.Scene.greeble_seed = bpy.props.IntProperty(
+        name="Seed",
+        description="Seed for Stable Diffusion, -1 for a random seed. Results of fixed seeds are cached",
+        default=-1,
+        min=-1
+    )
+    bpy.types.Scene.greeble_steps = bpy.props.IntProperty(
+        name="Steps",
+        description="Sampling steps of a full texture generation",
+        default=10,
+        min=1,
+        max=150
+    )
+    bpy.types.Scene.greeble_draft = bpy.props.BoolProperty(
+        name="Draft First",
+        description="Generate a quick low-step draft; refine it with the same seed once it looks right",
+        default=False
+    )
+    bpy.types.Scene.greeble_draft_steps = bpy.props.IntProperty(
+        name="Draft Steps",
+        description="Sampling steps of a draft",
+        default=4,
+        min=1,
+        max=150
+    )
+    bpy.types.Scene.greeble_last_seed = bpy.props.IntProperty(
+        name="Last Seed",
+        description="Seed the last texture was generated with",
+        default=-1
+    )
+    bpy.types.Scene.greeble_variation_count = bpy.props.IntProperty(
+        name="Variations",
+        description="Candidate textures generated together in one request",
+        default=4,
+        min=2,
+        max=8
+    )
+    bpy.types.Scene.greeble_live_preview = bpy.props.BoolProperty(
+        name="Live Preview",
+        description="Show the intermediate images of the server on the faces while the texture is generated. "
+                    "Needs live previews enabled in the Web UI settings",
+        default=True
+    )
+    bpy.types.Scene.greeble_capture_mode = bpy.props.EnumProperty(
+        name="Capture",
+        description="How the snapshot of the selected faces is taken",
+        items=[
+            ('RENDER', "Render", "Render the active object alone with the capture rig"),
+            ('RASTER', "Fast Raster", "Rasterize only the selected faces with NumPy, takes milliseconds"),
+        ],
+        default='RENDER'
+    )
+    bpy.types.Scene.greeble_capture_engine = bpy.props.EnumProperty(
+        name="Engine",
+        description="Render engine preset of rendered snapshots",
+        items=[
+            ('WORKBENCH', "Workbench", "Solid shading with studio light, fastest"),
+            ('EEVEE', "EEVEE", "The object's materials, with few samples"),
+        ],
+        default='WORKBENCH'
+    )
+    bpy.types.Scene.greeble_geometry_depth = bpy.props.BoolProperty(
+        name="Guide with Geometry Depth",
+        description="Send the depth of the fast raster snapshot to ControlNet so the texture follows the geometry",
+        default=False
+    )
+    bpy.types.Scene.greeble_in_memory = bpy.props.BoolProperty(
+        name="Keep Images in Memory",
+        description="Pass images between snapshot, Stable Diffusion and Blender in memory instead of through PNG files",
+        default=True
+    )
+    bpy.types.Scene.greeble_batch_concurrency = bpy.props.IntProperty(
+        name="Concurrent Requests",
+        description="Number of batch requests sent to the Stable Diffusion server at the same time",
+        default=2,
+        min=1,
+        max=16
+    )
+    bpy.types.Scene.greeble_batch_pack_size = bpy.props.IntProperty(
+        name="Islands per Request",
+        description="Number of face islands packed into a single img2img request",
+        default=4,
+        min=1,
+        max=16
+    )
+    bpy.types.Scene.greeble_view_count = bpy.props.IntProperty(
+        name="Max Views",
+        description="Most views a multi-view batch takes of one island, one per group of faces facing the same way",
+        default=4,
+        min=1,
+        max=12
+    )
+    bpy.types.Scene.greeble_tiled = bpy.props.BoolProperty(
+        name="Tiled High Resolution",
+        description="Capture large selections at a higher resolution and generate them as overlapping 512 px tiles",
+        default=False
+    )
+    bpy.types.Scene.greeble_tile_world_size = bpy.props.FloatProperty(
+        name="Tile Size",
+        description="Size in world units covered by one 512 px tile, sets the number of tiles from the face area",
+        default=1.0,
+        min=0.01,
+        subtype='DISTANCE'
+    )
+    bpy.types.Scene.greeble_max_tiles = bpy.props.IntProperty(
+        name="Max Tiles per Side",
+        description="Upper limit of tiles along each side of the snapshot",
+        default=4,
+        min=1,
+        max=8
+    )
+    bpy.types.Scene.greeble_show_timings = bpy.props.BoolProperty(
+        name="Show Timings",
+        description="Show where the time of the last greeble operation went",
+        default=False
+    )
+    bpy.types.Scene.greeble_use_atlas = bpy.props.BoolProperty(
+        name="Pack into Atlas",
+        description="Pack every greebled island into shared atlas images (up to 64 islands) and give all greebled faces one material",
+        default=False
+    )
+    # Progress of the background generation shown in the panel
+    bpy.types.Scene.greeble_job_running = bpy.props.BoolProperty(
+        name="Generation Running",
+        default=False
+    )
+    bpy.types.Scene.greeble_job_label = bpy.props.StringProperty(
+        name="Generation",
+        default=""
+    )
+    bpy.types.Scene.greeble_job_progress = bpy.props.FloatProperty(
+        name="Progress",
+        subtype='PERCENTAGE',
+        default=0.0,
+        min=0.0,
+        max=100.0
+    )
+    bpy.types.Scene.greeble_color_format = bpy.props.EnumProperty(
+        name="Texture Format",
+        description="File format of saved textures",
+        items=[
+            ('PNG', "PNG", "Lossless, as returned by the server"),
+            ('WEBP', "WebP", "Lossy, small files"),
+            ('JPEG', "JPEG", "Lossy, widely supported"),
+        ],
+        default='PNG'
+    )
+    bpy.types.Scene.greeble_export_quality = bpy.props.IntProperty(
+        name="Quality",
+        description="Quality of lossy texture formats",
+        default=90,
+        min=1,
+        max=100
+    )
+    bpy.types.Scene.greeble_depth_format = bpy.props.EnumProperty(
+        name="Depth Format",
+        description="File format of saved depth maps",
+        items=[
+            ('PNG', "PNG 8 bit", "As returned by the server"),
+            ('PNG16', "PNG 16 bit", "16 bit grayscale for tools that expect it, the depth itself stays 8 bit"),
+            ('EXR', "OpenEXR", "32 bit float for tools that expect it, the depth itself stays 8 bit"),
+        ],
+        default='PNG'
+    )
     # Register the custom property
     bpy.types.Scene.greeble_texture_scale = bpy.props.FloatProperty(
         name="Texture Scale",
@@ -101,11 +299,58 @@ def unregister():
     bpy.utils.unregister_class(SnapshotOperator)
     bpy.utils.unregister_class(GreebleGeneratorPanel)
     bpy.utils.unregister_class(ApplyGreebleTextureOperator)
+    bpy.utils.unregister_class(GenerateGreebleVariationsOperator)
+    bpy.utils.unregister_class(ApplyGreebleVariationOperator)
     bpy.utils.unregister_class(ApplyDepthMapOperator)
     bpy.utils.unregister_class(ScaleUVOperator)
     bpy.utils.unregister_class(SaveTexturesOperator)
+    bpy.utils.unregister_class(CancelGreebleJobOperator)
+    bpy.utils.unregister_class(ClearGenerationCacheOperator)
+    bpy.utils.unregister_class(ClearGreebleTraceOperator)
+    bpy.utils.unregister_class(BatchGreebleOperator)
+    bpy.utils.unregister_class(PurgeGreebleDataOperator)
+    bpy.utils.unregister_class(RefreshGreebleMemoryReportOperator)
+    bpy.utils.unregister_class(AddGreebleEndpointOperator)
+    bpy.utils.unregister_class(RemoveGreebleEndpointOperator)
+    bpy.utils.unregister_class(InstallGreebleDependenciesOperator)
+    if pack_generated_images in bpy.app.handlers.save_pre:
+        bpy.app.handlers.save_pre.remove(pack_generated_images)
+    bpy.utils.unregister_class(GreebleGeneratorPreferences)
+    bpy.utils.unregister_class(GreebleEndpoint)
+    close_client()
+    configure_trace(False, "")
+    variations.candidates.clear()
+    export.shutdown()
     del bpy.types.Scene.greeble_generator_snapshot_path
     del bpy.types.Scene.greeble_generator_prompt
+    del bpy.types.Scene.greeble_depth_source
+    del bpy.types.Scene.greeble_depth_mode
+    del bpy.types.Scene.greeble_depth_strength
+    del bpy.types.Scene.greeble_in_memory
+    del bpy.types.Scene.greeble_capture_mode
+    del bpy.types.Scene.greeble_capture_engine
+    del bpy.types.Scene.greeble_steps
+    del bpy.types.Scene.greeble_draft
+    del bpy.types.Scene.greeble_draft_steps
+    del bpy.types.Scene.greeble_last_seed
+    del bpy.types.Scene.greeble_variation_count
+    del bpy.types.Scene.greeble_live_preview
+    del bpy.types.Scene.greeble_geometry_depth
+    del bpy.types.Scene.greeble_seed
+    del bpy.types.Scene.greeble_batch_concurrency
+    del bpy.types.Scene.greeble_batch_pack_size
+    del bpy.types.Scene.greeble_view_count
+    del bpy.types.Scene.greeble_use_atlas
+    del bpy.types.Scene.greeble_show_timings
+    del bpy.types.Scene.greeble_tiled
+    del bpy.types.Scene.greeble_tile_world_size
+    del bpy.types.Scene.greeble_max_tiles
+    del bpy.types.Scene.greeble_job_running
+    del bpy.types.Scene.greeble_job_label
+    del bpy.types.Scene.greeble_job_progress
+    del bpy.types.Scene.greeble_color_format
+    del bpy.types.Scene.greeble_export_quality
+    del bpy.types.Scene.greeble_depth_format
     # Unregister the custom property
     del bpy.types.Scene.greeble_texture_scale
 
@@ -1,97 +1,394 @@
 import bpy
-import io
 import base64
+import json
 import os
-from PIL import Image
-import requests
+import random
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from . import imagebuffers
+from . import tiles
+from . import profiling
+from .cache import get_cache, make_key
+from .sdclient import get_pool
+
+def encode_png(png):
+    with profiling.stage("base64 encode"):
+        encoded = base64.b64encode(png)
+        return 'data:image/png;base64,' + str(encoded, encoding='utf-8')
+
 
 def get_encoded_image(image_path):
     if os.path.exists(image_path):
         with open(image_path, "rb") as image_file:
-            encoded = base64.b64encode(image_file.read())
-            return 'data:image/png;base64,' + str(encoded, encoding='utf-8')
+            return encode_png(image_file.read())
     else:
         return None
 
-def send_prompt_to_stable_diffusion(prompt, steps=5):
-    addon_dir = os.path.dirname(__file__)
-    snapshot_path = os.path.join(addon_dir, "snapshot.png")
-    EncodedImage = get_encoded_image(snapshot_path)
-    Model_name = "sd-v1-5-pruned-noema-fp16"	# Model name
-    Lora_name = "<lora:Greeble_dataset-10:1>"	# LoRA name
-    cfg_scale = bpy.context.scene.greeble_cfg_scale
-    denoising_strength = bpy.context.scene.greeble_denoising_strength
+
+def get_stage_image(name, in_memory=False):
+    # Encoded image of a pipeline stage ('snapshot', 'output' or 'depth'),
+    # taken from the in-memory buffers or from the work directory
+    if in_memory:
+        buffer = imagebuffers.get_buffer(name)
+        return encode_png(buffer.png) if buffer else None
+    return get_encoded_image(imagebuffers.get_work_path(f"{name}.png"))
+
+
+def store_stage_image(name, encoded, in_memory=False, cache=None, cache_key=None):
+    # The server already answers with PNG data, keep it as it is instead of
+    # decoding and encoding it again. Returns an ImageBuffer or a file path.
+    with profiling.stage("base64 decode"):
+        png = base64.b64decode(encoded)
+    if cache is not None:
+        cache.put(cache_key, png)
+    return store_stage_png(name, png, in_memory)
+
+
+def store_stage_png(name, png, in_memory=False):
+    if in_memory:
+        # Decode here, usually on a worker thread, so the main thread only
+        # has to copy the pixels into the Blender image
+        return imagebuffers.put_buffer(name, png, decode=True)
+    path = imagebuffers.get_work_path(f"{name}.png")
+    with open(path, "wb") as image_file:
+        image_file.write(png)
+    return path
+
+
+def get_progress(skip_current_image=True):
+    # Progress of the job currently running on the server (0.0 - 1.0), with
+    # the intermediate image as 'current_image' unless skip_current_image
+    return get_pool().progress(skip_current_image)
+
+
+def interrupt():
+    # Ask the servers running our requests to stop
+    get_pool().interrupt()
+
+
+Model_name = "sd-v1-5-pruned-noema-fp16"	# Model name
+Lora_name = "<lora:Greeble_dataset-10:1>"	# LoRA name
+Depthmap_module = "depth"	# ControlNet preprocessor used for depth estimation
+Depthmap_model_name = "control_sd15_depth"	# Depthmap model name
+
+# Whether the stored 'depth' stage is the blended depth of a tiled texture,
+# which is the detected depth of every tile at full resolution
+tiled_depth = False
+
+
+def get_result_seed(r, seed):
+    # The seed the server actually used, a random one when seed was -1
+    try:
+        return int(json.loads(r.get('info') or '{}').get('seed', seed))
+    except (TypeError, ValueError):
+        return seed
+
+
+def depth_controlnet_unit(weight=1.0):
+    return {
+        "module": Depthmap_module,
+        "model": Depthmap_model_name,
+        "weight": weight
+    }
+
+
+def send_prompt_to_stable_diffusion(prompt, steps=5, cfg_scale=None, denoising_strength=None, with_depth=False,
+                                    in_memory=False, seed=-1, geometry_depth=False):
+    # Returns the 'output' stage and the seed the server used for it, so a
+    # draft can be refined; the output is None when there is no snapshot
+    global tiled_depth
+    tiled_depth = False
+    EncodedImage = get_stage_image("snapshot", in_memory)
+    # Depth of the rasterized snapshot, used to keep the diffusion on the geometry
+    GeometryDepth = get_stage_image("snapshot_depth", in_memory) if geometry_depth else None
+
+    # Scene values are read here only when called from the main thread;
+    # background workers must pass them in explicitly
+    if cfg_scale is None:
+        cfg_scale = bpy.context.scene.greeble_cfg_scale
+    if denoising_strength is None:
+        denoising_strength = bpy.context.scene.greeble_denoising_strength
 
     if EncodedImage is None:
         print("Snapshot image not found.")
-        return  # Or handle the absence of the image as needed
+        return None, seed
 
-    # Set model to specific model to use fine-tuned LoRA model
-    url = "http://127.0.0.1:7860"
-    opt = requests.get(url=f'{url}/sdapi/v1/options')
-    opt_json = opt.json()
-    opt_json['sd_model_checkpoint'] = Model_name
-    requests.post(url=f'{url}/sdapi/v1/options', json=opt_json)
+    # Only a fixed seed gives reproducible results worth caching
+    cache = get_cache() if seed >= 0 else None
+    cache_key = depth_cache_key = None
+    if cache is not None:
+        cache_key = make_key("texture", EncodedImage, prompt, Lora_name, Model_name,
+                             steps, cfg_scale, denoising_strength, seed,
+                             *([GeometryDepth] if GeometryDepth else []))
+        depth_cache_key = make_key("texture-depth", cache_key, Depthmap_module, Depthmap_model_name)
+        png = cache.get(cache_key)
+        depth_png = cache.get(depth_cache_key) if with_depth else None
+        if png is not None and (depth_png is not None or not with_depth):
+            output = store_stage_png("output", png, in_memory)
+            if depth_png is not None:
+                store_stage_png("depth", depth_png, in_memory)
+            return output, seed
 
     payload = {
 	"prompt": f"{prompt} {Lora_name}",
         "init_images": [EncodedImage],
         "steps": steps,
         "cfg_scale": cfg_scale,
-        "denoising_strength": denoising_strength
+        "denoising_strength": denoising_strength,
+        "seed": seed
     }
 
-    response = requests.post(url=f'{url}/sdapi/v1/img2img', json=payload)
-    r = response.json()
+    controlnet_units = []
+    if with_depth:
+        # Ask ControlNet to annotate the snapshot with a depth map in the same
+        # request. With a weight of 0 the unit does not steer the diffusion,
+        # the preprocessor output is returned as the second image.
+        controlnet_units.append(depth_controlnet_unit(weight=0.0))
+    if GeometryDepth:
+        # The rasterized depth already is a depth map, skip the preprocessor
+        unit = depth_controlnet_unit()
+        unit["module"] = "none"
+        unit["input_image"] = GeometryDepth
+        controlnet_units.append(unit)
+    if controlnet_units:
+        payload["alwayson_scripts"] = {
+            "controlnet": {
+                "args": controlnet_units
+            }
+        }
+
+    # The pool loads the fine-tuned model on the server it picks, if needed
+    r = get_pool().call(lambda client: client.img2img(payload), checkpoint=Model_name)
+    output = store_stage_image("output", r['images'][0], in_memory, cache, cache_key)
 
-    output_path = os.path.join(addon_dir, "output.png")
+    if with_depth and len(r['images']) > 1:
+        store_stage_image("depth", r['images'][1], in_memory, cache, depth_cache_key)
 
-    image = Image.open(io.BytesIO(base64.b64decode(r['images'][0])))
-    image.save(output_path)   
+    return output, get_result_seed(r, seed)
 
-    return output_path
 
+def get_depth_map(prompt, steps=5, source='DETECT', in_memory=False):
+    # source selects how the depth map is produced:
+    #   DETECT  - run only the ControlNet depth preprocessor on the texture
+    #   TEXTURE - reuse the depth annotated during the texture request, falls
+    #             back to DETECT when there is none for the current texture
+    #   IMG2IMG - run a full img2img job with ControlNet and keep its
+    #             preprocessor output (slow, the diffused image is discarded)
+    # A tiled texture comes with the detected depth of its tiles, blended at
+    # full resolution; DETECT uses it instead of detecting again at 512 px.
+    if source == 'TEXTURE' or (source == 'DETECT' and tiled_depth):
+        depth = get_fresh_texture_depth(in_memory)
+        if depth is not None:
+            return depth
 
-def get_depth_map(prompt, steps=5):
-    addon_dir = os.path.dirname(__file__)
-    snapshot_path = os.path.join(addon_dir, "output.png")
-    EncodedImage = get_encoded_image(snapshot_path)
-    Model_name = "sd-v1-5-pruned-noema-fp16"	# Model name
-    Depthmap_model_name = "control_sd15_depth"	# Depthmap model name
-    Lora_name = "<lora:Greeble_dataset-10:1>"	# LoRA name
+    EncodedImage = get_stage_image("output", in_memory)
 
     if EncodedImage is None:
         print("Depth Map image not found.")
         return  # Or handle the absence of the image as needed
 
-    # Set model to specific model to use fine-tuned LoRA model
-    url = "http://127.0.0.1:7860"
-    opt = requests.get(url=f'{url}/sdapi/v1/options')
-    opt_json = opt.json()
-    opt_json['sd_model_checkpoint'] = Model_name
-    requests.post(url=f'{url}/sdapi/v1/options', json=opt_json)
+    # The preprocessor output only depends on the texture, whichever way it is produced
+    cache = get_cache()
+    cache_key = None
+    if cache is not None:
+        cache_key = make_key("depth", EncodedImage, Depthmap_module, Depthmap_model_name)
+        png = cache.get(cache_key)
+        if png is not None:
+            return store_stage_png("depth", png, in_memory)
+
+    if source != 'IMG2IMG':
+        r = get_pool().call(lambda client: client.detect(Depthmap_module, [EncodedImage]))
+        return store_stage_image("depth", r['images'][0], in_memory, cache, cache_key)
 
     payload = {
         "init_images": [EncodedImage],
         "steps": steps,
         "alwayson_scripts": {
             "controlnet": {
-                "args": [
-                    {
-                        "module": "depth",
-                        "model": Depthmap_model_name
-                    }
-                ]
+                "args": [depth_controlnet_unit()]
             }
         }
     }
 
-    response = requests.post(url=f'{url}/sdapi/v1/img2img', json=payload)
-    r = response.json()
+    # Set model to specific model to use fine-tuned LoRA model
+    r = get_pool().call(lambda client: client.img2img(payload), checkpoint=Model_name)
+
+    return store_stage_image("depth", r['images'][1], in_memory, cache, cache_key)
+
+
+def batch_cache_key(encoded_image, prompt, steps, cfg_scale, denoising_strength, seed, index, count):
+    # Cache key of image index of an img2img batch of count images started at
+    # seed. The WebUI does not promise that a batch image equals a single
+    # request with seed + index, so only a batch of one shares its key with
+    # the single request.
+    key = make_key("texture", encoded_image, prompt, Lora_name, Model_name,
+                   steps, cfg_scale, denoising_strength, seed + index)
+    if count == 1:
+        return key
+    return make_key("texture-batch", key, seed, index, count)
+
+
+def generate_texture_batch(encoded_images, prompt, steps=5, cfg_scale=7.0, denoising_strength=0.8, seed=-1):
+    # Texture and depth PNGs for several snapshots at once: one img2img request
+    # with all snapshots as init_images and a matching batch_size, then one
+    # ControlNet detect call for all textures. Returns a list of
+    # (texture_png, depth_png) pairs in the order of encoded_images.
+    # Never touches bpy, meant to run on worker threads.
+    pool = get_pool()
+
+    # A batch uses seed, seed + 1, ... so it is cached as a whole
+    cache = get_cache() if seed >= 0 else None
+    cache_keys = []
+    textures = []
+    if cache is not None:
+        cache_keys = [batch_cache_key(image, prompt, steps, cfg_scale, denoising_strength, seed, i,
+                                      len(encoded_images))
+                      for i, image in enumerate(encoded_images)]
+        textures = [cache.get(key) for key in cache_keys]
+
+    if not textures or None in textures:
+        payload = {
+            "prompt": f"{prompt} {Lora_name}",
+            "init_images": encoded_images,
+            "batch_size": len(encoded_images),
+            "steps": steps,
+            "cfg_scale": cfg_scale,
+            "denoising_strength": denoising_strength,
+            "seed": seed
+        }
+        r = pool.call(lambda client: client.img2img(payload), checkpoint=Model_name)
+        textures = [base64.b64decode(image) for image in r['images'][:len(encoded_images)]]
+        if cache is not None:
+            for key, png in zip(cache_keys, textures):
+                cache.put(key, png)
+
+    encoded_textures = [encode_png(png) for png in textures]
+    depth_cache = get_cache()
+    depth_keys = []
+    depths = [None] * len(textures)
+    if depth_cache is not None:
+        depth_keys = [make_key("depth", image, Depthmap_module, Depthmap_model_name)
+                      for image in encoded_textures]
+        depths = [depth_cache.get(key) for key in depth_keys]
+
+    missing = [i for i, depth in enumerate(depths) if depth is None]
+    if missing:
+        r = pool.call(lambda client: client.detect(Depthmap_module, [encoded_textures[i] for i in missing]))
+        for i, image in zip(missing, r['images']):
+            depths[i] = base64.b64decode(image)
+            if depth_cache is not None:
+                depth_cache.put(depth_keys[i], depths[i])
+
+    return list(zip(textures, depths))
+
 
-    depth_output_path = os.path.join(addon_dir, "depth.png") 
+def generate_variations(prompt, count=4, steps=5, cfg_scale=7.0, denoising_strength=0.8, seed=-1,
+                        in_memory=False):
+    # count candidate textures of the snapshot from one img2img request with
+    # batch_size=count. The seeds are explicit, seed, seed + 1, ..., with a
+    # random base when seed is -1, so the candidates can be cached. Returns a
+    # list of (seed, png).
+    # Never touches bpy, meant to run on worker threads.
+    EncodedImage = get_stage_image("snapshot", in_memory)
+    if EncodedImage is None:
+        print("Snapshot image not found.")
+        return
 
-    image = Image.open(io.BytesIO(base64.b64decode(r['images'][1])))
-    image.save(depth_output_path)
+    if seed < 0:
+        seed = random.randrange(2 ** 31 - count)
+    seeds = [seed + i for i in range(count)]
 
-    return depth_output_path
\ No newline at end of file
+    cache = get_cache()
+    cache_keys = []
+    textures = []
+    if cache is not None:
+        cache_keys = [batch_cache_key(EncodedImage, prompt, steps, cfg_scale, denoising_strength, seed, i, count)
+                      for i in range(count)]
+        textures = [cache.get(key) for key in cache_keys]
+
+    if not textures or None in textures:
+        payload = {
+            "prompt": f"{prompt} {Lora_name}",
+            "init_images": [EncodedImage],
+            "batch_size": count,
+            "steps": steps,
+            "cfg_scale": cfg_scale,
+            "denoising_strength": denoising_strength,
+            "seed": seed
+        }
+        r = get_pool().call(lambda client: client.img2img(payload), checkpoint=Model_name)
+        textures = [base64.b64decode(image) for image in r['images'][:count]]
+        # The WebUI reports the seed of every image of the batch
+        try:
+            seeds = [int(s) for s in json.loads(r.get('info') or '{}').get('all_seeds', seeds)][:len(textures)]
+        except (TypeError, ValueError):
+            pass
+        if cache is not None:
+            for key, png in zip(cache_keys, textures):
+                cache.put(key, png)
+
+    return list(zip(seeds, textures))
+
+
+def send_tiles_to_stable_diffusion(prompt, steps=5, cfg_scale=7.0, denoising_strength=0.8, in_memory=False,
+                                   seed=-1, max_workers=2):
+    # Tiled variant of send_prompt_to_stable_diffusion for high resolution
+    # snapshots: the snapshot is split into overlapping tiles, every tile is
+    # generated on its own with up to max_workers requests in flight, and the
+    # textures and depth maps are blended back into one image each. Stores
+    # and returns the 'output' stage and seed like the untiled request, with
+    # the matching 'depth' stage. Never touches bpy, meant to run on worker threads.
+    global tiled_depth
+    if in_memory:
+        buffer = imagebuffers.get_buffer("snapshot")
+        snapshot = buffer.pixels if buffer else None
+    else:
+        path = imagebuffers.get_work_path("snapshot.png")
+        snapshot = imagebuffers.load_result_pixels(path) if os.path.exists(path) else None
+
+    if snapshot is None:
+        print("Snapshot image not found.")
+        return None, seed
+
+    tiles_per_side = tiles.get_tiles_from_resolution(snapshot.shape[0])
+    snapshot = imagebuffers.resize_nearest(snapshot, tiles.get_resolution(tiles_per_side))
+    # Tiles go out as PNG, top row first and 8 bit
+    encoded_tiles = [encode_png(imagebuffers.encode_png((tile[::-1] * 255.0 + 0.5).astype(np.uint8)))
+                     for tile in tiles.split_tiles(snapshot, tiles_per_side)]
+
+    # The same seed on every tile keeps the style consistent across the grid
+    def generate_tile(encoded_tile):
+        return generate_texture_batch([encoded_tile], prompt, steps=steps, cfg_scale=cfg_scale,
+                                      denoising_strength=denoising_strength, seed=seed)[0]
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        results = list(executor.map(generate_tile, encoded_tiles))
+
+    texture = tiles.blend_tiles([imagebuffers.decode_png(png) for png, _ in results], tiles_per_side)
+    depth = tiles.blend_tiles([imagebuffers.decode_png(png) for _, png in results], tiles_per_side,
+                              match_levels=True)
+
+    def to_png(pixels):
+        return imagebuffers.encode_png((np.clip(pixels[::-1], 0.0, 1.0) * 255.0 + 0.5).astype(np.uint8))
+
+    # The depth is stored after the texture so it counts as its fresh depth
+    output = store_stage_png("output", to_png(texture), in_memory)
+    store_stage_png("depth", to_png(depth), in_memory)
+    tiled_depth = True
+    return output, seed
+
+
+def get_fresh_texture_depth(in_memory=False):
+    # Depth stored by the last texture request, if it belongs to the current texture
+    if in_memory:
+        output = imagebuffers.get_buffer("output")
+        depth = imagebuffers.get_buffer("depth")
+        if output and depth and depth.created >= output.created:
+            return depth
+        return None
+    output_path = imagebuffers.get_work_path("output.png")
+    depth_path = imagebuffers.get_work_path("depth.png")
+    if os.path.exists(output_path) and os.path.exists(depth_path):
+        if os.path.getmtime(depth_path) >= os.path.getmtime(output_path):
+            return depth_path
+    return None
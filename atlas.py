@@ -0,0 +1,256 @@
+import json
+import bpy
+import numpy as np
+from . import meshdata
+from .imagebuffers import resize_nearest
+from .resources import mark_owned, set_depth_image, set_depth_maps, invalidate_memory_report
+from . import profiling
+
+# All greebled faces in atlas mode share one material whose color and depth
+# images are grids of SLOT_SIZE squares. Every island gets one slot, its UVs
+# are mapped into it. The atlas doubles in size when it runs out of slots.
+#
+# Slot writes go to a NumPy copy of each atlas image, read once on the first
+# write. flush() writes the copies back; operators call it once when they
+# are done, a batch once at its end.
+ATLAS_IMAGE = "GreebleAtlas"
+ATLAS_DEPTH_IMAGE = "GreebleAtlasDepth"
+ATLAS_NORMAL_IMAGE = "GreebleAtlasNormal"
+ATLAS_MATERIAL = "GreebleAtlasMaterial"
+SLOT_ATTRIBUTE = "greeble_atlas_slot"
+SLOT_SIZE = 512
+# The atlas stops growing here (64 slots); islands that do not fit get a
+# material of their own
+MAX_ATLAS_SIZE = 4096
+# Color of unwritten atlas pixels other than black: a flat normal, so
+# islands without a baked normal map shade as they would without one
+FILL_COLORS = {ATLAS_NORMAL_IMAGE: (0.5, 0.5, 1.0, 1.0)}
+
+# Atlas image name -> NumPy copy of its pixels with unflushed slot writes
+_pixels = {}
+
+
+def get_atlas_image(name, non_color=False):
+    image = bpy.data.images.get(name)
+    if image is None:
+        image = mark_owned(bpy.data.images.new(name, SLOT_SIZE, SLOT_SIZE, alpha=True,
+                                               color=FILL_COLORS.get(name, (0.0, 0.0, 0.0, 1.0))))
+        if non_color:
+            image.colorspace_settings.name = 'Non-Color'
+        image["greeble_pack_on_save"] = True
+    return image
+
+
+def get_atlas_material():
+    mat = bpy.data.materials.get(ATLAS_MATERIAL)
+    if mat is not None:
+        return mat
+
+    mat = mark_owned(bpy.data.materials.new(name=ATLAS_MATERIAL))
+    mat.use_nodes = True
+    nodes = mat.node_tree.nodes
+    links = mat.node_tree.links
+    bsdf = nodes["Principled BSDF"]
+    tex_image = nodes.new('ShaderNodeTexImage')
+    tex_image.image = get_atlas_image(ATLAS_IMAGE)
+    links.new(bsdf.inputs['Base Color'], tex_image.outputs['Color'])
+
+    set_depth_image(mat, get_atlas_image(ATLAS_DEPTH_IMAGE, non_color=True))
+    return mat
+
+
+def get_slots(image):
+    # Pixel origin of every allocated slot, the list index is the slot id.
+    # Freed slots are None until their id is handed out again.
+    return json.loads(image.get("greeble_atlas_slots", "[]"))
+
+
+def allocate_slot():
+    image = get_atlas_image(ATLAS_IMAGE)
+    slots = get_slots(image)
+    used = {tuple(slot) for slot in slots if slot is not None}
+    size = image.size[0]
+    cells = size // SLOT_SIZE
+    free = [(x * SLOT_SIZE, y * SLOT_SIZE) for y in range(cells) for x in range(cells)
+            if (x * SLOT_SIZE, y * SLOT_SIZE) not in used]
+    if not free:
+        if size * 2 > MAX_ATLAS_SIZE:
+            return None, None
+        grow_atlas(size * 2)
+        # The old content fills the bottom left quadrant, continue to its right
+        free = [(size, 0)]
+    if None in slots:
+        slot_id = slots.index(None)
+        slots[slot_id] = list(free[0])
+    else:
+        slot_id = len(slots)
+        slots.append(list(free[0]))
+    image["greeble_atlas_slots"] = json.dumps(slots)
+    return slot_id, free[0]
+
+
+def grow_atlas(new_size):
+    # Enlarge the atlas images keeping existing pixels in place, then shrink
+    # the UVs of every atlas face so they still point at the same pixels
+    factor = get_atlas_image(ATLAS_IMAGE).size[0] / new_size
+    names = [ATLAS_IMAGE, ATLAS_DEPTH_IMAGE]
+    if ATLAS_NORMAL_IMAGE in bpy.data.images:
+        names.append(ATLAS_NORMAL_IMAGE)
+    for name in names:
+        image = get_atlas_image(name, non_color=name != ATLAS_IMAGE)
+        pixels = get_pixels(image)
+        old_size = min(pixels.shape[0], new_size)
+        grown = np.empty((new_size, new_size, 4), dtype=np.float32)
+        grown[:] = FILL_COLORS.get(name, 0.0)
+        grown[:old_size, :old_size] = pixels[:old_size, :old_size]
+        image.scale(new_size, new_size)
+        _pixels[name] = grown
+    invalidate_memory_report()
+
+    for mesh in bpy.data.meshes:
+        if SLOT_ATTRIBUTE not in mesh.attributes or not mesh.uv_layers:
+            continue
+        slot_ids = get_face_slots(mesh)
+        meshdata.transform_uvs(mesh, slot_ids >= 0, scale=factor, pivot=(0.0, 0.0))
+        mesh.update()
+
+
+def read_pixels(image):
+    width, height = image.size
+    pixels = np.empty(width * height * 4, dtype=np.float32)
+    image.pixels.foreach_get(pixels)
+    return pixels.reshape(height, width, 4)
+
+
+def get_pixels(image):
+    # The NumPy copy of an atlas image that slot writes go to
+    pixels = _pixels.get(image.name)
+    if pixels is None or pixels.shape[:2] != tuple(image.size)[::-1]:
+        with profiling.stage("atlas read"):
+            pixels = _pixels[image.name] = read_pixels(image)
+    return pixels
+
+
+def write_slot(image, origin, pixels):
+    atlas = get_pixels(image)
+    x, y = origin
+    if pixels is None:
+        atlas[y:y + SLOT_SIZE, x:x + SLOT_SIZE] = FILL_COLORS.get(image.name, 0.0)
+    else:
+        atlas[y:y + SLOT_SIZE, x:x + SLOT_SIZE] = resize_nearest(pixels, SLOT_SIZE)
+
+
+def flush():
+    # Write the atlas copies edited since the last flush back into their
+    # images, one foreach_set each
+    with profiling.stage("atlas write"):
+        for name, pixels in _pixels.items():
+            image = bpy.data.images.get(name)
+            if image is None or pixels.shape[:2] != tuple(image.size)[::-1]:
+                continue
+            image.pixels.foreach_set(pixels.ravel())
+            image.update()
+            image["greeble_pack_on_save"] = True
+    _pixels.clear()
+
+
+def get_face_slots(mesh):
+    slots = np.full(len(mesh.polygons), -1, dtype=np.int32)
+    if SLOT_ATTRIBUTE in mesh.attributes:
+        mesh.attributes[SLOT_ATTRIBUTE].data.foreach_get("value", slots)
+    return slots
+
+
+def set_face_slots(mesh, face_mask, slot_id):
+    if SLOT_ATTRIBUTE not in mesh.attributes:
+        attribute = mesh.attributes.new(SLOT_ATTRIBUTE, 'INT', 'FACE')
+        attribute.data.foreach_set("value", np.full(len(mesh.polygons), -1, dtype=np.int32))
+    slots = get_face_slots(mesh)
+    slots[face_mask] = slot_id
+    mesh.attributes[SLOT_ATTRIBUTE].data.foreach_set("value", slots)
+
+
+def get_used_slots():
+    # Ids of the slots any face of any mesh is in
+    used = set()
+    for mesh in bpy.data.meshes:
+        if SLOT_ATTRIBUTE in mesh.attributes:
+            used.update(np.unique(get_face_slots(mesh)).tolist())
+    return used
+
+
+def remove_island(mesh, face_mask):
+    # Take the faces out of their atlas slots: their UVs go back to the
+    # [0, 1] frame they had before add_island, and slots no face is left in
+    # are freed. Does nothing for faces outside the atlas.
+    face_slots = get_face_slots(mesh)
+    leaving = np.unique(face_slots[face_mask & (face_slots >= 0)])
+    if not len(leaving):
+        return
+    image = get_atlas_image(ATLAS_IMAGE)
+    slots = get_slots(image)
+    atlas_size = image.size[0]
+    for slot_id in leaving.tolist():
+        if slot_id >= len(slots) or slots[slot_id] is None:
+            continue
+        x, y = slots[slot_id]
+        meshdata.transform_uvs(mesh, face_mask & (face_slots == slot_id), scale=atlas_size / SLOT_SIZE,
+                               offset=(-x / SLOT_SIZE, -y / SLOT_SIZE), pivot=(0.0, 0.0))
+    set_face_slots(mesh, face_mask, -1)
+
+    used = get_used_slots()
+    for slot_id in leaving.tolist():
+        if slot_id < len(slots) and slot_id not in used:
+            # Whatever takes the slot next must not inherit its depth
+            for name in (ATLAS_DEPTH_IMAGE, ATLAS_NORMAL_IMAGE):
+                if name in bpy.data.images:
+                    write_slot(bpy.data.images[name], slots[slot_id], None)
+            slots[slot_id] = None
+    image["greeble_atlas_slots"] = json.dumps(slots)
+
+
+def add_island(mesh, face_mask, pixels):
+    # Put an island texture into an atlas slot and map the UVs of its faces
+    # into that slot. Faces greebled before leave their old slot first, so
+    # greebling them again reuses it. Returns the slot id, None when the
+    # atlas is full; the faces are then out of the atlas.
+    remove_island(mesh, face_mask)
+    slot_id, origin = allocate_slot()
+    if slot_id is None:
+        return None
+    image = get_atlas_image(ATLAS_IMAGE)
+    write_slot(image, origin, pixels)
+    set_face_slots(mesh, face_mask, slot_id)
+
+    # UVs in [0, 1] end up covering exactly the slot
+    atlas_size = image.size[0]
+    scale = SLOT_SIZE / atlas_size
+    offset = (origin[0] / atlas_size, origin[1] / atlas_size)
+    meshdata.transform_uvs(mesh, face_mask, scale=scale, offset=offset, pivot=(0.0, 0.0))
+    return slot_id
+
+
+def set_island_depth(mesh, face_mask, pixels, mode='DISPLACEMENT', normal_pixels=None, strength=1.0):
+    # Write a depth map, and in NORMAL mode the normal map baked from it,
+    # into the slot of the island the faces belong to, and connect the
+    # atlas the way mode asks for (see resources.set_depth_maps). Returns
+    # False when the faces are not in the atlas.
+    slots = get_face_slots(mesh)[face_mask]
+    if not len(slots) or slots[0] < 0:
+        return False
+    image = get_atlas_image(ATLAS_IMAGE)
+    origin = get_slots(image)[slots[0]]
+    written = {ATLAS_DEPTH_IMAGE: pixels}
+    if normal_pixels is not None:
+        written[ATLAS_NORMAL_IMAGE] = normal_pixels
+    for name, slot_pixels in written.items():
+        slot_image = get_atlas_image(name, non_color=True)
+        if tuple(slot_image.size) != tuple(image.size):
+            # Created later or recreated by the user, keep it in step with the color atlas
+            slot_image.scale(*image.size)
+            _pixels.pop(name, None)
+        write_slot(slot_image, origin, slot_pixels)
+    normal_image = get_atlas_image(ATLAS_NORMAL_IMAGE, non_color=True) if normal_pixels is not None else None
+    set_depth_maps(get_atlas_material(), mode, get_atlas_image(ATLAS_DEPTH_IMAGE, non_color=True),
+                   normal_image, strength)
+    return True
@@ -0,0 +1,171 @@
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from .apihandler import generate_texture_batch
+from .imagebuffers import ImageBuffer
+
+# Multi-view batches: faces further than this from straight on (in degrees)
+# get a view of their own, up to the maximum number of views
+MAX_VIEW_ANGLE = 35.0
+
+
+def get_face_islands(bm, faces):
+    # Split BMesh faces into connected islands, faces sharing an edge belong
+    # to the same island. Returns lists of face indices.
+    remaining = {f.index for f in faces}
+    bm.faces.ensure_lookup_table()
+    islands = []
+    while remaining:
+        start = remaining.pop()
+        island = [start]
+        stack = [start]
+        while stack:
+            face = bm.faces[stack.pop()]
+            for edge in face.edges:
+                for other in edge.link_faces:
+                    if other.index in remaining:
+                        remaining.remove(other.index)
+                        island.append(other.index)
+                        stack.append(other.index)
+        islands.append(island)
+    return islands
+
+
+def cluster_normals(normals, count, weights=None, iterations=20):
+    # Spherical k-means of unit normals: count view directions and the index
+    # of the nearest one for every normal. Seeded with the weighted mean and
+    # then the normals farthest from the directions so far, so the result is
+    # the same on every run.
+    normals = np.asarray(normals, dtype=np.float64)
+    weights = np.ones(len(normals)) if weights is None else np.asarray(weights, dtype=np.float64)
+    count = max(1, min(count, len(normals)))
+    mean = weights @ normals
+    centroids = [mean / np.linalg.norm(mean) if np.linalg.norm(mean) > 1e-6 else normals[0]]
+    for _ in range(count - 1):
+        similarity = (normals @ np.array(centroids).T).max(axis=1)
+        centroids.append(normals[similarity.argmin()])
+    centroids = np.array(centroids)
+
+    labels = None
+    for _ in range(iterations):
+        new_labels = (normals @ centroids.T).argmax(axis=1)
+        if labels is not None and np.array_equal(labels, new_labels):
+            break
+        labels = new_labels
+        # Weighted sum of the normals of every cluster, all clusters at once
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, normals * weights[:, None])
+        lengths = np.linalg.norm(sums, axis=1)
+        # A cluster that lost all its normals keeps its direction
+        used = lengths > 1e-6
+        centroids[used] = sums[used] / lengths[used, None]
+    return centroids, labels
+
+
+def get_view_clusters(normals, max_views, weights=None, max_angle=MAX_VIEW_ANGLE):
+    # Split faces into the fewest view directions, up to max_views, that see
+    # every face within max_angle of straight on. Returns (indices into
+    # normals, view direction) of every view; the direction is the weighted
+    # cluster centroid the angle was checked against.
+    normals = np.asarray(normals, dtype=np.float64)
+    min_cosine = np.cos(np.radians(max_angle))
+    for count in range(1, max(1, max_views) + 1):
+        centroids, labels = cluster_normals(normals, count, weights)
+        if (np.einsum('ij,ij->i', normals, centroids[labels]) >= min_cosine).all():
+            break
+    views = []
+    for index, direction in enumerate(centroids):
+        indices = np.flatnonzero(labels == index)
+        if len(indices):
+            views.append((indices, direction))
+    return views
+
+
+class IslandJob:
+    # One face island on its way through snapshot -> texture -> depth -> material
+
+    def __init__(self, obj_name, face_indices, center, normal, size):
+        self.obj_name = obj_name
+        self.face_indices = face_indices
+        self.center = center
+        self.normal = normal
+        self.size = size
+        self.snapshot = None  # Encoded snapshot, set on the main thread
+        self.texture = None   # ImageBuffer, set by a worker
+        self.depth = None     # ImageBuffer, set by a worker
+        self.error = None
+
+
+def generate_pack(jobs, prompt, steps, cfg_scale, denoising_strength, seed):
+    # Worker side of a batch: one request for the whole pack, results are
+    # decoded here so the main thread only has to copy pixels
+    results = generate_texture_batch([job.snapshot for job in jobs], prompt, steps=steps,
+                                     cfg_scale=cfg_scale, denoising_strength=denoising_strength,
+                                     seed=seed)
+    for job, (texture, depth) in zip(jobs, results):
+        job.texture = ImageBuffer(texture)
+        job.depth = ImageBuffer(depth)
+        job.texture.pixels
+        job.depth.pixels
+
+
+class BatchQueue:
+    # Packs islands with a snapshot into groups of pack_size and generates
+    # each group on a thread pool, so at most max_workers requests are in
+    # flight against the server at any time. generate(jobs) runs on a worker
+    # and fills in texture and depth of the jobs it gets.
+
+    def __init__(self, generate, max_workers=2, pack_size=4):
+        self.generate = generate
+        self.pack_size = max(1, pack_size)
+        self.max_workers = max(1, max_workers)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self._pending = []
+        self._futures = []
+        self.cancelled = False
+
+    @property
+    def busy(self):
+        return bool(self._pending or self._futures)
+
+    @property
+    def saturated(self):
+        # Every worker is busy and has a pack waiting behind it, the caller
+        # can hold back further snapshots until some of them complete
+        return len(self._futures) >= 2 * self.max_workers
+
+    def add(self, job):
+        self._pending.append(job)
+        if len(self._pending) >= self.pack_size:
+            self.flush()
+
+    def flush(self):
+        while self._pending and not self.cancelled:
+            pack = self._pending[:self.pack_size]
+            del self._pending[:self.pack_size]
+            self._futures.append((self._executor.submit(self._run, pack), pack))
+
+    def _run(self, pack):
+        try:
+            self.generate(pack)
+        except Exception as e:
+            for job in pack:
+                job.error = e
+
+    def pop_completed(self):
+        # Jobs of all packs that finished since the last call
+        completed = []
+        for future, pack in list(self._futures):
+            if future.done():
+                self._futures.remove((future, pack))
+                completed.extend(pack)
+        return completed
+
+    def cancel(self):
+        self.cancelled = True
+        self._pending.clear()
+        for future, _ in self._futures:
+            future.cancel()
+        self._executor.shutdown(wait=False)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
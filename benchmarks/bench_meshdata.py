@@ -0,0 +1,174 @@
+# Compares the per-element BMesh code the operators used to run with the
+# NumPy helpers in meshdata.py on a large grid. Each row starts in the mode
+# the operator is used from; the NumPy side includes the Edit/Object Mode
+# round trip of MeshEditSession whenever the operator pays for it.
+#
+#   blender -b --factory-startup --python benchmarks/bench_meshdata.py -- --size 1000
+#
+# --size N creates an N x N grid (N=1000 is one million faces).
+import argparse
+import importlib
+import os
+import sys
+import time
+
+import bmesh
+import bpy
+import numpy as np
+from mathutils import Vector
+
+ADDON_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(ADDON_DIR))
+meshdata = importlib.import_module(os.path.basename(ADDON_DIR) + ".meshdata")
+editsession = importlib.import_module(os.path.basename(ADDON_DIR) + ".editsession")
+
+
+def parse_args():
+    argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=1000, help="grid subdivisions per side")
+    parser.add_argument("--select", type=float, default=0.5, help="fraction of faces selected")
+    parser.add_argument("--repeat", type=int, default=3)
+    return parser.parse_args(argv)
+
+
+def timed(label, func, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    print(f"{label:<40} {best * 1000.0:10.1f} ms")
+    return best
+
+
+def create_grid(size, select):
+    bpy.ops.mesh.primitive_grid_add(x_subdivisions=size, y_subdivisions=size, size=2.0)
+    obj = bpy.context.active_object
+    mesh = obj.data
+    mesh.uv_layers.new()
+    mask = np.random.default_rng(0).random(len(mesh.polygons)) < select
+    meshdata.set_face_selection(mesh, mask)
+    return obj
+
+
+# The code the operators ran before, kept here for comparison
+
+# Mesh syncs (Edit/Object Mode switches) of the old code since the last reset
+old_syncs = 0
+
+
+def set_mode(obj, mode):
+    global old_syncs
+    if obj.mode != mode:
+        old_syncs += 1
+        bpy.ops.object.mode_set(mode=mode)
+
+
+def bmesh_selection(obj):
+    set_mode(obj, 'EDIT')
+    bm = bmesh.from_edit_mesh(obj.data)
+    bm.faces.ensure_lookup_table()
+    indices = [f.index for f in bm.faces if f.select]
+    for face in bm.faces:
+        face.select = False
+    for face_index in indices:
+        bm.faces[face_index].select = True
+    bmesh.update_edit_mesh(obj.data)
+    set_mode(obj, 'OBJECT')
+
+
+def bmesh_bounds(obj):
+    set_mode(obj, 'EDIT')
+    bm = bmesh.from_edit_mesh(obj.data)
+    selected_faces = [f for f in bm.faces if f.select]
+    bbox_corners = [v.co for f in selected_faces for v in f.verts]
+    min_corner = Vector(map(min, zip(*bbox_corners)))
+    max_corner = Vector(map(max, zip(*bbox_corners)))
+    sum((f.normal for f in selected_faces), Vector()) / len(selected_faces)
+    set_mode(obj, 'OBJECT')
+    return min_corner, max_corner
+
+
+def bmesh_scale_uv(obj, scale_factor):
+    # Scale UV only runs in Edit Mode, where the BMesh is already there
+    bm = bmesh.from_edit_mesh(obj.data)
+    uv_layer = bm.loops.layers.uv.active
+    for face in bm.faces:
+        if face.select:
+            for loop in face.loops:
+                loop_uv = loop[uv_layer]
+                loop_uv.uv = ((loop_uv.uv - Vector((0.5, 0.5))) * scale_factor) + Vector((0.5, 0.5))
+    bmesh.update_edit_mesh(obj.data)
+
+
+def bmesh_apply_material(obj, mat):
+    # Mesh handling of the old ApplyGreebleTextureOperator, called from Edit
+    # Mode: capture the selection, assign the material, restore the selection
+    bm = bmesh.from_edit_mesh(obj.data)
+    indices = [f.index for f in bm.faces if f.select]
+    bm = bmesh.from_edit_mesh(obj.data)
+    if mat.name not in obj.data.materials:
+        obj.data.materials.append(mat)
+    mat_index = obj.data.materials.find(mat.name)
+    for face in [f for f in bm.faces if f.select]:
+        face.material_index = mat_index
+    set_mode(obj, 'OBJECT')
+    set_mode(obj, 'EDIT')
+    bm = bmesh.from_edit_mesh(obj.data)
+    bm.faces.ensure_lookup_table()
+    for face in bm.faces:
+        face.select = False
+    for face_index in indices:
+        bm.faces[face_index].select = True
+    bmesh.update_edit_mesh(obj.data)
+
+
+def numpy_selection(obj):
+    mask = meshdata.get_face_selection(obj.data)
+    meshdata.set_face_selection(obj.data, mask)
+
+
+def numpy_bounds(obj):
+    return meshdata.get_faces_bounds(obj.data, meshdata.get_face_selection(obj.data))
+
+
+def numpy_scale_uv(obj, scale_factor):
+    # What ScaleUVOperator does: to Object Mode and back around the write
+    with editsession.MeshEditSession(bpy.context, obj, "scale UVs") as session:
+        meshdata.transform_uvs(session.mesh, session.selection, scale=scale_factor, pivot=(0.5, 0.5))
+
+
+def numpy_apply_material(obj, mat):
+    with editsession.MeshEditSession(bpy.context, obj, "apply material") as session:
+        session.assign_material(mat, session.selection)
+
+
+def main():
+    args = parse_args()
+    bpy.ops.wm.read_factory_settings(use_empty=True)
+    obj = create_grid(args.size, args.select)
+    print(f"{len(obj.data.polygons)} faces, {len(obj.data.loops)} loops")
+    mat = bpy.data.materials.new("Benchmark")
+
+    rows = [
+        ("selection save/restore", 'OBJECT', bmesh_selection, numpy_selection),
+        ("bounding box + average normal", 'OBJECT', bmesh_bounds, numpy_bounds),
+        ("scale UVs", 'EDIT', lambda o: bmesh_scale_uv(o, 1.01), lambda o: numpy_scale_uv(o, 1.01)),
+        ("apply material", 'EDIT', lambda o: bmesh_apply_material(o, mat), lambda o: numpy_apply_material(o, mat)),
+    ]
+    global old_syncs
+    for label, mode, old, new in rows:
+        bpy.ops.object.mode_set(mode=mode)
+        old_syncs = 0
+        old_time = timed(f"{label} (bmesh)", lambda: old(obj), args.repeat)
+        new_time = timed(f"{label} (numpy)", lambda: new(obj), args.repeat)
+        # Sessions record their syncs under their label, the other rows have none
+        new_syncs = editsession.last_runs.get(label, (0, 0.0))[0]
+        print(f"{'':<40} {old_time / new_time:10.1f} x faster, "
+              f"mesh syncs {old_syncs // args.repeat} -> {new_syncs}")
+    bpy.ops.object.mode_set(mode='OBJECT')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+# Times every stage of the greeble pipeline against the stand-in server in
+# mock_sdserver.py, so changes can be measured without a GPU.
+#
+#   blender -b --factory-startup --python benchmarks/bench_pipeline.py -- --sizes 10 100 300
+#
+# --sizes are grid subdivisions per side (300 is 90000 faces). --server runs
+# against a real WebUI instead of the mock, --json writes the timings for CI.
+import argparse
+import importlib
+import json
+import os
+import sys
+import time
+
+import bpy
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ADDON_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, os.path.dirname(ADDON_DIR))
+sys.path.insert(0, BENCH_DIR)
+PACKAGE = os.path.basename(ADDON_DIR)
+addon = importlib.import_module(PACKAGE)
+apihandler = importlib.import_module(PACKAGE + ".apihandler")
+meshdata = importlib.import_module(PACKAGE + ".meshdata")
+resources = importlib.import_module(PACKAGE + ".resources")
+sdclient = importlib.import_module(PACKAGE + ".sdclient")
+cache = importlib.import_module(PACKAGE + ".cache")
+editsession = importlib.import_module(PACKAGE + ".editsession")
+import mock_sdserver
+
+
+def parse_args():
+    argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 300], help="grid subdivisions per side")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--server", help="URL of a real WebUI, the mock is started otherwise")
+    parser.add_argument("--step-latency", type=float, default=0.01, help="mock seconds per sampling step")
+    parser.add_argument("--request-latency", type=float, default=0.0, help="mock seconds per generation")
+    parser.add_argument("--detect-latency", type=float, default=0.0, help="mock seconds per detect call")
+    parser.add_argument("--json", help="write all timings to this file")
+    return parser.parse_args(argv)
+
+
+def timed(func, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def create_grid(size):
+    for old in list(bpy.data.objects):
+        bpy.data.objects.remove(old)
+    bpy.ops.mesh.primitive_grid_add(x_subdivisions=size, y_subdivisions=size, size=2.0)
+    obj = bpy.context.active_object
+    obj.data.uv_layers.new()
+    meshdata.set_face_selection(obj.data, np.ones(len(obj.data.polygons), dtype=bool))
+    return obj
+
+
+def apply_material(obj):
+    # What the apply operators do with a result once it is back
+    with editsession.MeshEditSession(bpy.context, obj, "Benchmark material") as session:
+        image = resources.load_image(apihandler.imagebuffers.get_buffer("output"), "GreebleTexture")
+        mat = resources.get_texture_material(image)
+        session.assign_material(mat, session.selection)
+        depth = resources.load_image(apihandler.imagebuffers.get_buffer("depth"), "GreebleDepth")
+        resources.set_depth_image(mat, depth)
+
+
+def bench_size(size, args):
+    obj = create_grid(size)
+    scene = bpy.context.scene
+    scene.greeble_in_memory = True
+    prompt = scene.greeble_generator_prompt
+    stages = {}
+
+    for mode in ('RASTER', 'RENDER'):
+        scene.greeble_capture_mode = mode
+        stages[f"snapshot ({mode.lower()})"] = timed(bpy.ops.object.snapshot_operator, args.repeat)
+
+    stages["send_prompt_to_stable_diffusion"] = timed(
+        lambda: apihandler.send_prompt_to_stable_diffusion(prompt, steps=args.steps, in_memory=True), args.repeat)
+    stages["get_depth_map"] = timed(
+        lambda: apihandler.get_depth_map("", steps=args.steps, source='DETECT', in_memory=True), args.repeat)
+    stages["material application"] = timed(lambda: apply_material(obj), args.repeat)
+    return len(obj.data.polygons), stages
+
+
+def main():
+    args = parse_args()
+    server = None
+    url = args.server
+    if url is None:
+        server = mock_sdserver.start_server(request_latency=args.request_latency, step_latency=args.step_latency,
+                                            detect_latency=args.detect_latency)
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    addon.register()
+    sdclient.configure_client(urls=[url], health_interval=0)
+    # Every repetition has to reach the server
+    cache.configure_cache(enabled=False)
+
+    results = []
+    try:
+        for size in args.sizes:
+            faces, stages = bench_size(size, args)
+            print(f"{faces} faces")
+            for label, seconds in stages.items():
+                print(f"  {label:<40} {seconds * 1000.0:10.1f} ms")
+            results.append({"size": size, "faces": faces, "seconds": stages})
+    finally:
+        addon.unregister()
+        if server is not None:
+            server.shutdown()
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as output:
+            json.dump({"server": args.server or "mock", "steps": args.steps, "results": results}, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+# Measures how long enabling the add-on takes: importing the package and
+# running register() in a fresh background Blender, repeated in new processes
+# so nothing is cached between runs.
+#
+#   blender -b --factory-startup --python benchmarks/bench_startup.py -- --repeat 5
+#
+# Also reports which heavy modules the enable pulled in. --eager imports
+# them up front the way the add-on used to, for a before/after comparison.
+import argparse
+import importlib
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import bpy
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ADDON_DIR = os.path.dirname(BENCH_DIR)
+PACKAGE = os.path.basename(ADDON_DIR)
+# Modules that are slow to import and are not needed to enable the add-on
+HEAVY_MODULES = ("requests", "urllib3", "PIL", "numpy")
+RESULT_PREFIX = "GREEBLE_STARTUP "
+
+
+def parse_args():
+    argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5, help="fresh Blender processes to measure")
+    parser.add_argument("--eager", action="store_true", help="import requests and Pillow before enabling")
+    parser.add_argument("--json", help="write all timings to this file")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def measure(eager):
+    # One enable in this process, printed as a result line
+    preloaded = [name for name in HEAVY_MODULES if name in sys.modules]
+    sys.path.insert(0, os.path.dirname(ADDON_DIR))
+    start = time.perf_counter()
+    if eager:
+        import requests
+        import PIL
+    addon = importlib.import_module(PACKAGE)
+    imported = time.perf_counter()
+    addon.register()
+    registered = time.perf_counter()
+    result = {
+        "import": imported - start,
+        "register": registered - imported,
+        "total": registered - start,
+        "preloaded": preloaded,
+        "loaded": [name for name in HEAVY_MODULES if name in sys.modules and name not in preloaded],
+    }
+    addon.unregister()
+    print(RESULT_PREFIX + json.dumps(result), flush=True)
+
+
+def run_child(eager):
+    command = [bpy.app.binary_path, "-b", "--factory-startup", "--python", os.path.abspath(__file__),
+               "--", "--child"]
+    if eager:
+        command.append("--eager")
+    output = subprocess.run(command, capture_output=True, text=True).stdout
+    for line in output.splitlines():
+        if line.startswith(RESULT_PREFIX):
+            return json.loads(line[len(RESULT_PREFIX):])
+    raise RuntimeError(f"no result from the child Blender:\n{output}")
+
+
+def main():
+    args = parse_args()
+    if args.child:
+        measure(args.eager)
+        return
+
+    results = [run_child(args.eager) for _ in range(args.repeat)]
+    for key in ("import", "register", "total"):
+        values = [result[key] for result in results]
+        print(f"  {key:<10} median {statistics.median(values) * 1000.0:8.1f} ms   "
+              f"min {min(values) * 1000.0:8.1f} ms")
+    print(f"  already loaded by Blender: {', '.join(results[0]['preloaded']) or 'none'}")
+    print(f"  loaded by the add-on:      {', '.join(results[0]['loaded']) or 'none'}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as output:
+            json.dump({"eager": args.eager, "results": results}, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
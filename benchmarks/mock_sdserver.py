@@ -0,0 +1,198 @@
+# Stand-in for the Stable Diffusion WebUI API, for benchmarks and tests
+# without a GPU. Standard library only, runs inside or outside Blender.
+#
+#   python benchmarks/mock_sdserver.py --port 7860 --step-latency 0.05
+#
+# Implements the endpoints the add-on uses:
+#   GET/POST /sdapi/v1/options   - sd_model_checkpoint, switching takes --load-latency
+#   POST     /sdapi/v1/img2img   - echoes the init images, batch_size of them, plus
+#                                  one depth map per ControlNet unit like the extension
+#   GET      /sdapi/v1/progress  - progress of the running img2img, with its first
+#                                  init image as current_image unless skipped
+#   POST     /sdapi/v1/interrupt - ends the running img2img early
+#   POST     /controlnet/detect  - one depth map per input image
+# A generation takes --request-latency plus --step-latency per sampling step.
+import argparse
+import base64
+import json
+import struct
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_CHECKPOINT = "sd-v1-5-pruned-noema-fp16.safetensors [c83fa2bd2a]"
+
+
+def gray_png(size=512):
+    # Vertical gradient, standing in for a depth map
+    row_values = bytes(int(255 * y / max(size - 1, 1)) for y in range(size))
+    raw = b"".join(b"\x00" + bytes((value,)) * size for value in row_values)
+
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data))
+
+    header = struct.pack(">IIBBBBB", size, size, 8, 0, 0, 0, 0)
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header)
+            + chunk(b"IDAT", zlib.compress(raw, 1)) + chunk(b"IEND", b""))
+
+
+def strip_data_uri(image):
+    return image.split(",", 1)[1] if image.startswith("data:") else image
+
+
+class MockState:
+    # Server side state shared by all request handler threads
+
+    def __init__(self, request_latency=0.0, step_latency=0.0, load_latency=0.0, detect_latency=0.0):
+        self.request_latency = request_latency
+        self.step_latency = step_latency
+        self.load_latency = load_latency
+        self.detect_latency = detect_latency
+        self.checkpoint = DEFAULT_CHECKPOINT
+        self.depth = base64.b64encode(gray_png()).decode()
+        self.lock = threading.Lock()
+        self.generation_lock = threading.Lock()   # The WebUI runs one job at a time
+        self.interrupted = threading.Event()
+        self.job_count = 0
+        self.steps = 0
+        self.step = 0
+        self.started = 0.0
+        self.current_image = None
+        self.requests = {}
+
+    def count(self, path):
+        with self.lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+    def progress(self, skip_current_image=True):
+        with self.lock:
+            if not self.steps:
+                return {"progress": 0.0, "eta_relative": 0.0,
+                        "state": {"job": "", "job_count": self.job_count, "sampling_step": 0,
+                                  "sampling_steps": 0}}
+            progress = self.step / self.steps
+            elapsed = time.monotonic() - self.started
+            eta = elapsed / progress - elapsed if progress else 0.0
+            current_image = None if skip_current_image else self.current_image
+            return {"progress": progress, "eta_relative": eta, "current_image": current_image,
+                    "state": {"job": "img2img", "job_count": self.job_count,
+                              "sampling_step": self.step, "sampling_steps": self.steps}}
+
+    def generate(self, payload):
+        init_images = [strip_data_uri(image) for image in payload.get("init_images", [])] or [self.depth]
+        with self.lock:
+            self.job_count += 1
+            self.current_image = init_images[0]
+        try:
+            with self.generation_lock:
+                self.interrupted.clear()
+                steps = max(1, int(payload.get("steps", 20)))
+                with self.lock:
+                    self.steps, self.step, self.started = steps, 0, time.monotonic()
+                time.sleep(self.request_latency)
+                for step in range(steps):
+                    if self.interrupted.is_set():
+                        break
+                    time.sleep(self.step_latency)
+                    with self.lock:
+                        self.step = step + 1
+                with self.lock:
+                    self.steps = self.step = 0
+        finally:
+            with self.lock:
+                self.job_count -= 1
+
+        batch_size = max(1, int(payload.get("batch_size", 1)))
+        images = [init_images[i % len(init_images)] for i in range(batch_size)]
+        units = payload.get("alwayson_scripts", {}).get("controlnet", {}).get("args", [])
+        # The ControlNet extension appends the preprocessor result of every unit
+        images += [self.depth for _ in units]
+        return {"images": images, "parameters": payload, "info": json.dumps({"seed": payload.get("seed", -1)})}
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"null") if length else None
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        self.state.count(path)
+        if path == "/sdapi/v1/options":
+            self.send_json({"sd_model_checkpoint": self.state.checkpoint})
+        elif path == "/sdapi/v1/progress":
+            self.send_json(self.state.progress(skip_current_image="skip_current_image=false" not in self.path))
+        else:
+            self.send_json({"detail": "Not Found"}, 404)
+
+    def do_POST(self):
+        path = self.path.split("?", 1)[0]
+        self.state.count(path)
+        payload = self.read_json() or {}
+        if path == "/sdapi/v1/options":
+            checkpoint = payload.get("sd_model_checkpoint")
+            if checkpoint and checkpoint != self.state.checkpoint:
+                time.sleep(self.state.load_latency)
+                self.state.checkpoint = checkpoint
+            self.send_json(None)
+        elif path == "/sdapi/v1/img2img":
+            self.send_json(self.state.generate(payload))
+        elif path == "/sdapi/v1/interrupt":
+            self.state.interrupted.set()
+            self.send_json(None)
+        elif path == "/controlnet/detect":
+            time.sleep(self.state.detect_latency)
+            images = payload.get("controlnet_input_images", [])
+            self.send_json({"images": [self.state.depth for _ in images], "info": "Success"})
+        else:
+            self.send_json({"detail": "Not Found"}, 404)
+
+
+def start_server(port=0, **latencies):
+    # Serve on a daemon thread, port 0 picks a free one. Returns the server,
+    # its URL is f"http://127.0.0.1:{server.server_address[1]}".
+    server = ThreadingHTTPServer(("127.0.0.1", port), MockHandler)
+    server.daemon_threads = True
+    server.state = MockState(**latencies)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=7860)
+    parser.add_argument("--request-latency", type=float, default=0.0, help="seconds added to every generation")
+    parser.add_argument("--step-latency", type=float, default=0.0, help="seconds per sampling step")
+    parser.add_argument("--load-latency", type=float, default=0.0, help="seconds to switch checkpoints")
+    parser.add_argument("--detect-latency", type=float, default=0.0, help="seconds per ControlNet detect")
+    args = parser.parse_args()
+    server = start_server(args.port, request_latency=args.request_latency, step_latency=args.step_latency,
+                          load_latency=args.load_latency, detect_latency=args.detect_latency)
+    print(f"Mock Stable Diffusion API on http://127.0.0.1:{server.server_address[1]}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
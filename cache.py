@@ -0,0 +1,135 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from .imagebuffers import get_work_dir
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+
+def make_key(*parts):
+    # Stable content hash of the generation inputs. Parts may be str, bytes,
+    # numbers or JSON serialisable values.
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode('utf-8')
+        elif not isinstance(part, bytes):
+            part = json.dumps(part, sort_keys=True).encode('utf-8')
+        digest.update(len(part).to_bytes(8, 'little'))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+class GenerationCache:
+    # On-disk cache of generated PNGs keyed by the hash of their inputs.
+    #
+    # The directory is scanned once; after that an in-process index ordered
+    # from least to most recently used answers lookups and drives eviction.
+    # File modification times carry the LRU order over to the next session.
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._index = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith('.png'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+        for _, key, size in sorted(entries):
+            self._index[key] = size
+            self.total_bytes += size
+        self._evict()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.png")
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._index:
+                self.misses += 1
+                return None
+            self._index.move_to_end(key)
+            path = self._path(key)
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                os.utime(path)
+            except OSError:
+                # Removed behind our back
+                self.total_bytes -= self._index.pop(key)
+                self.misses += 1
+                return None
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        with self._lock:
+            if key in self._index:
+                self.total_bytes -= self._index.pop(key)
+            tmp_path = self._path(key) + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(key))
+            self._index[key] = len(data)
+            self.total_bytes += len(data)
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._index):
+                self._remove(key)
+
+    def set_max_bytes(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self._index:
+            self._remove(next(iter(self._index)))
+
+    def _remove(self, key):
+        self.total_bytes -= self._index.pop(key)
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def __len__(self):
+        return len(self._index)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+_cache_enabled = True
+_cache_max_bytes = DEFAULT_MAX_BYTES
+
+
+def configure_cache(enabled=True, max_bytes=DEFAULT_MAX_BYTES):
+    global _cache_enabled, _cache_max_bytes
+    _cache_enabled = enabled
+    _cache_max_bytes = max_bytes
+    if _cache is not None:
+        _cache.set_max_bytes(max_bytes)
+
+
+def get_cache():
+    # The shared cache, or None when caching is disabled
+    global _cache
+    if not _cache_enabled:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = GenerationCache(os.path.join(get_work_dir(), "cache"), _cache_max_bytes)
+        return _cache
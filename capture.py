@@ -0,0 +1,188 @@
+import bpy
+import numpy as np
+from mathutils import Matrix
+from . import imagebuffers
+from . import meshdata
+from . import profiling
+from . import rasterizer
+from .resources import mark_owned
+
+# Persistent rig for rendered snapshots. A scene of its own holds an
+# orthographic camera, a sun light and a plain world; its only view layer
+# and collection never contain anything else. For a snapshot the active
+# object is linked into that collection, rendered with a fast engine preset
+# and a border around the selection, and unlinked again. The user's scene,
+# its render settings and compositor are never touched.
+#
+# The image is read back from the capture scene's compositor Viewer node,
+# without a round trip through a file.
+
+CAPTURE_SCENE = "GreebleCapture"
+CAPTURE_CAMERA = "GreebleCaptureCamera"
+CAPTURE_LIGHT = "GreebleCaptureLight"
+CAPTURE_WORLD = "GreebleCaptureWorld"
+VIEWER_IMAGE = "Viewer Node"
+
+# Engine presets of the capture_engine setting
+ENGINES = {
+    'WORKBENCH': ('BLENDER_WORKBENCH',),
+    # EEVEE was renamed in Blender 4.2 and back in 5.0
+    'EEVEE': ('BLENDER_EEVEE_NEXT', 'BLENDER_EEVEE'),
+}
+EEVEE_SAMPLES = 4
+
+
+def get_rig_object(scene, name, data):
+    obj = bpy.data.objects.get(name)
+    if obj is None:
+        obj = mark_owned(bpy.data.objects.new(name, data))
+    if obj.name not in scene.collection.objects:
+        scene.collection.objects.link(obj)
+    return obj
+
+
+def get_capture_scene():
+    # The capture scene, created on first use and repaired if parts of it
+    # were deleted
+    scene = bpy.data.scenes.get(CAPTURE_SCENE)
+    if scene is None:
+        scene = mark_owned(bpy.data.scenes.new(CAPTURE_SCENE))
+        render = scene.render
+        render.resolution_percentage = 100
+        render.film_transparent = False
+        render.use_sequencer = False
+        render.use_border = True
+        render.use_crop_to_border = False
+        scene.view_settings.view_transform = 'Standard'
+        scene.display.render_aa = 'FXAA'
+        scene.display.shading.light = 'STUDIO'
+        scene.display.shading.color_type = 'MATERIAL'
+
+    if scene.world is None:
+        world = bpy.data.worlds.get(CAPTURE_WORLD) or mark_owned(bpy.data.worlds.new(CAPTURE_WORLD))
+        # The grey of Blender's default world
+        world.color = (rasterizer.BACKGROUND,) * 3
+        scene.world = world
+
+    camera_data = bpy.data.cameras.get(CAPTURE_CAMERA) or mark_owned(bpy.data.cameras.new(CAPTURE_CAMERA))
+    camera_data.type = 'ORTHO'
+    scene.camera = get_rig_object(scene, CAPTURE_CAMERA, camera_data)
+    light_data = bpy.data.lights.get(CAPTURE_LIGHT) or mark_owned(bpy.data.lights.new(CAPTURE_LIGHT, 'SUN'))
+    get_rig_object(scene, CAPTURE_LIGHT, light_data)
+    return scene
+
+
+def setup_compositor(scene):
+    # Render Layers -> Composite and Viewer, so the render result ends up in
+    # the Viewer Node image whose pixels can be read. False when this
+    # Blender's compositor API does not fit.
+    try:
+        scene.use_nodes = True
+        scene.render.use_compositing = True
+        tree = scene.node_tree
+        nodes = tree.nodes
+        if {node.type for node in nodes} >= {'R_LAYERS', 'COMPOSITE', 'VIEWER'}:
+            return True
+        nodes.clear()
+        layers = nodes.new('CompositorNodeRLayers')
+        layers.scene = scene
+        composite = nodes.new('CompositorNodeComposite')
+        viewer = nodes.new('CompositorNodeViewer')
+        tree.links.new(layers.outputs['Image'], composite.inputs['Image'])
+        tree.links.new(layers.outputs['Image'], viewer.inputs['Image'])
+        return True
+    except (AttributeError, KeyError, RuntimeError):
+        return False
+
+
+def set_engine(scene, engine):
+    for name in ENGINES[engine]:
+        try:
+            scene.render.engine = name
+            break
+        except TypeError:
+            continue
+    if engine == 'EEVEE':
+        scene.eevee.taa_render_samples = EEVEE_SAMPLES
+
+
+def place_rig(scene, center, normal, size):
+    # Camera and sun look along -normal at center, with the right and up
+    # axes of the rasterizer so both capture modes frame the same image
+    right, up, n = rasterizer.get_projection_basis(normal)
+    matrix = Matrix((right, up, n)).transposed().to_4x4()
+    matrix.translation = np.asarray(center, dtype=np.float64) + n * size
+    camera = scene.camera
+    camera.matrix_world = matrix
+    camera.data.ortho_scale = size
+    camera.data.clip_start = size * 0.001
+    camera.data.clip_end = size * 3.0
+    bpy.data.objects[CAPTURE_LIGHT].matrix_world = matrix
+
+
+def set_border(scene, obj, face_mask, center, normal, size, resolution):
+    # Render only the square around the selected faces, a pixel of margin
+    # on every side. The image keeps its full size.
+    mesh = obj.data
+    loop_verts = np.empty(len(mesh.loops), dtype=np.int32)
+    mesh.loops.foreach_get("vertex_index", loop_verts)
+    vertices = np.unique(loop_verts[meshdata.get_loop_mask(mesh, face_mask)])
+    matrix = np.array(obj.matrix_world, dtype=np.float64)
+    coords = meshdata.get_vertex_coords(mesh)[vertices] @ matrix[:3, :3].T + matrix[:3, 3]
+    u, v, _ = rasterizer.project_to_plane(coords, center, normal, size)
+    margin = 1.0 / resolution
+    render = scene.render
+    render.border_min_x = float(np.clip(u.min() - margin, 0.0, 1.0))
+    render.border_max_x = float(np.clip(u.max() + margin, 0.0, 1.0))
+    render.border_min_y = float(np.clip(v.min() - margin, 0.0, 1.0))
+    render.border_max_y = float(np.clip(v.max() + margin, 0.0, 1.0))
+
+
+def read_viewer(resolution):
+    # Pixels of the Viewer Node image as an sRGB PNG, None when there is no
+    # image of the expected size
+    image = bpy.data.images.get(VIEWER_IMAGE)
+    if image is None or tuple(image.size) != (resolution, resolution):
+        return None
+    pixels = np.empty(resolution * resolution * 4, dtype=np.float32)
+    image.pixels.foreach_get(pixels)
+    pixels = pixels.reshape(resolution, resolution, 4)[::-1]
+    # Pixels outside the border are left empty, give them the world color
+    rgb = np.clip(pixels[..., :3], 0.0, 1.0)
+    rgb[pixels[..., 3] == 0.0] = rasterizer.BACKGROUND
+    # The compositor works in linear light, the snapshot is sRGB like a saved render
+    rgb = np.where(rgb <= 0.0031308, rgb * 12.92, 1.055 * rgb ** (1.0 / 2.4) - 0.055)
+    rgba = np.concatenate((rgb, np.ones_like(rgb[..., :1])), axis=-1)
+    return imagebuffers.encode_png((rgba * 255.0 + 0.5).astype(np.uint8))
+
+
+def render_faces(obj, face_mask, center, normal, size, resolution=512, engine='WORKBENCH'):
+    # PNG of obj alone, seen orthographically along -normal at center, all in
+    # world space. Object Mode only.
+    with profiling.stage("camera setup"):
+        scene = get_capture_scene()
+        use_viewer = setup_compositor(scene)
+        set_engine(scene, engine)
+        scene.render.resolution_x = resolution
+        scene.render.resolution_y = resolution
+        place_rig(scene, center, normal, size)
+        set_border(scene, obj, face_mask, center, normal, size, resolution)
+
+    linked = obj.name not in scene.collection.objects
+    if linked:
+        scene.collection.objects.link(obj)
+    try:
+        with profiling.stage("render"):
+            bpy.ops.render.render(scene=scene.name)
+    finally:
+        if linked:
+            scene.collection.objects.unlink(obj)
+
+    with profiling.stage("read render"):
+        png = read_viewer(resolution) if use_viewer else None
+        if png is None:
+            path = imagebuffers.get_work_path("capture.png")
+            bpy.data.images['Render Result'].save_render(filepath=path, scene=scene)
+            with open(path, "rb") as image_file:
+                png = image_file.read()
+    return png
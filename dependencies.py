@@ -0,0 +1,39 @@
+import importlib
+import importlib.util
+import subprocess
+import sys
+
+# Python packages the add-on uses beyond what Blender ships with. None of
+# them is imported while the add-on is enabled; they are installed only when
+# asked to from the add-on preferences.
+#
+#   module name -> (pip package, what it is used for)
+PACKAGES = {
+    "requests": ("requests", "talking to the Stable Diffusion servers"),
+    "PIL": ("Pillow", "faster PNG decoding, WebP and JPEG export"),
+}
+
+_available = {}
+
+
+def is_available(module):
+    # Whether module can be imported, without importing it
+    if module not in _available:
+        _available[module] = importlib.util.find_spec(module) is not None
+    return _available[module]
+
+
+def missing_packages():
+    return [package for module, (package, _) in PACKAGES.items() if not is_available(module)]
+
+
+def install(packages):
+    # pip install packages into Blender's Python. Blocks until pip is done,
+    # returns pip's output. Raises subprocess.CalledProcessError on failure.
+    python_exe = sys.executable
+    subprocess.run([python_exe, "-m", "ensurepip"], capture_output=True, text=True)
+    result = subprocess.run([python_exe, "-m", "pip", "install", *packages],
+                            capture_output=True, text=True, check=True)
+    importlib.invalidate_caches()
+    _available.clear()
+    return result.stdout
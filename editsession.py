@@ -0,0 +1,101 @@
+import time
+import bpy
+from . import meshdata
+from . import resources
+from . import profiling
+
+# Every Edit/Object Mode switch and every update_from_editmode() copies the
+# whole mesh between BMesh and Mesh data. Each session records how many of
+# these syncs it caused and how long it took, keyed by its label.
+last_runs = {}
+
+
+def set_mode(obj, mode, session=None):
+    # bpy.ops.object.mode_set that counts the mesh syncs it causes
+    if obj.mode == mode:
+        return
+    if session is not None:
+        session.mesh_syncs += 1
+    with profiling.stage("mode switch"):
+        bpy.ops.object.mode_set(mode=mode)
+
+
+def capture_selection(obj, label):
+    # Face selection mask of obj without leaving the current mode
+    start = time.perf_counter()
+    syncs = 0
+    if obj.mode == 'EDIT':
+        with profiling.stage("mode switch"):
+            obj.update_from_editmode()
+        syncs = 1
+    mask = meshdata.get_face_selection(obj.data)
+    record_run(label, syncs, time.perf_counter() - start)
+    return mask
+
+
+def record_run(label, mesh_syncs, seconds):
+    # Shown with the timings in the panel, and read by bench_meshdata.py
+    last_runs[label] = (mesh_syncs, seconds)
+
+
+class MeshEditSession:
+    # Context manager doing all face and material edits of one operator in
+    # Object Mode, where mesh data is read and written with foreach_get/set.
+    #
+    #   with MeshEditSession(context, obj, "Apply Greeble Texture") as session:
+    #       session.assign_material(mat, session.selection)
+    #
+    # The mode is switched at most once on enter and once on exit, and the
+    # face selection is captured once.
+
+    def __init__(self, context, obj, label):
+        self.context = context
+        self.obj = obj
+        self.label = label
+        self.mesh_syncs = 0
+        self.selection = None
+        self._mode = None
+        self._start = None
+        self._opened_run = False
+
+    @property
+    def mesh(self):
+        return self.obj.data
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        # Stages go to the run of a background job when there is one
+        self._opened_run = profiling.begin_run(self.label)
+        self._mode = self.obj.mode
+        self.context.view_layer.objects.active = self.obj
+        set_mode(self.obj, 'OBJECT', self)
+        self.selection = meshdata.get_face_selection(self.mesh)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Operators such as camera_add change the active object
+        self.context.view_layer.objects.active = self.obj
+        self.mesh.update()
+        # Material assignments change which greeble datablocks are orphans
+        resources.invalidate_memory_report()
+        set_mode(self.obj, self._mode, self)
+        record_run(self.label, self.mesh_syncs, time.perf_counter() - self._start)
+        if self._opened_run:
+            profiling.end_run()
+        return False
+
+    def assign_material(self, mat, face_mask):
+        if mat.name not in self.mesh.materials:
+            self.mesh.materials.append(mat)
+        # Ensure the object has UV mapping
+        if not self.mesh.uv_layers:
+            self.mesh.uv_layers.new()
+        meshdata.set_material_index(self.mesh, face_mask, self.mesh.materials.find(mat.name))
+
+    def get_face_material(self, face_mask):
+        # Material of the first face in face_mask
+        faces = face_mask.nonzero()[0]
+        if not len(faces):
+            return None
+        face_mat_index = meshdata.get_material_indices(self.mesh)[faces[0]]
+        return self.mesh.materials[face_mat_index] if face_mat_index < len(self.mesh.materials) else None
@@ -0,0 +1,142 @@
+import hashlib
+import io
+import os
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from . import imagebuffers
+from . import profiling
+
+# Writing saved textures off the main thread. Results are encoded from the
+# in-memory buffers (or the PNGs of the work directory) on a small thread
+# pool, in the chosen format, and named by a hash of their content and
+# format: saving the same texture twice finds the file already there.
+#
+# Color: PNG (as returned by the server), WebP or JPEG
+# Depth: PNG (8 bit, as returned), 16 bit PNG or 32 bit float OpenEXR. Every
+#        depth source is 8 bit, the wider formats only change the container.
+
+COLOR_FORMATS = {'PNG': ".png", 'WEBP': ".webp", 'JPEG': ".jpg"}
+DEPTH_FORMATS = {'PNG': ".png", 'PNG16': ".png", 'EXR': ".exr"}
+
+_executor = None
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="greeble-export")
+    return _executor
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+
+
+def submit(result, base_name, directory, file_format, quality=90, depth=False):
+    # Export a pipeline result (file path or ImageBuffer) on the pool. The
+    # future resolves to (content hash of the result, written file path).
+    return get_executor().submit(export_result, result, base_name, directory, file_format, quality, depth)
+
+
+def export_result(result, base_name, directory, file_format, quality=90, depth=False):
+    # Never touches bpy, runs on the export pool
+    if isinstance(result, imagebuffers.ImageBuffer):
+        png = result.png
+    else:
+        with open(result, "rb") as image_file:
+            png = image_file.read()
+    digest = hashlib.sha256(png).hexdigest()
+
+    extension = (DEPTH_FORMATS if depth else COLOR_FORMATS)[file_format]
+    # Lossy formats are named by their quality too
+    name_hash = hashlib.sha256(f"{digest} {file_format} {quality}".encode()).hexdigest()[:16]
+    path = os.path.join(directory, f"{base_name}_{name_hash}{extension}")
+    if os.path.exists(path):
+        return digest, path
+
+    with profiling.stage("export encode"):
+        if file_format == 'PNG':
+            data = png
+        elif depth:
+            data = encode_depth(load_pixels(result, png), file_format)
+        else:
+            data = encode_color(load_pixels(result, png), file_format, quality)
+
+    # Written under a temporary name first, a file that exists is complete
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as image_file:
+        image_file.write(data)
+    os.replace(tmp_path, path)
+    return digest, path
+
+
+def load_pixels(result, png):
+    if isinstance(result, imagebuffers.ImageBuffer):
+        return result.pixels
+    return imagebuffers.decode_png(png)
+
+
+def encode_color(pixels, file_format, quality=90):
+    # Float RGBA pixels (bottom row first) as WebP or JPEG
+    from PIL import Image
+    rgb = (pixels[::-1, :, :3] * 255.0 + 0.5).astype(np.uint8)
+    output = io.BytesIO()
+    Image.fromarray(rgb, "RGB").save(output, format=file_format, quality=quality)
+    return output.getvalue()
+
+
+def encode_depth(pixels, file_format):
+    # The red channel of float RGBA pixels (bottom row first) as a 16 bit
+    # grayscale PNG or a float OpenEXR
+    depth = np.clip(pixels[::-1, :, 0], 0.0, 1.0)
+    if file_format == 'EXR':
+        return encode_exr(depth)
+    return imagebuffers.encode_png((depth * 65535.0 + 0.5).astype(np.uint16), compress_level=6)
+
+
+def encode_exr(depth):
+    # Single channel ("Y") 32 bit float scanline OpenEXR, ZIP compressed in
+    # blocks of 16 lines. Top row first, standard library and NumPy only.
+    height, width = depth.shape
+
+    def attribute(name, type_name, value):
+        return name.encode() + b"\0" + type_name.encode() + b"\0" + struct.pack("<i", len(value)) + value
+
+    channels = b"Y\0" + struct.pack("<iB3xii", 2, 0, 1, 1) + b"\0"
+    box = struct.pack("<iiii", 0, 0, width - 1, height - 1)
+    header = (b"\x76\x2f\x31\x01" + struct.pack("<i", 2)
+              + attribute("channels", "chlist", channels)
+              + attribute("compression", "compression", b"\x03")
+              + attribute("dataWindow", "box2i", box)
+              + attribute("displayWindow", "box2i", box)
+              + attribute("lineOrder", "lineOrder", b"\x00")
+              + attribute("pixelAspectRatio", "float", struct.pack("<f", 1.0))
+              + attribute("screenWindowCenter", "v2f", struct.pack("<ff", 0.0, 0.0))
+              + attribute("screenWindowWidth", "float", struct.pack("<f", 1.0))
+              + b"\0")
+
+    rows = depth.astype("<f4")
+    blocks = []
+    for y in range(0, height, 16):
+        raw = np.frombuffer(rows[y:y + 16].tobytes(), dtype=np.uint8)
+        # ZIP predictor: interleave the even and odd bytes, then store deltas
+        split = np.concatenate((raw[0::2], raw[1::2])).astype(np.int16)
+        split[1:] = (split[1:] - split[:-1] + 384) & 0xff
+        data = zlib.compress(split.astype(np.uint8).tobytes(), 6)
+        if len(data) >= len(raw):
+            # Blocks that do not compress are stored as they are
+            data = raw.tobytes()
+        blocks.append(struct.pack("<ii", y, len(data)) + data)
+
+    # Offset table of the blocks, which follow it
+    offset = len(header) + 8 * len(blocks)
+    offsets = []
+    for block in blocks:
+        offsets.append(offset)
+        offset += len(block)
+    return header + struct.pack(f"<{len(offsets)}Q", *offsets) + b"".join(blocks)
@@ -0,0 +1,265 @@
+# Headless batch runs of the greeble pipeline, for render farms and scripts.
+#
+#   blender -b --python-expr "import sys, GreebleGenerator.headless as h; sys.exit(h.main())" -- \
+#       jobs.jsonl --output results.jsonl --output-dir greebles --workers 4
+#
+# (use the folder name the add-on is installed under in place of
+# GreebleGenerator). Every line of the manifest is one job:
+#
+#   {"id": "hull-01", "blend": "ship.blend", "object": "Hull", "faces": [12, 13, 14],
+#    "prompt": "grb, hull plating", "seed": 7, "depth_source": "TEXTURE"}
+#
+# "faces" is a list of face indices, "selected" (default) or "all". The other
+# keys in JOB_SETTINGS override the scene settings of the same name. Each job
+# runs snapshot -> texture -> depth -> material in a background Blender
+# process of its own pool, starting from the unmodified .blend file. Results
+# are streamed to the output JSONL as jobs finish, one line per job with its
+# stage timings and the files written to --output-dir.
+import argparse
+import json
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+
+import bpy
+import numpy as np
+
+# Manifest key -> scene property set before the job runs
+JOB_SETTINGS = {
+    "prompt": "greeble_generator_prompt",
+    "seed": "greeble_seed",
+    "cfg_scale": "greeble_cfg_scale",
+    "denoising_strength": "greeble_denoising_strength",
+    "depth_source": "greeble_depth_source",
+    "depth_mode": "greeble_depth_mode",
+    "depth_strength": "greeble_depth_strength",
+    "capture_mode": "greeble_capture_mode",
+    "capture_engine": "greeble_capture_engine",
+    "geometry_depth": "greeble_geometry_depth",
+    "tiled": "greeble_tiled",
+    "use_atlas": "greeble_use_atlas",
+}
+
+# Marks the lines of a worker's stdout that carry a job result, everything
+# else Blender prints is passed through
+RESULT_PREFIX = "GREEBLE_RESULT "
+
+
+def parse_args(argv=None):
+    if argv is None:
+        argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    parser = argparse.ArgumentParser(prog="greeble-headless")
+    parser.add_argument("manifest", nargs="?", help="JSONL file with one job per line")
+    parser.add_argument("--output", default="greeble_results.jsonl", help="JSONL file the results are streamed to")
+    parser.add_argument("--output-dir", default="greeble_output", help="directory for textures and .blend files")
+    parser.add_argument("--blend", help=".blend file for jobs that do not name one")
+    parser.add_argument("--workers", type=int, default=2, help="background Blender processes")
+    parser.add_argument("--save-blend", action="store_true", help="save a greebled copy of the .blend per job")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.worker:
+        return worker_main(args)
+    if not args.manifest:
+        print("Greeble Generator: no job manifest given")
+        return 1
+    return run_pool(args)
+
+
+def read_manifest(path, default_blend=None):
+    jobs = []
+    with open(path, encoding="utf-8") as manifest:
+        for number, line in enumerate(manifest, 1):
+            if not line.strip():
+                continue
+            job = json.loads(line)
+            job.setdefault("id", str(number))
+            if default_blend and "blend" not in job:
+                job["blend"] = default_blend
+            if "blend" in job:
+                job["blend"] = os.path.abspath(job["blend"])
+            jobs.append(job)
+    return jobs
+
+
+# Coordinator side
+
+def run_pool(args):
+    # Hand out jobs to a pool of background Blender processes one at a time,
+    # so fast workers take more of them, and stream their results
+    jobs = read_manifest(args.manifest, args.blend)
+    os.makedirs(args.output_dir, exist_ok=True)
+    pending = queue.Queue()
+    for job in jobs:
+        pending.put(job)
+
+    output_lock = threading.Lock()
+    failed = []
+    start = time.perf_counter()
+    with open(args.output, "w", encoding="utf-8") as output:
+        def write_result(result):
+            with output_lock:
+                output.write(json.dumps(result) + "\n")
+                output.flush()
+                if result.get("status") != "ok":
+                    failed.append(result["id"])
+                print(f"Greeble Generator: job {result['id']} {result.get('status')} "
+                      f"in {result.get('seconds', 0.0):.1f} s")
+
+        threads = [threading.Thread(target=drive_worker, args=(index, args, pending, write_result))
+                   for index in range(max(1, min(args.workers, len(jobs))))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Jobs left over when every worker died never ran
+        while True:
+            try:
+                job = pending.get_nowait()
+            except queue.Empty:
+                break
+            write_result({"id": job["id"], "status": "error", "error": "no worker left to run the job"})
+
+    print(f"Greeble Generator: {len(jobs) - len(failed)} of {len(jobs)} jobs done "
+          f"in {time.perf_counter() - start:.1f} s, results in {args.output}")
+    return 1 if failed else 0
+
+
+def worker_command(args):
+    package = __package__
+    command = [
+        bpy.app.binary_path, "-b",
+        "--python-expr", f"import sys, {package}.headless as h; sys.exit(h.main())",
+        "--", "--worker", "--output-dir", os.path.abspath(args.output_dir),
+    ]
+    if args.save_blend:
+        command.append("--save-blend")
+    return command
+
+
+def drive_worker(index, args, pending, write_result):
+    # Feed one background Blender jobs through its stdin and collect the
+    # result line it prints for each. A crashed worker fails its current job.
+    process = subprocess.Popen(worker_command(args), stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               text=True, bufsize=1)
+    try:
+        while True:
+            try:
+                job = pending.get_nowait()
+            except queue.Empty:
+                break
+            process.stdin.write(json.dumps(job) + "\n")
+            process.stdin.flush()
+            result = None
+            for line in process.stdout:
+                if line.startswith(RESULT_PREFIX):
+                    result = json.loads(line[len(RESULT_PREFIX):])
+                    break
+                print(f"[worker {index}] {line}", end="")
+            if result is None:
+                write_result({"id": job["id"], "status": "error", "worker": index,
+                              "error": f"worker exited with code {process.poll()}"})
+                break
+            result["worker"] = index
+            write_result(result)
+    finally:
+        if process.stdin and not process.stdin.closed:
+            process.stdin.close()
+        process.wait()
+
+
+# Worker side, runs inside a background Blender
+
+def worker_main(args):
+    import addon_utils
+    if __package__ not in bpy.context.preferences.addons:
+        addon_utils.enable(__package__, default_set=False)
+
+    # Jobs arrive one JSON line at a time until the coordinator closes stdin
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        job = json.loads(line)
+        result = run_job(job, args.output_dir, args.save_blend)
+        sys.stdout.write(RESULT_PREFIX + json.dumps(result) + "\n")
+        sys.stdout.flush()
+    return 0
+
+
+def run_job(job, output_dir, save_blend=False):
+    from . import imagebuffers
+
+    result = {"id": job["id"], "status": "ok", "timings": {}}
+    timings = result["timings"]
+    start = time.perf_counter()
+
+    def stage(name, operator):
+        stage_start = time.perf_counter()
+        outcome = operator()
+        timings[name] = time.perf_counter() - stage_start
+        if 'FINISHED' not in outcome:
+            raise RuntimeError(f"{name} failed")
+
+    try:
+        # Every job starts from the file as it is on disk
+        if job.get("blend"):
+            bpy.ops.wm.open_mainfile(filepath=job["blend"])
+        prepare_job(job)
+
+        stage("snapshot", bpy.ops.object.snapshot_operator)
+        stage("texture", bpy.ops.object.apply_greeble_texture)
+        stage("depth", bpy.ops.object.apply_depth_map)
+
+        stage_start = time.perf_counter()
+        os.makedirs(output_dir, exist_ok=True)
+        for name, stage_name in (("texture", "output"), ("depth", "depth")):
+            buffer = imagebuffers.get_buffer(stage_name)
+            if buffer is not None:
+                path = os.path.join(output_dir, f"{job['id']}_{name}.png")
+                with open(path, "wb") as image_file:
+                    image_file.write(buffer.png)
+                result[name] = path
+        if save_blend:
+            result["blend"] = os.path.join(output_dir, f"{job['id']}.blend")
+            bpy.ops.wm.save_as_mainfile(filepath=result["blend"], copy=True)
+        timings["save"] = time.perf_counter() - stage_start
+    except Exception as e:
+        result["status"] = "error"
+        result["error"] = str(e)
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+def prepare_job(job):
+    # Apply the job's settings and select its faces on its object
+    from . import meshdata
+
+    scene = bpy.context.scene
+    # Results are passed around in memory and written out by run_job
+    scene.greeble_in_memory = True
+    for key, prop in JOB_SETTINGS.items():
+        if key in job:
+            setattr(scene, prop, job[key])
+
+    obj = bpy.data.objects.get(job.get("object", ""))
+    if obj is None or obj.type != 'MESH':
+        raise ValueError(f"mesh object {job.get('object')!r} not found")
+    if bpy.context.object is not None and bpy.context.object.mode != 'OBJECT':
+        bpy.ops.object.mode_set(mode='OBJECT')
+    bpy.context.view_layer.objects.active = obj
+    obj.select_set(True)
+
+    faces = job.get("faces", "selected")
+    if faces == "all":
+        meshdata.set_face_selection(obj.data, np.ones(len(obj.data.polygons), dtype=bool))
+    elif faces != "selected":
+        mask = np.zeros(len(obj.data.polygons), dtype=bool)
+        mask[np.asarray(faces, dtype=np.int64)] = True
+        meshdata.set_face_selection(obj.data, mask)
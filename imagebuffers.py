@@ -0,0 +1,248 @@
+import bpy
+import io
+import os
+import tempfile
+import threading
+import time
+import struct
+import zlib
+import numpy as np
+from . import profiling
+
+# Intermediate images are kept outside the add-on folder, which may be
+# read-only when the add-on is installed system wide
+_work_dir = None
+
+
+def get_work_dir():
+    global _work_dir
+    if _work_dir is None:
+        _work_dir = os.path.join(tempfile.gettempdir(), "greeble_generator")
+        os.makedirs(_work_dir, exist_ok=True)
+    return _work_dir
+
+
+def get_work_path(filename):
+    return os.path.join(get_work_dir(), filename)
+
+
+def get_texture_dir():
+    # Saved textures go next to the .blend file, or to the work directory
+    # while the file has not been saved yet
+    if bpy.data.filepath:
+        texture_dir = bpy.path.abspath("//greeble_textures")
+        os.makedirs(texture_dir, exist_ok=True)
+        return texture_dir
+    return get_work_dir()
+
+
+class ImageBuffer:
+    # An encoded PNG as returned by the server, plus its pixels decoded into
+    # the float RGBA layout of bpy.types.Image.pixels (bottom row first).
+    # Decoding is thread safe and may happen on a worker thread.
+
+    def __init__(self, png):
+        self.png = png
+        self.created = time.monotonic()
+        self._pixels = None
+        self._lock = threading.Lock()
+
+    @property
+    def pixels(self):
+        with self._lock:
+            if self._pixels is None:
+                self._pixels = decode_png(self.png)
+        return self._pixels
+
+    @property
+    def width(self):
+        return self.pixels.shape[1]
+
+    @property
+    def height(self):
+        return self.pixels.shape[0]
+
+
+# Last image of each pipeline stage: 'snapshot', 'output' and 'depth'
+buffers = {}
+
+
+def put_buffer(name, png, decode=False):
+    buffer = ImageBuffer(png)
+    if decode:
+        buffer.pixels
+    buffers[name] = buffer
+    return buffer
+
+
+def get_buffer(name):
+    return buffers.get(name)
+
+
+def decode_png(png):
+    # Float RGBA pixels, bottom row first. Pillow is used when it is
+    # installed, the standard library decoder below otherwise.
+    try:
+        from PIL import Image
+    except ImportError:
+        Image = None
+    with profiling.stage("png decode"):
+        if Image is None:
+            pixels = decode_png_rgba(png)
+        else:
+            image = Image.open(io.BytesIO(png)).convert('RGBA')
+            pixels = np.asarray(image, dtype=np.float32) / 255.0
+    # Blender stores images bottom row first
+    return np.ascontiguousarray(pixels[::-1])
+
+
+def decode_png_rgba(png):
+    # Decode a non-interlaced PNG of any color type and a bit depth of 8 or
+    # 16 with zlib and NumPy. Returns top-row-first float RGBA pixels.
+    if png[:8] != b'\x89PNG\r\n\x1a\n':
+        raise ValueError("not a PNG image")
+    position = 8
+    idat = []
+    palette = transparency = None
+    while position < len(png):
+        length, tag = struct.unpack('>I4s', png[position:position + 8])
+        data = png[position + 8:position + 8 + length]
+        position += length + 12
+        if tag == b'IHDR':
+            width, height, bit_depth, color_type, _, _, interlace = struct.unpack('>IIBBBBB', data)
+        elif tag == b'PLTE':
+            palette = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3)
+        elif tag == b'tRNS':
+            transparency = np.frombuffer(data, dtype=np.uint8)
+        elif tag == b'IDAT':
+            idat.append(data)
+        elif tag == b'IEND':
+            break
+    if interlace or bit_depth not in (8, 16):
+        raise ValueError(f"unsupported PNG: bit depth {bit_depth}, interlace {interlace}")
+
+    channels = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}[color_type]
+    pixel_bytes = channels * bit_depth // 8
+    raw = np.frombuffer(zlib.decompress(b''.join(idat)), dtype=np.uint8)
+    raw = raw.reshape(height, 1 + width * pixel_bytes)
+    rows = unfilter_png_rows(raw[:, 0], raw[:, 1:].reshape(height, width, pixel_bytes))
+
+    if bit_depth == 16:
+        values = rows.reshape(height, width * channels * 2).view('>u2').reshape(height, width, channels)
+        values = values.astype(np.float32) / 65535.0
+    else:
+        values = rows.astype(np.float32) / 255.0
+
+    if color_type == 3:
+        alpha = np.full(256, 255, dtype=np.uint8)
+        if transparency is not None:
+            alpha[:len(transparency)] = transparency
+        indices = rows[..., 0]
+        rgba = np.concatenate((palette[indices], alpha[indices][..., None]), axis=-1)
+        return rgba.astype(np.float32) / 255.0
+    if channels < 3:
+        gray = values[..., :1]
+        values = np.concatenate((gray, gray, gray, values[..., 1:]), axis=-1)
+    if values.shape[-1] == 3:
+        values = np.concatenate((values, np.ones(values.shape[:2] + (1,), dtype=np.float32)), axis=-1)
+    return values
+
+
+def unfilter_png_rows(filters, rows):
+    # Undo the per-row PNG filters of rows, shape (height, width, bytes per
+    # pixel). A byte depends on the bytes left, above and above left of it,
+    # so the pixels are reconstructed one anti-diagonal at a time, each
+    # diagonal in one vectorized step.
+    height, width, _ = rows.shape
+    out = np.zeros((height + 1, width + 1, rows.shape[2]), dtype=np.int16)
+    rows = rows.astype(np.int16)
+    filters = filters.astype(np.int16)
+    for diagonal in range(height + width - 1):
+        y = np.arange(max(0, diagonal - width + 1), min(height, diagonal + 1))
+        x = diagonal - y
+        raw = rows[y, x]
+        left = out[y + 1, x]
+        up = out[y, x + 1]
+        up_left = out[y, x]
+        f = filters[y][:, None]
+        # Paeth predictor
+        estimate = left + up - up_left
+        distance_left = np.abs(estimate - left)
+        distance_up = np.abs(estimate - up)
+        distance_up_left = np.abs(estimate - up_left)
+        paeth = np.where((distance_left <= distance_up) & (distance_left <= distance_up_left), left,
+                         np.where(distance_up <= distance_up_left, up, up_left))
+        prediction = np.select([f == 1, f == 2, f == 3, f == 4],
+                               [left, up, (left + up) // 2, paeth], 0)
+        out[y + 1, x + 1] = (raw + prediction) & 0xff
+    return out[1:, 1:].astype(np.uint8)
+
+
+def encode_png(pixels, compress_level=1):
+    # Encode a top-row-first uint8 or uint16 array of shape (h, w) or
+    # (h, w, channels) as PNG, with the standard library only
+    pixels = np.asarray(pixels)
+    if pixels.ndim == 2:
+        pixels = pixels[..., None]
+    height, width, channels = pixels.shape
+    color_type = {1: 0, 2: 4, 3: 2, 4: 6}[channels]
+    if pixels.dtype == np.uint16:
+        bit_depth = 16
+        rows = pixels.astype('>u2').reshape(height, -1).view(np.uint8)
+    else:
+        bit_depth = 8
+        rows = pixels.astype(np.uint8).reshape(height, -1)
+    # Filter type 0 (None) in front of every row
+    raw = np.hstack((np.zeros((height, 1), dtype=np.uint8), rows)).tobytes()
+
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data))
+
+    header = struct.pack('>IIBBBBB', width, height, bit_depth, color_type, 0, 0, 0)
+    with profiling.stage("png encode"):
+        data = zlib.compress(raw, compress_level)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', data) + chunk(b'IEND', b'')
+
+
+def resize_nearest(pixels, size):
+    # Nearest neighbour resize of an (h, w, ...) array to (size, size, ...)
+    height, width = pixels.shape[:2]
+    if (width, height) == (size, size):
+        return pixels
+    rows = np.arange(size) * height // size
+    cols = np.arange(size) * width // size
+    return pixels[rows[:, None], cols[None, :]]
+
+
+def pixels_to_image(pixels, name, image=None):
+    # Fill a Blender image straight from a float RGBA buffer. An existing
+    # image is refilled in place. Main thread only.
+    height, width = pixels.shape[:2]
+    if image is None:
+        image = bpy.data.images.new(name, width, height, alpha=True)
+    elif tuple(image.size) != (width, height):
+        image.scale(width, height)
+    image.pixels.foreach_set(pixels.ravel())
+    image.update()
+    # Generated images are lost when the .blend is saved, pack_generated_images
+    # packs them right before saving
+    image["greeble_pack_on_save"] = True
+    return image
+
+
+def load_result_pixels(result):
+    # Float RGBA pixels of a pipeline result, file path or ImageBuffer
+    if isinstance(result, ImageBuffer):
+        return result.pixels
+    with open(result, "rb") as image_file:
+        return decode_png(image_file.read())
+
+
+@bpy.app.handlers.persistent
+def pack_generated_images(*args):
+    # save_pre handler: encode the images filled from memory only once, when
+    # the .blend is saved
+    for image in bpy.data.images:
+        if image.get("greeble_pack_on_save"):
+            image.pack()
+            image["greeble_pack_on_save"] = False
@@ -0,0 +1,147 @@
+import numpy as np
+from .rasterizer import project_to_plane
+
+# NumPy views of mesh data through foreach_get/foreach_set. All functions work
+# on bpy.types.Mesh data, which is only up to date outside of Edit Mode; call
+# sync_from_editmode() first when the object may be in Edit Mode.
+
+
+def sync_from_editmode(obj):
+    # Flush Edit Mode changes into obj.data without leaving Edit Mode
+    if obj.mode == 'EDIT':
+        obj.update_from_editmode()
+
+
+def get_face_selection(mesh):
+    mask = np.zeros(len(mesh.polygons), dtype=bool)
+    mesh.polygons.foreach_get("select", mask)
+    return mask
+
+
+def set_face_selection(mesh, face_mask):
+    # Select exactly the faces in face_mask, with vertex and edge selection
+    # kept consistent so Edit Mode picks it up unchanged
+    face_mask = np.asarray(face_mask, dtype=bool)
+    loop_mask = get_loop_mask(mesh, face_mask)
+
+    loop_verts = np.empty(len(mesh.loops), dtype=np.int32)
+    mesh.loops.foreach_get("vertex_index", loop_verts)
+    vert_mask = np.zeros(len(mesh.vertices), dtype=bool)
+    vert_mask[loop_verts[loop_mask]] = True
+
+    loop_edges = np.empty(len(mesh.loops), dtype=np.int32)
+    mesh.loops.foreach_get("edge_index", loop_edges)
+    edge_mask = np.zeros(len(mesh.edges), dtype=bool)
+    edge_mask[loop_edges[loop_mask]] = True
+
+    mesh.vertices.foreach_set("select", vert_mask)
+    mesh.edges.foreach_set("select", edge_mask)
+    mesh.polygons.foreach_set("select", face_mask)
+
+
+def get_loop_mask(mesh, face_mask):
+    # Per loop mask of the loops belonging to the faces in face_mask
+    loop_totals = np.empty(len(mesh.polygons), dtype=np.int32)
+    mesh.polygons.foreach_get("loop_total", loop_totals)
+    return np.repeat(np.asarray(face_mask, dtype=bool), loop_totals)
+
+
+def get_vertex_coords(mesh):
+    coords = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+    mesh.vertices.foreach_get("co", coords)
+    return coords.reshape(-1, 3)
+
+
+def get_face_normals(mesh):
+    normals = np.empty(len(mesh.polygons) * 3, dtype=np.float32)
+    mesh.polygons.foreach_get("normal", normals)
+    return normals.reshape(-1, 3)
+
+
+def get_faces_bounds(mesh, face_mask, matrix=None):
+    # Bounding box center, average normal and largest bounding box dimension
+    # of the faces in face_mask as NumPy arrays, in world space when matrix
+    # is given
+    loop_mask = get_loop_mask(mesh, face_mask)
+    loop_verts = np.empty(len(mesh.loops), dtype=np.int32)
+    mesh.loops.foreach_get("vertex_index", loop_verts)
+    coords = get_vertex_coords(mesh)[np.unique(loop_verts[loop_mask])]
+    normals = get_face_normals(mesh)[face_mask]
+
+    if matrix is not None:
+        matrix = np.array(matrix, dtype=np.float64)
+        coords = coords @ matrix[:3, :3].T + matrix[:3, 3]
+        normals = normals @ np.linalg.inv(matrix[:3, :3])
+        normals /= np.linalg.norm(normals, axis=1, keepdims=True)
+
+    min_corner = coords.min(axis=0)
+    max_corner = coords.max(axis=0)
+    center = (min_corner + max_corner) / 2
+    avg_normal = normals.mean(axis=0)
+    max_dimension = float((max_corner - min_corner).max())
+    return center, avg_normal, max_dimension
+
+
+def get_face_areas(mesh):
+    areas = np.empty(len(mesh.polygons), dtype=np.float32)
+    mesh.polygons.foreach_get("area", areas)
+    return areas
+
+
+def get_faces_area(mesh, face_mask, matrix=None):
+    # Total area of the faces in face_mask, in world space when matrix is
+    # given (its scale is treated as uniform)
+    area = float(get_face_areas(mesh)[face_mask].sum())
+    if matrix is not None:
+        area *= abs(np.linalg.det(np.array(matrix, dtype=np.float64)[:3, :3])) ** (2.0 / 3.0)
+    return area
+
+
+def get_material_indices(mesh):
+    indices = np.empty(len(mesh.polygons), dtype=np.int32)
+    mesh.polygons.foreach_get("material_index", indices)
+    return indices
+
+
+def set_material_index(mesh, face_mask, material_index):
+    indices = get_material_indices(mesh)
+    indices[face_mask] = material_index
+    mesh.polygons.foreach_set("material_index", indices)
+
+
+def get_uvs(mesh, uv_layer=None):
+    uv_layer = uv_layer or mesh.uv_layers.active
+    uvs = np.empty(len(mesh.loops) * 2, dtype=np.float32)
+    uv_layer.data.foreach_get("uv", uvs)
+    return uvs.reshape(-1, 2)
+
+
+def set_uvs(mesh, uvs, uv_layer=None):
+    uv_layer = uv_layer or mesh.uv_layers.active
+    uv_layer.data.foreach_set("uv", np.ascontiguousarray(uvs, dtype=np.float32).ravel())
+
+
+def transform_uvs(mesh, face_mask, scale=1.0, offset=(0.0, 0.0), pivot=(0.5, 0.5), uv_layer=None):
+    # Scale the UVs of the faces in face_mask around pivot, then move them by offset
+    uvs = get_uvs(mesh, uv_layer)
+    loop_mask = get_loop_mask(mesh, face_mask)
+    pivot = np.asarray(pivot, dtype=np.float32)
+    uvs[loop_mask] = (uvs[loop_mask] - pivot) * scale + pivot + np.asarray(offset, dtype=np.float32)
+    set_uvs(mesh, uvs, uv_layer)
+
+
+def project_uvs(mesh, face_mask, center, normal, size, matrix=None, uv_layer=None):
+    # Planar UVs for the faces in face_mask that match an orthographic
+    # snapshot along -normal at center with side size (see
+    # rasterizer.project_to_plane), in world space when matrix is given
+    loop_mask = get_loop_mask(mesh, face_mask)
+    loop_verts = np.empty(len(mesh.loops), dtype=np.int32)
+    mesh.loops.foreach_get("vertex_index", loop_verts)
+    coords = get_vertex_coords(mesh)[loop_verts[loop_mask]].astype(np.float64)
+    if matrix is not None:
+        matrix = np.array(matrix, dtype=np.float64)
+        coords = coords @ matrix[:3, :3].T + matrix[:3, 3]
+    u, v, _ = project_to_plane(coords, center, normal, size)
+    uvs = get_uvs(mesh, uv_layer)
+    uvs[loop_mask] = np.stack((u, v), axis=1)
+    set_uvs(mesh, uvs, uv_layer)
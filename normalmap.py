@@ -0,0 +1,36 @@
+import numpy as np
+
+# Depth maps as tangent-space normal maps, an alternative to displacement
+# that needs no extra geometry and costs nothing at render time.
+#
+# Strength 1.0 makes the full depth range (black to white) as deep as 1/16
+# of the texture width.
+DEPTH_SCALE = 1.0 / 16.0
+
+
+def sobel(height):
+    # Horizontal and vertical Sobel gradients of a 2D array per pixel, with
+    # the border pixels repeated
+    padded = np.pad(height, 1, mode='edge')
+    left = padded[:-2, :-2] + 2.0 * padded[1:-1, :-2] + padded[2:, :-2]
+    right = padded[:-2, 2:] + 2.0 * padded[1:-1, 2:] + padded[2:, 2:]
+    low = padded[:-2, :-2] + 2.0 * padded[:-2, 1:-1] + padded[:-2, 2:]
+    high = padded[2:, :-2] + 2.0 * padded[2:, 1:-1] + padded[2:, 2:]
+    return (right - left) / 8.0, (high - low) / 8.0
+
+
+def depth_to_normal(pixels, strength=1.0):
+    # Float RGBA normal map of float RGBA depth pixels, both in the layout of
+    # bpy.types.Image.pixels (bottom row first, so rows go up along V). The
+    # normal is in OpenGL convention (+Y up) like Blender's Normal Map node,
+    # encoded as color = normal * 0.5 + 0.5.
+    height = np.asarray(pixels, dtype=np.float32)[..., 0]
+    dx, dy = sobel(height)
+    scale = strength * DEPTH_SCALE * height.shape[1]
+    normals = np.stack((-dx * scale, -dy * scale, np.ones_like(height)), axis=-1)
+    normals /= np.linalg.norm(normals, axis=-1, keepdims=True)
+
+    result = np.empty(height.shape + (4,), dtype=np.float32)
+    result[..., :3] = normals * 0.5 + 0.5
+    result[..., 3] = 1.0
+    return result
@@ -1,13 +1,60 @@
 import bpy
 import bmesh
 import mathutils
+import numpy as np
 import os
-from datetime import datetime
+import subprocess
+import time
 from mathutils import Vector
 from .apihandler import send_prompt_to_stable_diffusion
 from .apihandler import get_depth_map
+from .apihandler import encode_png
+from .apihandler import send_tiles_to_stable_diffusion
+from . import apihandler
+from . import tiles
+from . import imagebuffers
+from . import rasterizer
+from . import capture
+from . import normalmap
+from . import meshdata
+from . import atlas
+from . import resources
+from . import variations
+from . import export
+from . import dependencies
+from .editsession import MeshEditSession, capture_selection, record_run, set_mode
+from .cache import get_cache
+from .preferences import get_preferences, apply_client_settings
+from . import worker
+from . import profiling
+from .batch import BatchQueue, IslandJob, generate_pack, get_face_islands, get_view_clusters
+from functools import partial
+
+
+def rasterize_snapshot(obj, center, avg_normal, max_dimension, in_memory=False, resolution=512):
+    # Fast capture: project the selected faces onto the plane of avg_normal and
+    # rasterize them with NumPy. Stores the shaded image as the 'snapshot'
+    # stage and the geometric depth as 'snapshot_depth'. Object Mode only.
+    with profiling.stage("rasterize"):
+        coords, triangles, tri_normals = rasterizer.get_selected_triangles(obj.data)
+        shaded, depth, _ = rasterizer.rasterize(coords, triangles, tri_normals, center, avg_normal,
+                                                max_dimension, resolution)
+    stages = {
+        "snapshot": imagebuffers.encode_png(shaded),
+        "snapshot_depth": imagebuffers.encode_png(rasterizer.depth_to_image(depth)),
+    }
+    for name, png in stages.items():
+        if in_memory:
+            imagebuffers.put_buffer(name, png)
+        else:
+            with open(imagebuffers.get_work_path(f"{name}.png"), "wb") as image_file:
+                image_file.write(png)
+
+
+def uses_geometry_depth(scene):
+    # Only the fast raster capture produces a geometric depth
+    return scene.greeble_capture_mode == 'RASTER' and scene.greeble_geometry_depth
 
-addon_dir = os.path.dirname(__file__)
 
 class SnapshotOperator(bpy.types.Operator):
     bl_idname = "object.snapshot_operator"
@@ -16,254 +63,798 @@ class SnapshotOperator(bpy.types.Operator):
     def execute(self, context):
         obj = context.active_object
 
-        # Store current mode and switch to edit mode to access face data
-        current_mode = bpy.context.object.mode
-        bpy.ops.object.mode_set(mode='EDIT')
+        # All mesh access happens in one Object Mode session, which restores
+        # the original mode once at the end
+        with MeshEditSession(context, obj, self.bl_label) as session:
+            selected_faces = session.selection
+
+            if not selected_faces.any():
+                self.report({'ERROR'}, "No faces selected!")
+                return {'CANCELLED'}
+
+            # Calculate the collective bounding box and average normal
+            center, avg_normal, max_dimension = meshdata.get_faces_bounds(session.mesh, selected_faces)
+            center, avg_normal = Vector(center), Vector(avg_normal)
+
+            # Large selections are captured in enough detail for several tiles
+            resolution = tiles.TILE_SIZE
+            if context.scene.greeble_tiled:
+                area = meshdata.get_faces_area(session.mesh, selected_faces, obj.matrix_world)
+                tiles_per_side = tiles.get_tiles_per_side(area, context.scene.greeble_tile_world_size,
+                                                          context.scene.greeble_max_tiles)
+                resolution = tiles.get_resolution(tiles_per_side)
+
+            snapshot_path = imagebuffers.get_work_path("snapshot.png")
+            if context.scene.greeble_capture_mode == 'RASTER':
+                # Rasterize only the selected faces, no render engine involved
+                rasterize_snapshot(obj, center, avg_normal, max_dimension,
+                                   context.scene.greeble_in_memory, resolution)
+            else:
+                # Render the object alone with the capture rig, in world space
+                center, avg_normal, max_dimension = meshdata.get_faces_bounds(session.mesh, selected_faces,
+                                                                              obj.matrix_world)
+                png = capture.render_faces(obj, selected_faces, center, avg_normal, max_dimension,
+                                           resolution, context.scene.greeble_capture_engine)
+
+                # Keep the encoded render in memory, it is sent as it is
+                if context.scene.greeble_in_memory:
+                    imagebuffers.put_buffer("snapshot", png)
+                else:
+                    with open(snapshot_path, "wb") as snapshot_file:
+                        snapshot_file.write(png)
+
+            # Store the path for later use
+            context.scene.greeble_generator_snapshot_path = snapshot_path
+
+        return {'FINISHED'}
+
+
+def assign_material_to_faces(obj, mat, face_indices):
+    # Assign mat to the given faces of obj, in Edit or Object Mode
+    if mat.name not in obj.data.materials:
+        obj.data.materials.append(mat)
+    if not obj.data.uv_layers:
+        obj.data.uv_layers.new()
+    mat_index = obj.data.materials.find(mat.name)
+
+    if obj.mode == 'EDIT':
         bm = bmesh.from_edit_mesh(obj.data)
         bm.faces.ensure_lookup_table()
+        for face_index in face_indices:
+            bm.faces[face_index].material_index = mat_index
+        bmesh.update_edit_mesh(obj.data)
+    else:
+        meshdata.set_material_index(obj.data, face_indices, mat_index)
+        obj.data.update()
 
-        # Store indices of initially selected faces
-        initially_selected_faces_indices = [f.index for f in bm.faces if f.select]
 
-        # Get selected faces
-        selected_faces = [f for f in bm.faces if f.select]
+def tag_redraw_view3d(context):
+    for area in context.screen.areas:
+        if area.type == 'VIEW_3D':
+            area.tag_redraw()
 
-        if not selected_faces:
-            self.report({'ERROR'}, "No faces selected!")
+
+class BackgroundJobMixin:
+    # Shared invoke/modal logic for operators that run a Stable Diffusion
+    # request on a worker thread. Subclasses implement create_job() and
+    # finish_job(context, session, face_mask, result); the latter always runs
+    # on the main thread, inside a MeshEditSession of the target object.
+    _timer = None
+    _job = None
+    _shown_preview = None
+
+    def invoke(self, context, event):
+        if worker.active_job is not None:
+            self.report({'WARNING'}, "A greeble generation is already running.")
             return {'CANCELLED'}
 
-        # Calculate the collective bounding box and average normal
-        bbox_corners = [v.co for f in selected_faces for v in f.verts]
-        min_corner = Vector(map(min, zip(*bbox_corners)))
-        max_corner = Vector(map(max, zip(*bbox_corners)))
-        center = (min_corner + max_corner) / 2
-        avg_normal = sum((f.normal for f in selected_faces), Vector()) / len(selected_faces)
-
-        # Calculate orthographic scale based on the bounding box
-        bbox_dimensions = max_corner - min_corner
-        max_dimension = max(bbox_dimensions.x, bbox_dimensions.y, bbox_dimensions.z)
-
-        # Switch back to object mode
-        bpy.ops.object.mode_set(mode='OBJECT')
-
-        # Create and position the camera
-        bpy.ops.object.camera_add()
-        camera = context.object
-        camera.data.type = 'ORTHO'
-        camera.rotation_euler = avg_normal.rotation_difference(Vector((0, 0, -1))).to_euler()
-        camera_offset = max_dimension  # Adjust this value as needed
-        camera.location = center + avg_normal * camera_offset
-        camera.data.ortho_scale = max_dimension
-
-        # Set camera resolution to 1:1 aspect ratio
-        render = bpy.context.scene.render
-        render.resolution_x = 512
-        render.resolution_y = 512
-
-        # Add a light source at the camera's position
-        bpy.ops.object.light_add(type='POINT', location=camera.location)
-        light = context.object
-
-        # Set the camera as active and render the scene
-        bpy.context.scene.camera = camera
-        bpy.ops.render.render(write_still=True)
-
-        # Save the image
-        snapshot_path = os.path.join(addon_dir, "snapshot.png")
-        bpy.data.images['Render Result'].save_render(filepath=snapshot_path)
-
-        # Store the path for later use
-        context.scene.greeble_generator_snapshot_path = snapshot_path
-
-        # Clean up: delete the camera and light
-        bpy.data.objects.remove(camera)
-        bpy.data.objects.remove(light)
-
-        # Reactivate the original object and restore initial selection
-        context.view_layer.objects.active = obj
-        bpy.ops.object.mode_set(mode='EDIT')
-        bm = bmesh.from_edit_mesh(obj.data)  # Re-acquire BMesh data
-        bm.faces.ensure_lookup_table()  # Update the internal index table
-
-        # Deselect all faces first
-        for face in bm.faces:
-            face.select = False
-
-        # Reselect initially selected faces
-        for face_index in initially_selected_faces_indices:
-            bm.faces[face_index].select = True
-
-        # Update mesh and switch back to the original mode
-        bmesh.update_edit_mesh(obj.data)
-        bpy.ops.object.mode_set(mode=current_mode)
+        obj = context.active_object
+        if obj is None or obj.type != 'MESH':
+            self.report({'ERROR'}, "No active mesh object!")
+            return {'CANCELLED'}
 
-        return {'FINISHED'}
+        # The run covers the whole job, including the worker thread's stages
+        profiling.begin_run(self.bl_label)
+
+        # Remember what to apply the result to; the user may keep working
+        # while the request runs
+        self._obj_name = obj.name
+        self._face_mask = capture_selection(obj, f"{self.bl_label} (capture)")
+
+        self._job = self.create_job(context)
+        self._job.start()
+
+        wm = context.window_manager
+        self._timer = wm.event_timer_add(0.2, window=context.window)
+        wm.modal_handler_add(self)
+        self.update_status(context)
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+        if event.type == 'ESC':
+            self._job.cancel()
+
+        if event.type != 'TIMER':
+            return {'PASS_THROUGH'}
+
+        self.update_status(context)
+        if self._job.preview is not None and self._job.preview is not self._shown_preview:
+            self._shown_preview = self._job.preview
+            self.show_preview(context, self._job.preview)
+        if not self._job.finished:
+            return {'PASS_THROUGH'}
+
+        context.window_manager.event_timer_remove(self._timer)
+        self._timer = None
+        job = self._job
+        self._job = None
+        context.scene.greeble_job_running = False
+        tag_redraw_view3d(context)
+        try:
+            return self.finish_modal(context, job)
+        finally:
+            profiling.end_run()
+
+    def finish_modal(self, context, job):
+        self.discard_preview(context)
+        if job.state == 'CANCELLED':
+            self.report({'INFO'}, f"{job.label} cancelled.")
+            return {'CANCELLED'}
+        if job.state == 'FAILED':
+            self.report({'ERROR'}, f"{job.label} failed: {job.error}")
+            return {'CANCELLED'}
+
+        obj = bpy.data.objects.get(self._obj_name)
+        if obj is None:
+            self.report({'ERROR'}, "Target object no longer exists!")
+            return {'CANCELLED'}
+
+        # Apply the result to the faces that were selected when the job started,
+        # the current selection is left untouched
+        with MeshEditSession(context, obj, self.bl_label) as session:
+            if len(self._face_mask) != len(session.mesh.polygons):
+                self.report({'ERROR'}, "The mesh was edited while generating!")
+                return {'CANCELLED'}
+            return self.finish_job(context, session, self._face_mask, job.result)
+
+    def show_preview(self, context, preview):
+        # Called with every new intermediate image of jobs that want previews
+        pass
+
+    def discard_preview(self, context):
+        # Called once the job has ended, before any result is applied, to
+        # undo what show_preview did
+        pass
+
+    def update_status(self, context):
+        job = self._job
+        scene = context.scene
+        scene.greeble_job_running = not job.finished
+        scene.greeble_job_label = job.label
+        scene.greeble_job_progress = job.progress * 100.0
+        tag_redraw_view3d(context)
+
+
+def apply_texture(scene, session, face_mask, result):
+    # Put a texture result on the faces, packed into the atlas or on their
+    # own material
+    if scene.greeble_use_atlas:
+        # Share one material and pack the texture into its atlas, unless it
+        # is full
+        slot_id = atlas.add_island(session.mesh, face_mask, imagebuffers.load_result_pixels(result))
+        atlas.flush()
+        if slot_id is not None:
+            session.assign_material(atlas.get_atlas_material(), face_mask)
+            return
+    else:
+        # Faces leaving the atlas get their own UVs back
+        atlas.remove_island(session.mesh, face_mask)
+        atlas.flush()
+
+    # Greebling the same faces again refreshes their material in place
+    mat = resources.reusable_material(session.mesh, face_mask)
+
+    # Load the texture image, either from disk or from the in-memory
+    # buffer. An image only this material uses is refreshed in place.
+    old_image = resources.get_node_image(mat, resources.TEXTURE_NODE)
+    if old_image is not None and old_image.users > 1:
+        old_image = None
+    image = resources.load_image(result, "GreebleTexture", old_image)
+
+    # Reuse or create the material, and apply it to the faces
+    with profiling.stage("material"):
+        mat = resources.get_texture_material(image, mat)
+        session.assign_material(mat, face_mask)
 
 
-class ApplyGreebleTextureOperator(bpy.types.Operator):
+class ApplyGreebleTextureOperator(BackgroundJobMixin, bpy.types.Operator):
     bl_idname = "object.apply_greeble_texture"
     bl_label = "Apply Greeble Texture"
 
-    def execute(self, context):
-        snapshot_path = context.scene.greeble_generator_snapshot_path
+    refine: bpy.props.BoolProperty(
+        name="Refine",
+        description="Generate again with the full step count and the seed of the last texture",
+        default=False,
+        options={'SKIP_SAVE'}
+    )
+
+    def get_steps_and_seed(self, scene):
+        # A draft runs few steps; a refine repeats the seed the last texture
+        # was generated with at the full step count
+        if self.refine:
+            return scene.greeble_steps, scene.greeble_last_seed
+        if scene.greeble_draft:
+            return scene.greeble_draft_steps, scene.greeble_seed
+        return scene.greeble_steps, scene.greeble_seed
 
+    def execute(self, context):
+        # Blocking variant, used when the operator is called from a script
         obj = context.active_object
 
-        # Store current mode and switch to edit mode to access face data
-        current_mode = bpy.context.object.mode
-        bpy.ops.object.mode_set(mode='EDIT')
-        bm = bmesh.from_edit_mesh(obj.data)
-        bm.faces.ensure_lookup_table()
+        with MeshEditSession(context, obj, self.bl_label) as session:
+            # Send the snapshot to Stable Diffusion
+            prompt = context.scene.greeble_generator_prompt
+            with_depth = context.scene.greeble_depth_source == 'TEXTURE'
+            steps, seed = self.get_steps_and_seed(context.scene)
+            if context.scene.greeble_tiled:
+                result = send_tiles_to_stable_diffusion(prompt, steps=steps,
+                                                            cfg_scale=context.scene.greeble_cfg_scale,
+                                                            denoising_strength=context.scene.greeble_denoising_strength,
+                                                            in_memory=context.scene.greeble_in_memory,
+                                                            seed=seed,
+                                                            max_workers=context.scene.greeble_batch_concurrency)
+                return self.finish_job(context, session, session.selection, result)
+            result = send_prompt_to_stable_diffusion(prompt, steps=steps, with_depth=with_depth,
+                                                         in_memory=context.scene.greeble_in_memory,
+                                                         seed=seed,
+                                                         geometry_depth=uses_geometry_depth(context.scene))
+            return self.finish_job(context, session, session.selection, result)
+
+    def create_job(self, context):
+        # Scene values are captured here, the worker thread must not read bpy
+        scene = context.scene
+        steps, seed = self.get_steps_and_seed(scene)
+        if scene.greeble_tiled:
+            return worker.GenerationJob(
+                "Tiled Greeble Texture",
+                send_tiles_to_stable_diffusion,
+                scene.greeble_generator_prompt,
+                steps=steps,
+                cfg_scale=scene.greeble_cfg_scale,
+                denoising_strength=scene.greeble_denoising_strength,
+                in_memory=scene.greeble_in_memory,
+                seed=seed,
+                max_workers=scene.greeble_batch_concurrency,
+            )
+        job = worker.GenerationJob(
+            "Refine Greeble Texture" if self.refine else "Greeble Texture",
+            send_prompt_to_stable_diffusion,
+            scene.greeble_generator_prompt,
+            steps=steps,
+            cfg_scale=scene.greeble_cfg_scale,
+            denoising_strength=scene.greeble_denoising_strength,
+            with_depth=scene.greeble_depth_source == 'TEXTURE',
+            in_memory=scene.greeble_in_memory,
+            seed=seed,
+            geometry_depth=uses_geometry_depth(scene),
+        )
+        # Atlas slots are only written once the texture is final
+        job.wants_preview = scene.greeble_live_preview and not scene.greeble_use_atlas
+        self._preview_image_name = None
+        self._preview_material_name = None
+        return job
+
+    def show_preview(self, context, preview):
+        # Write the intermediate image into the live preview image. The first
+        # one also puts that image on the faces the result is meant for, on
+        # a throwaway material; their own materials are left as they are.
+        image = bpy.data.images.get(self._preview_image_name or "")
+        if image is not None:
+            imagebuffers.pixels_to_image(preview.pixels, image.name, image)
+            return
 
-        # Store indices of initially selected faces
-        initially_selected_faces_indices = [f.index for f in bm.faces if f.select]
-
-        # Send the snapshot to Stable Diffusion
-        prompt = context.scene.greeble_generator_prompt
-        send_prompt_to_stable_diffusion(prompt, steps=10)
-
-        # Load the texture image
-        addon_dir = os.path.dirname(__file__)
-        image_path = os.path.join(addon_dir, "output.png")
-        image = bpy.data.images.load(image_path)
-
-        # Create a new material
-        mat = bpy.data.materials.new(name="GreebleTextureMaterial")
-        mat.use_nodes = True
-        bsdf = mat.node_tree.nodes["Principled BSDF"]
-        tex_image = mat.node_tree.nodes.new('ShaderNodeTexImage')
-        tex_image.image = image
-        mat.node_tree.links.new(bsdf.inputs['Base Color'], tex_image.outputs['Color'])
-
-        # Apply material to selected faces
-        self.apply_material_to_selected_faces(context, mat)
-
-        # Reactivate the original object and restore initial face selection
-        bpy.ops.object.mode_set(mode='EDIT')
-        bm = bmesh.from_edit_mesh(obj.data)  # Re-acquire BMesh data
-        bm.faces.ensure_lookup_table()  # Update the internal index table
-        for face in bm.faces:
-            face.select = False  # Deselect all faces first
-        for face_index in initially_selected_faces_indices:
-            bm.faces[face_index].select = True  # Reselect initially selected faces
-        bmesh.update_edit_mesh(obj.data)
+        obj = bpy.data.objects.get(self._obj_name)
+        if obj is None:
+            return
+        image = resources.mark_owned(imagebuffers.pixels_to_image(preview.pixels, "GreeblePreview"))
+        self._preview_image_name = image.name
+        with MeshEditSession(context, obj, f"{self.bl_label} (preview)") as session:
+            if len(self._face_mask) != len(session.mesh.polygons):
+                return
+            self._material_indices = meshdata.get_material_indices(session.mesh)
+            mat = resources.mark_owned(bpy.data.materials.new(name="GreeblePreview"))
+            mat.use_nodes = True
+            mat = resources.get_texture_material(image, mat)
+            self._preview_material_name = mat.name
+            session.assign_material(mat, self._face_mask)
+
+    def discard_preview(self, context):
+        # Put the faces still showing the preview back on the materials they
+        # had before it and remove the preview material and image, so a
+        # result is applied as if there never was a preview
+        mat = bpy.data.materials.get(self._preview_material_name or "")
+        image = bpy.data.images.get(self._preview_image_name or "")
+        self._preview_material_name = self._preview_image_name = None
+        obj = bpy.data.objects.get(self._obj_name)
+        if mat is not None and obj is not None:
+            with MeshEditSession(context, obj, f"{self.bl_label} (preview)") as session:
+                mesh = session.mesh
+                index = mesh.materials.find(mat.name)
+                if index >= 0 and len(self._material_indices) == len(mesh.polygons):
+                    showing = meshdata.get_material_indices(mesh) == index
+                    meshdata.set_material_index(mesh, showing, self._material_indices[showing])
+                    mesh.materials.pop(index=index)
+        # Whatever still uses them after an edit of the mesh keeps them
+        if mat is not None and mat.users == 0:
+            bpy.data.materials.remove(mat)
+        if image is not None and image.users == 0:
+            bpy.data.images.remove(image)
+        resources.invalidate_memory_report()
+
+    def finish_job(self, context, session, face_mask, result):
+        image_path, seed = result
+        if image_path is None:
+            self.report({'ERROR'}, "Snapshot image not found!")
+            return {'CANCELLED'}
 
-        bpy.ops.object.mode_set(mode=current_mode)
+        # Remember the seed so the texture can be refined later
+        if not context.scene.greeble_tiled:
+            context.scene.greeble_last_seed = seed
 
+        apply_texture(context.scene, session, face_mask, image_path)
         return {'FINISHED'}
 
-    @staticmethod
-    def apply_material_to_selected_faces(context, mat):
-        obj = context.active_object
-        if mat.name not in obj.data.materials:
-            obj.data.materials.append(mat)
 
-        # Ensure the object has UV mapping
-        if not obj.data.uv_layers:
-            obj.data.uv_layers.new()
+class GenerateGreebleVariationsOperator(BackgroundJobMixin, bpy.types.Operator):
+    bl_idname = "object.generate_greeble_variations"
+    bl_label = "Generate Variations"
+    bl_description = "Generate several candidate textures of the snapshot in one request, to pick from"
 
-        # Get the index of the material
-        mat_index = obj.data.materials.find(mat.name)
+    def execute(self, context):
+        # Blocking variant, used when the operator is called from a script
+        scene = context.scene
+        result = variations.generate(scene.greeble_generator_prompt, **self.get_settings(scene))
+        return self.finish_job(context, None, None, result)
+
+    def get_settings(self, scene):
+        # Candidates are usually picked from drafts, then refined
+        return {
+            "count": scene.greeble_variation_count,
+            "steps": scene.greeble_draft_steps if scene.greeble_draft else scene.greeble_steps,
+            "cfg_scale": scene.greeble_cfg_scale,
+            "denoising_strength": scene.greeble_denoising_strength,
+            "seed": scene.greeble_seed,
+            "in_memory": scene.greeble_in_memory,
+        }
+
+    def create_job(self, context):
+        scene = context.scene
+        return worker.GenerationJob("Greeble Variations", variations.generate,
+                                    scene.greeble_generator_prompt, **self.get_settings(scene))
+
+    def finish_job(self, context, session, face_mask, result):
+        if result is None:
+            self.report({'ERROR'}, "Snapshot image not found!")
+            return {'CANCELLED'}
+        variations.set_candidates(result)
+        self.report({'INFO'}, f"{len(result)} variations ready, pick one in the panel.")
+        return {'FINISHED'}
 
-        # Get selected faces
-        bpy.ops.object.mode_set(mode='EDIT')
-        bm = bmesh.from_edit_mesh(obj.data)
-        bm.faces.ensure_lookup_table()
-        selected_faces = [f for f in bm.faces if f.select]
 
-        # Assign the material to the selected faces
-        for face in selected_faces:
-            face.material_index = mat_index
+class ApplyGreebleVariationOperator(bpy.types.Operator):
+    bl_idname = "object.apply_greeble_variation"
+    bl_label = "Apply Greeble Variation"
+    bl_description = "Apply this candidate texture to the selected faces, without another request"
 
-        # Update the mesh and return to Object Mode
-        bmesh.update_edit_mesh(obj.data)
-        bpy.ops.object.mode_set(mode='OBJECT')
+    index: bpy.props.IntProperty(name="Index", default=0, min=0)
 
+    def execute(self, context):
+        if self.index >= len(variations.candidates):
+            self.report({'ERROR'}, "Variation not found, generate the variations again!")
+            return {'CANCELLED'}
+
+        obj = context.active_object
+        if obj is None or obj.type != 'MESH':
+            self.report({'ERROR'}, "No active mesh object!")
+            return {'CANCELLED'}
 
+        scene = context.scene
+        variation = variations.candidates[self.index]
+        # The candidate becomes the current texture, so depth maps, refining
+        # and saving work on it like on any other result
+        result = apihandler.store_stage_png("output", variation.texture.png, scene.greeble_in_memory)
+        scene.greeble_last_seed = variation.seed
 
-class ApplyDepthMapOperator(bpy.types.Operator):
+        with MeshEditSession(context, obj, self.bl_label) as session:
+            apply_texture(scene, session, session.selection, result)
+        return {'FINISHED'}
+
+
+
+class ApplyDepthMapOperator(BackgroundJobMixin, bpy.types.Operator):
     bl_idname = "object.apply_depth_map"
     bl_label = "Apply Depth Map"
 
     def execute(self, context):
-
+        # Blocking variant, used when the operator is called from a script
         obj = context.active_object
 
-        # Store current mode and switch to edit mode to access face data
-        current_mode = bpy.context.object.mode
-        bpy.ops.object.mode_set(mode='EDIT')
-        bm = bmesh.from_edit_mesh(obj.data)
-        bm.faces.ensure_lookup_table()
+        with MeshEditSession(context, obj, self.bl_label) as session:
+            # Send Output image to Stable Diffusion
+            depth_image_path = get_depth_map("", steps=10, source=context.scene.greeble_depth_source,
+                                             in_memory=context.scene.greeble_in_memory)
+            return self.finish_job(context, session, session.selection, depth_image_path)
 
-        # Store indices of initially selected faces
-        initially_selected_faces_indices = [f.index for f in bm.faces if f.select]
+    def create_job(self, context):
+        return worker.GenerationJob("Depth Map", get_depth_map, "", steps=10,
+                                    source=context.scene.greeble_depth_source,
+                                    in_memory=context.scene.greeble_in_memory)
 
-	# Send Output image to Stable Diffusion
-        get_depth_map("", steps=10)
+    def finish_job(self, context, session, face_mask, depth_image_path):
+        # Check if depth map exists
+        if depth_image_path is None or (isinstance(depth_image_path, str) and not os.path.exists(depth_image_path)):
+            self.report({'WARNING'}, "Depth map image not found. Skipping depth map application.")
+            return {'FINISHED'}
 
-        # Load the depth map image
-        addon_dir = os.path.dirname(__file__)
-        depth_image_path = os.path.join(addon_dir, "depth.png")
-        depth_image = bpy.data.images.load(depth_image_path)
+        # In normal map mode the depth is baked into a tangent-space normal map
+        scene = context.scene
+        mode = scene.greeble_depth_mode
+        pixels = imagebuffers.load_result_pixels(depth_image_path)
+        normal_pixels = None
+        if mode == 'NORMAL':
+            with profiling.stage("normal map"):
+                normal_pixels = normalmap.depth_to_normal(pixels, scene.greeble_depth_strength)
+
+        # Faces packed into the atlas get the depth in their atlas slot
+        if atlas.set_island_depth(session.mesh, face_mask, pixels, mode, normal_pixels,
+                                  scene.greeble_depth_strength):
+            atlas.flush()
+            return {'FINISHED'}
 
-        # Get the material
-        # mat = bpy.data.materials.get("GreebleTextureMaterial")
-        mat = self.get_selected_face_material(self, context)
+        # Get the material of the first face
+        mat = session.get_face_material(face_mask)
         if not mat:
             self.report({'ERROR'}, "Material not found!")
             return {'CANCELLED'}
 
-        # Add a displacement node and connect the depth map
-        self.apply_depth_map_to_material(mat, depth_image)
+        # Load the depth map image, either from disk or from the in-memory
+        # buffer. A depth image only this material uses is refreshed in place.
+        old_depth = resources.get_node_image(mat, resources.DEPTH_NODE)
+        if old_depth is not None and old_depth.users > 1:
+            old_depth = None
+        depth_image = resources.load_image(depth_image_path, "GreebleDepth", old_depth)
+        normal_image = None
+        if normal_pixels is not None:
+            normal_image = resources.image_from_pixels(normal_pixels, "GreebleNormal")
+
+        # Connect the depth map as displacement, normal map or bump
+        with profiling.stage("material"):
+            resources.set_depth_maps(mat, mode, depth_image, normal_image, scene.greeble_depth_strength)
+        return {'FINISHED'}
 
-        # Check if depth map exists
-        if not os.path.exists(depth_image_path):
-            self.report({'WARNING'}, "Depth map image not found. Skipping depth map application.")
-            return {'FINISHED'}
 
-        # Reactivate the original object and restore initial face selection
-        bpy.ops.object.mode_set(mode='EDIT')
-        bm = bmesh.from_edit_mesh(obj.data)  # Re-acquire BMesh data
-        bm.faces.ensure_lookup_table()  # Update the internal index table
-        for face in bm.faces:
-            face.select = False  # Deselect all faces first
-        for face_index in initially_selected_faces_indices:
-            bm.faces[face_index].select = True  # Reselect initially selected faces
-        bmesh.update_edit_mesh(obj.data)
+class BatchGreebleOperator(bpy.types.Operator):
+    bl_idname = "object.batch_greeble"
+    bl_label = "Batch Greeble Selection"
+    bl_description = "Greeble every connected island of the selected faces of all objects in Edit Mode"
 
-        bpy.ops.object.mode_set(mode=current_mode)
+    multi_view: bpy.props.BoolProperty(
+        name="Multi-View",
+        description="Split every island by face direction and greeble each direction from its own view",
+        default=False,
+        options={'SKIP_SAVE'}
+    )
 
-        return {'FINISHED'}
+    _timer = None
+    _queue = None
+
+    @classmethod
+    def poll(cls, context):
+        return context.mode == 'EDIT_MESH'
 
+    def invoke(self, context, event):
+        if worker.active_job is not None:
+            self.report({'WARNING'}, "A greeble generation is already running.")
+            return {'CANCELLED'}
+
+        # Split the selection of every object in Edit Mode into face islands,
+        # and in multi-view mode every island into groups of faces that face
+        # the same way
+        scene = context.scene
+        self._jobs = []
+        for obj in context.objects_in_mode_unique_data:
+            bm = bmesh.from_edit_mesh(obj.data)
+            bm.faces.ensure_lookup_table()
+            selected_faces = [f for f in bm.faces if f.select]
+            # Bounds and normals are read from the mesh data, flushed once
+            # per object
+            meshdata.sync_from_editmode(obj)
+            if self.multi_view:
+                normals, areas = self.get_world_normals(obj)
+            for island in get_face_islands(bm, selected_faces):
+                groups = [(island, None)]
+                if self.multi_view:
+                    groups = self.split_by_normal(normals, areas, island, scene.greeble_view_count)
+                for group, direction in groups:
+                    face_mask = np.zeros(len(obj.data.polygons), dtype=bool)
+                    face_mask[group] = True
+                    center, normal, size = meshdata.get_faces_bounds(obj.data, face_mask, obj.matrix_world)
+                    if direction is not None:
+                        normal = direction
+                    self._jobs.append(IslandJob(obj.name, group, center, normal, size))
+
+        if not self._jobs:
+            self.report({'ERROR'}, "No faces selected!")
+            return {'CANCELLED'}
+
+        # Snapshots need Object Mode, stay there until the batch is done
+        self._active_name = context.active_object.name
+        self._start_time = time.perf_counter()
+        profiling.begin_run(self.bl_label)
+        self.mesh_syncs = 0
+        set_mode(context.active_object, 'OBJECT', self)
+
+        generate = partial(
+            generate_pack,
+            prompt=scene.greeble_generator_prompt,
+            steps=scene.greeble_steps,
+            cfg_scale=scene.greeble_cfg_scale,
+            denoising_strength=scene.greeble_denoising_strength,
+            seed=scene.greeble_seed,
+        )
+        self._queue = BatchQueue(generate, max_workers=scene.greeble_batch_concurrency,
+                                 pack_size=scene.greeble_batch_pack_size)
+        worker.active_job = self._queue
+        self._to_snapshot = list(self._jobs)
+        self._applied = 0
+        self._failed = 0
+        self._use_atlas = scene.greeble_use_atlas
+        self._depth_mode = scene.greeble_depth_mode
+        self._depth_strength = scene.greeble_depth_strength
+
+        scene.greeble_job_running = True
+        scene.greeble_job_label = f"Batch of {len(self._jobs)} {'views' if self.multi_view else 'islands'}"
+        scene.greeble_job_progress = 0.0
+
+        wm = context.window_manager
+        self._timer = wm.event_timer_add(0.1, window=context.window)
+        wm.modal_handler_add(self)
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+        if event.type == 'ESC':
+            self._queue.cancel()
+
+        if self._queue.cancelled:
+            worker.interrupt_async()
+            self.finish(context)
+            self.report({'INFO'}, f"Batch cancelled, {self._applied} of {len(self._jobs)} islands greebled.")
+            return {'CANCELLED'}
+
+        if event.type != 'TIMER':
+            return {'PASS_THROUGH'}
+
+        # Render at most one snapshot per tick so the UI stays responsive,
+        # and only while the workers can take more
+        if self._to_snapshot and not self._queue.saturated:
+            job = self._to_snapshot.pop(0)
+            job.snapshot = self.snapshot_island(context, job)
+            self._queue.add(job)
+            if not self._to_snapshot:
+                self._queue.flush()
+
+        # Apply results as soon as their pack is done
+        for job in self._queue.pop_completed():
+            self.apply_island(job)
+
+        scene = context.scene
+        scene.greeble_job_progress = 100.0 * (self._applied + self._failed) / len(self._jobs)
+        tag_redraw_view3d(context)
+
+        if self._to_snapshot or self._queue.busy:
+            return {'PASS_THROUGH'}
+
+        self.finish(context)
+        if self._failed:
+            self.report({'WARNING'}, f"{self._failed} of {len(self._jobs)} islands failed.")
+        else:
+            self.report({'INFO'}, f"{self._applied} islands greebled.")
+        return {'FINISHED'}
 
     @staticmethod
-    def get_selected_face_material(self, context):
-        obj = context.active_object
-        bpy.ops.object.mode_set(mode='EDIT')
-        bm = bmesh.from_edit_mesh(obj.data)
-        bm.faces.ensure_lookup_table()
-        selected_faces = [f for f in bm.faces if f.select]
+    def get_world_normals(obj):
+        # World space face normals and face areas of obj's mesh data
+        matrix = np.array(obj.matrix_world, dtype=np.float64)
+        normals = meshdata.get_face_normals(obj.data) @ np.linalg.inv(matrix[:3, :3])
+        normals /= np.maximum(np.linalg.norm(normals, axis=1, keepdims=True), 1e-12)
+        return normals, meshdata.get_face_areas(obj.data)
 
-        if not selected_faces:
+    @staticmethod
+    def split_by_normal(normals, areas, island, max_views):
+        # (face indices, view direction) of every group of island faces that
+        # one view sees best, clustered on their normals weighted by area
+        island = np.asarray(island)
+        views = get_view_clusters(normals[island], max_views, areas[island])
+        return [(island[indices].tolist(), direction) for indices, direction in views]
+
+    def snapshot_island(self, context, job):
+        obj = bpy.data.objects[job.obj_name]
+        face_mask = np.zeros(len(obj.data.polygons), dtype=bool)
+        face_mask[job.face_indices] = True
+        png = capture.render_faces(obj, face_mask, job.center, job.normal, job.size,
+                                   engine=context.scene.greeble_capture_engine)
+        return encode_png(png)
+
+    def apply_island(self, job):
+        obj = bpy.data.objects.get(job.obj_name)
+        if job.error is not None or obj is None:
+            print(f"Greeble Generator: island of {job.obj_name} failed: {job.error}")
+            self._failed += 1
+            return
+        face_mask = np.zeros(len(obj.data.polygons), dtype=bool)
+        face_mask[job.face_indices] = True
+        self.project_view_uvs(obj, face_mask, job)
+        # The atlas images are written once, when the batch finishes; a full
+        # atlas leaves the island to a material of its own
+        if self._use_atlas and atlas.add_island(obj.data, face_mask, job.texture.pixels) is not None:
+            assign_material_to_faces(obj, atlas.get_atlas_material(), job.face_indices)
+            atlas.set_island_depth(obj.data, face_mask, job.depth.pixels, self._depth_mode,
+                                   self.get_normal_pixels(job), self._depth_strength)
+            obj.data.update()
+            self._applied += 1
+            return
+        image = resources.image_from_pixels(job.texture.pixels, "GreebleTexture")
+        depth_image = resources.image_from_pixels(job.depth.pixels, "GreebleDepth")
+        normal_pixels = self.get_normal_pixels(job)
+        normal_image = None
+        if normal_pixels is not None:
+            normal_image = resources.image_from_pixels(normal_pixels, "GreebleNormal")
+        mat = resources.get_texture_material(image)
+        resources.set_depth_maps(mat, self._depth_mode, depth_image, normal_image, self._depth_strength)
+        atlas.remove_island(obj.data, face_mask)
+        assign_material_to_faces(obj, mat, job.face_indices)
+        self._applied += 1
+
+    def project_view_uvs(self, obj, face_mask, job):
+        # In multi-view mode the texture of a view only fits its faces
+        # through UVs projected the way the snapshot was taken
+        if self.multi_view:
+            # Replaced UVs are no longer in any atlas slot
+            atlas.remove_island(obj.data, face_mask)
+            meshdata.project_uvs(obj.data, face_mask, job.center, job.normal, job.size, obj.matrix_world)
+            obj.data.update()
+
+    def get_normal_pixels(self, job):
+        if self._depth_mode != 'NORMAL':
             return None
+        with profiling.stage("normal map"):
+            return normalmap.depth_to_normal(job.depth.pixels, self._depth_strength)
+
+    def finish(self, context):
+        context.window_manager.event_timer_remove(self._timer)
+        self._timer = None
+        self._queue.shutdown()
+        if worker.active_job is self._queue:
+            worker.active_job = None
+        context.scene.greeble_job_running = False
+        atlas.flush()
+
+        # Back to Edit Mode on the object that was active
+        obj = bpy.data.objects.get(self._active_name)
+        if obj is not None:
+            context.view_layer.objects.active = obj
+            set_mode(obj, 'EDIT', self)
+        record_run(self.bl_label, self.mesh_syncs, time.perf_counter() - self._start_time)
+        profiling.end_run()
+        tag_redraw_view3d(context)
+
+
+class CancelGreebleJobOperator(bpy.types.Operator):
+    bl_idname = "object.cancel_greeble_job"
+    bl_label = "Cancel Greeble Generation"
+
+    @classmethod
+    def poll(cls, context):
+        return worker.active_job is not None
 
-        # Assuming the first selected face's material
-        face_mat_index = selected_faces[0].material_index
-        bpy.ops.object.mode_set(mode='OBJECT')
-        return obj.data.materials[face_mat_index] if face_mat_index < len(obj.data.materials) else None
+    def execute(self, context):
+        worker.active_job.cancel()
+        return {'FINISHED'}
 
 
-    @staticmethod
-    def apply_depth_map_to_material(mat, depth_image):
-        mat.use_nodes = True
-        displacement_node = mat.node_tree.nodes.new('ShaderNodeDisplacement')
-        tex_image_depth = mat.node_tree.nodes.new('ShaderNodeTexImage')
-        tex_image_depth.image = depth_image
+class ClearGenerationCacheOperator(bpy.types.Operator):
+    bl_idname = "object.clear_greeble_cache"
+    bl_label = "Clear Generation Cache"
+
+    def execute(self, context):
+        cache = get_cache()
+        if cache is not None:
+            cache.clear()
+        return {'FINISHED'}
+
+
+class ClearGreebleTraceOperator(bpy.types.Operator):
+    bl_idname = "object.clear_greeble_trace"
+    bl_label = "Clear Trace"
+    bl_description = "Drop the recorded trace events and start the trace file over"
+
+    def execute(self, context):
+        profiling.clear_trace()
+        profiling.write_trace()
+        return {'FINISHED'}
+
+
+class PurgeGreebleDataOperator(bpy.types.Operator):
+    bl_idname = "object.purge_greeble_data"
+    bl_label = "Purge Unused Greeble Data"
+    bl_description = "Remove greeble images and materials that are no longer used"
+
+    def execute(self, context):
+        before = resources.memory_report()["image_bytes"]
+        images, materials, reclaimed = resources.purge_orphans()
+        after = resources.memory_report()["image_bytes"]
+        self.report({'INFO'}, f"Removed {images} images and {materials} materials, "
+                              f"reclaimed {reclaimed / 2**20:.1f} MB "
+                              f"({before / 2**20:.1f} MB -> {after / 2**20:.1f} MB).")
+        return {'FINISHED'}
+
+
+class RefreshGreebleMemoryReportOperator(bpy.types.Operator):
+    bl_idname = "object.refresh_greeble_memory_report"
+    bl_label = "Refresh Memory Report"
+    bl_description = "Count the greeble images and materials again, e.g. after deleting objects"
+
+    def execute(self, context):
+        resources.invalidate_memory_report()
+        tag_redraw_view3d(context)
+        return {'FINISHED'}
+
+
+class AddGreebleEndpointOperator(bpy.types.Operator):
+    bl_idname = "object.add_greeble_endpoint"
+    bl_label = "Add Server"
+    bl_description = "Add a Stable Diffusion server to the endpoint pool"
 
-        # Connect the depth map to the Displacement input of the Material Output node
-        material_output = mat.node_tree.nodes.get('Material Output')
-        mat.node_tree.links.new(displacement_node.inputs['Height'], tex_image_depth.outputs['Color'])
-        mat.node_tree.links.new(material_output.inputs['Displacement'], displacement_node.outputs['Displacement'])
+    def execute(self, context):
+        prefs = get_preferences(context)
+        prefs.endpoints.add()
+        apply_client_settings(prefs)
+        return {'FINISHED'}
+
+
+class RemoveGreebleEndpointOperator(bpy.types.Operator):
+    bl_idname = "object.remove_greeble_endpoint"
+    bl_label = "Remove Server"
+    bl_description = "Remove the server from the endpoint pool"
+
+    index: bpy.props.IntProperty()
+
+    def execute(self, context):
+        prefs = get_preferences(context)
+        prefs.endpoints.remove(self.index)
+        apply_client_settings(prefs)
+        return {'FINISHED'}
+
+
+class InstallGreebleDependenciesOperator(bpy.types.Operator):
+    bl_idname = "object.install_greeble_dependencies"
+    bl_label = "Install Missing Packages"
+    bl_description = "Install the missing Python packages into Blender's Python with pip. Takes a while"
+
+    def execute(self, context):
+        packages = dependencies.missing_packages()
+        if not packages:
+            self.report({'INFO'}, "All packages are installed.")
+            return {'FINISHED'}
+        try:
+            dependencies.install(packages)
+        except (OSError, subprocess.CalledProcessError) as e:
+            output = getattr(e, "stderr", None) or str(e)
+            print(f"Greeble Generator: installing {', '.join(packages)} failed:\n{output}")
+            self.report({'ERROR'}, f"Installing {', '.join(packages)} failed, see the system console.")
+            return {'CANCELLED'}
+        self.report({'INFO'}, f"Installed {', '.join(packages)}.")
+        return {'FINISHED'}
 
 
 class ScaleUVOperator(bpy.types.Operator):
@@ -286,59 +877,99 @@ class ScaleUVOperator(bpy.types.Operator):
             self.report({'ERROR'}, "No active object with UV map found.")
             return
 
-        bm = bmesh.from_edit_mesh(obj.data)
-        uv_layer = bm.loops.layers.uv.active
-
-        for face in bm.faces:
-            if face.select:
-                for loop in face.loops:
-                    loop_uv = loop[uv_layer]
-                    # Scale around the center (0.5, 0.5)
-                    loop_uv.uv = ((loop_uv.uv - Vector((0.5, 0.5))) * scale_factor) + Vector((0.5, 0.5))
-
-        bmesh.update_edit_mesh(obj.data)
+        # UVs are written in Object Mode, all loops at once
+        with MeshEditSession(context, obj, self.bl_label) as session:
+            # Scale around the center (0.5, 0.5)
+            meshdata.transform_uvs(session.mesh, session.selection, scale=scale_factor, pivot=(0.5, 0.5))
 
 
 class SaveTexturesOperator(bpy.types.Operator):
     bl_idname = "object.save_textures_operator"
     bl_label = "Save Textures with Unique Names"
+    bl_description = "Save the texture and depth map next to the .blend file, named by their content"
+
+    _timer = None
+    _futures = None
+
+    def invoke(self, context, event):
+        # The files are encoded and written on the export pool; the material
+        # is pointed at them once all are written
+        self._futures = self.submit_exports(context)
+        if self._futures is None:
+            return {'CANCELLED'}
+        wm = context.window_manager
+        self._timer = wm.event_timer_add(0.1, window=context.window)
+        wm.modal_handler_add(self)
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+        if event.type != 'TIMER' or not all(future.done() for future in self._futures):
+            return {'PASS_THROUGH'}
+        context.window_manager.event_timer_remove(self._timer)
+        self._timer = None
+        return self.finish_exports(context, self._futures)
 
     def execute(self, context):
-        # Save the textures and get the new file paths
-        addon_dir = os.path.dirname(__file__)
-        image_path = os.path.join(addon_dir, "output.png")
-        depth_image_path = os.path.join(addon_dir, "depth.png")
-        new_output_path = self.save_texture_with_unique_name(image_path, "output")
-        new_depth_path = self.save_texture_with_unique_name(depth_image_path, "depth")
+        # Blocking variant, used when the operator is called from a script
+        futures = self.submit_exports(context)
+        if futures is None:
+            return {'CANCELLED'}
+        return self.finish_exports(context, futures)
+
+    def submit_exports(self, context):
+        scene = context.scene
+        if scene.greeble_in_memory:
+            image_path = imagebuffers.get_buffer("output")
+            depth_image_path = imagebuffers.get_buffer("depth")
+        else:
+            image_path = imagebuffers.get_work_path("output.png")
+            depth_image_path = imagebuffers.get_work_path("depth.png")
+            if not os.path.exists(image_path) or not os.path.exists(depth_image_path):
+                image_path = depth_image_path = None
+        if image_path is None or depth_image_path is None:
+            self.report({'ERROR'}, "Generate a texture and a depth map first!")
+            return None
+        # Only PNG is encoded without Pillow
+        if scene.greeble_color_format != 'PNG' and not dependencies.is_available("PIL"):
+            self.report({'ERROR'}, "WebP and JPEG export need Pillow. Install it from the add-on preferences "
+                                   "or save as PNG.")
+            return None
+
+        texture_dir = imagebuffers.get_texture_dir()
+        return [
+            export.submit(image_path, "output", texture_dir, scene.greeble_color_format,
+                          scene.greeble_export_quality),
+            export.submit(depth_image_path, "depth", texture_dir, scene.greeble_depth_format, depth=True),
+        ]
+
+    def finish_exports(self, context, futures):
+        try:
+            exported = dict(future.result() for future in futures)
+        except Exception as e:
+            self.report({'ERROR'}, f"Saving the textures failed: {e}")
+            return {'CANCELLED'}
 
         # Update the material with new image paths
-        self.update_material_image_paths(context, new_output_path, new_depth_path)
+        self.update_material_image_paths(context, exported)
 
         bpy.context.view_layer.update()
-
+        self.report({'INFO'}, f"Textures saved to {imagebuffers.get_texture_dir()}")
         return {'FINISHED'}
 
-    def save_texture_with_unique_name(self, filepath, base_name):
-        # Generate a unique timestamp
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-
-        # Create a new file name with the base name and timestamp
-        new_filename = f"{base_name}_{timestamp}.png"
-        new_filepath = os.path.join(addon_dir, new_filename)
-
-        # Save the file with the new name
-        bpy.data.images.load(filepath).save_render(new_filepath)
-
-        return new_filepath
-
-    def update_material_image_paths(self, context, new_output_path, new_depth_path):
-        # Update the material to use the new image paths
-        mat = bpy.data.materials.get("GreebleTextureMaterial")
-        if mat:
-            nodes = mat.node_tree.nodes
-            for node in nodes:
-                if node.type == 'TEX_IMAGE':
-                    if "output.png" in node.image.filepath:
-                        node.image.filepath = new_output_path
-                    elif "depth.png" in node.image.filepath:
-                        node.image.filepath = new_depth_path
+    def update_material_image_paths(self, context, exported):
+        # Point the images loaded from the exported results at their files.
+        # Images carry the content hash of the result they were loaded from,
+        # so every material showing one of them follows, whatever its name.
+        for image in resources.owned_images():
+            path = exported.get(image.get(resources.HASH_KEY))
+            if path is not None and bpy.path.abspath(image.filepath) != path:
+                self.set_image_filepath(image, path)
+
+    @staticmethod
+    def set_image_filepath(image, filepath):
+        # Images filled from memory become regular file images once saved
+        if image.source == 'GENERATED':
+            image.source = 'FILE'
+        image.filepath = filepath
+        if "greeble_pack_on_save" in image:
+            image["greeble_pack_on_save"] = False
@@ -0,0 +1,196 @@
+import bpy
+from .sdclient import configure_client, get_pool
+from .cache import configure_cache, get_cache
+from .profiling import configure_trace
+from .imagebuffers import get_work_path
+from . import dependencies
+
+
+def update_client_settings(self, context):
+    apply_client_settings(self)
+
+
+def apply_client_settings(prefs):
+    urls = [prefs.server_url] + [endpoint.url for endpoint in prefs.endpoints if endpoint.enabled]
+    configure_client(
+        urls=urls,
+        health_interval=prefs.health_interval,
+        timeout=prefs.timeout,
+        generation_timeout=prefs.generation_timeout,
+        retries=prefs.retries,
+        backoff=prefs.backoff,
+    )
+
+
+def update_cache_settings(self, context):
+    apply_cache_settings(self)
+
+
+def apply_cache_settings(prefs):
+    configure_cache(enabled=prefs.cache_enabled, max_bytes=prefs.cache_size_mb * 1024 * 1024)
+
+
+def update_trace_settings(self, context):
+    apply_trace_settings(self)
+
+
+def apply_trace_settings(prefs):
+    path = bpy.path.abspath(prefs.trace_path) if prefs.trace_path else get_work_path("greeble_trace.json")
+    configure_trace(prefs.trace_enabled, path)
+
+
+def get_preferences(context=None):
+    context = context or bpy.context
+    addon = context.preferences.addons.get(__package__)
+    return addon.preferences if addon else None
+
+
+class GreebleEndpoint(bpy.types.PropertyGroup):
+    # An additional server of the endpoint pool
+    url: bpy.props.StringProperty(
+        name="URL",
+        description="Address of another Stable Diffusion Web UI started with --api",
+        default="http://127.0.0.1:7861",
+        update=update_client_settings
+    )
+    enabled: bpy.props.BoolProperty(
+        name="Enabled",
+        description="Send generations to this server",
+        default=True,
+        update=update_client_settings
+    )
+
+
+class GreebleGeneratorPreferences(bpy.types.AddonPreferences):
+    bl_idname = __package__
+
+    server_url: bpy.props.StringProperty(
+        name="Server URL",
+        description="Address of the Stable Diffusion Web UI started with --api",
+        default="http://127.0.0.1:7860",
+        update=update_client_settings
+    )
+    timeout: bpy.props.FloatProperty(
+        name="Timeout",
+        description="Seconds to wait for quick requests such as options and progress",
+        default=10.0,
+        min=1.0,
+        max=120.0,
+        update=update_client_settings
+    )
+    generation_timeout: bpy.props.FloatProperty(
+        name="Generation Timeout",
+        description="Seconds to wait for an img2img request or a checkpoint switch",
+        default=600.0,
+        min=10.0,
+        max=3600.0,
+        update=update_client_settings
+    )
+    retries: bpy.props.IntProperty(
+        name="Retries",
+        description="How often a failed connection is retried",
+        default=3,
+        min=0,
+        max=10,
+        update=update_client_settings
+    )
+    backoff: bpy.props.FloatProperty(
+        name="Backoff",
+        description="Backoff factor in seconds between retries, doubled after each attempt",
+        default=0.5,
+        min=0.0,
+        max=10.0,
+        update=update_client_settings
+    )
+
+    endpoints: bpy.props.CollectionProperty(
+        type=GreebleEndpoint,
+        name="Additional Servers"
+    )
+    health_interval: bpy.props.FloatProperty(
+        name="Health Check Interval",
+        description="Seconds between two checks of the queue and health of every server",
+        default=10.0,
+        min=1.0,
+        max=600.0,
+        update=update_client_settings
+    )
+
+    cache_enabled: bpy.props.BoolProperty(
+        name="Cache Generations",
+        description="Reuse textures and depth maps generated from identical inputs with a fixed seed",
+        default=True,
+        update=update_cache_settings
+    )
+    cache_size_mb: bpy.props.IntProperty(
+        name="Cache Size (MB)",
+        description="Least recently used results are removed once the cache grows beyond this size",
+        default=512,
+        min=16,
+        max=65536,
+        update=update_cache_settings
+    )
+
+    trace_enabled: bpy.props.BoolProperty(
+        name="Record Trace",
+        description="Record the timings of every pipeline stage as Chrome trace-event JSON",
+        default=False,
+        update=update_trace_settings
+    )
+    trace_path: bpy.props.StringProperty(
+        name="Trace File",
+        description="Where the trace is written, chrome://tracing or ui.perfetto.dev open it. "
+                    "Defaults to greeble_trace.json in the temporary directory",
+        default="",
+        subtype='FILE_PATH',
+        update=update_trace_settings
+    )
+
+    def draw(self, context):
+        layout = self.layout
+        layout.prop(self, "server_url")
+
+        # Further servers; generations go to the least loaded live one
+        box = layout.box()
+        for index, endpoint in enumerate(self.endpoints):
+            row = box.row()
+            row.prop(endpoint, "enabled", text="")
+            row.prop(endpoint, "url", text="")
+            row.operator("object.remove_greeble_endpoint", text="", icon='X').index = index
+        row = box.row()
+        row.operator("object.add_greeble_endpoint", icon='ADD')
+        row.prop(self, "health_interval")
+        statuses = get_pool().status() if dependencies.is_available("requests") else []
+        for url, alive, load, checkpoint in statuses:
+            state = f"{load} queued" if alive else "unreachable"
+            box.label(text=f"{url}: {state}, {checkpoint or 'checkpoint unknown'}",
+                      icon='CHECKMARK' if alive else 'ERROR')
+
+        row = layout.row()
+        row.prop(self, "timeout")
+        row.prop(self, "generation_timeout")
+        row = layout.row()
+        row.prop(self, "retries")
+        row.prop(self, "backoff")
+        row = layout.row()
+        row.prop(self, "cache_enabled")
+        row.prop(self, "cache_size_mb")
+        row.operator("object.clear_greeble_cache")
+        cache = get_cache()
+        if cache is not None:
+            layout.label(text=f"{len(cache)} entries, {cache.total_bytes / (1024 * 1024):.1f} MB, "
+                              f"{cache.hits} hits, {cache.misses} misses this session")
+        row = layout.row()
+        row.prop(self, "trace_enabled")
+        row.prop(self, "trace_path", text="")
+        row.operator("object.clear_greeble_trace")
+
+        # Optional packages, installed only on request
+        box = layout.box()
+        for module, (package, purpose) in dependencies.PACKAGES.items():
+            installed = dependencies.is_available(module)
+            box.label(text=f"{package}: {'installed' if installed else 'missing'}, {purpose}",
+                      icon='CHECKMARK' if installed else 'ERROR')
+        row = box.row()
+        row.enabled = bool(dependencies.missing_packages())
+        row.operator("object.install_greeble_dependencies")
@@ -0,0 +1,131 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Lightweight timers for the hot paths of the pipeline.
+#
+#   with profiling.stage("render"):
+#       bpy.ops.render.render()
+#
+# Stages are summed per name into the run that is open while they happen,
+# from any thread. The last finished run is shown in the panel. With the
+# trace recorder enabled every stage also becomes a Chrome trace event, and
+# the whole session is written as trace-event JSON that chrome://tracing or
+# https://ui.perfetto.dev can open.
+
+_lock = threading.Lock()
+_current = None
+last_run = None
+
+_trace_enabled = False
+_trace_path = ""
+_trace_events = []
+_trace_origin = time.perf_counter()
+
+
+class Run:
+    # Summed stage timings of one operator run
+
+    def __init__(self, label):
+        self.label = label
+        self.start = time.perf_counter()
+        self.seconds = 0.0
+        self.stages = {}   # name -> [seconds, count]
+
+    def add(self, name, seconds):
+        entry = self.stages.setdefault(name, [0.0, 0])
+        entry[0] += seconds
+        entry[1] += 1
+
+    def breakdown(self):
+        # (name, seconds, count) of every stage, slowest first
+        return sorted(((name, seconds, count) for name, (seconds, count) in self.stages.items()),
+                      key=lambda item: -item[1])
+
+
+def begin_run(label):
+    # Open a run unless one is open already, in which case the stages go to
+    # that one. Returns whether a run was opened.
+    global _current
+    with _lock:
+        if _current is not None:
+            return False
+        _current = Run(label)
+        return True
+
+
+def end_run():
+    global _current, last_run
+    with _lock:
+        finished = _current
+        _current = None
+        if finished is None:
+            return None
+        finished.seconds = time.perf_counter() - finished.start
+        last_run = finished
+    _record_event(finished.label, "run", finished.start, finished.seconds)
+    if _trace_enabled:
+        write_trace()
+    return finished
+
+
+@contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_stage(name, start, time.perf_counter() - start)
+
+
+def add_stage(name, start, seconds):
+    with _lock:
+        if _current is not None:
+            _current.add(name, seconds)
+    _record_event(name, "stage", start, seconds)
+
+
+def _record_event(name, category, start, seconds):
+    # Complete ('X') event, runs are recorded once they end
+    if not _trace_enabled:
+        return
+    event = {
+        "name": name,
+        "cat": category,
+        "ph": "X",
+        "ts": (start - _trace_origin) * 1e6,
+        "dur": seconds * 1e6,
+        "pid": os.getpid(),
+        "tid": threading.get_ident(),
+    }
+    with _lock:
+        _trace_events.append(event)
+
+
+def configure_trace(enabled, path):
+    global _trace_enabled, _trace_path
+    if _trace_enabled and not enabled:
+        write_trace()
+    _trace_enabled = enabled
+    _trace_path = path
+
+
+def write_trace():
+    # Write all events of the session so far, replacing the previous file
+    if not _trace_path:
+        return
+    with _lock:
+        events = list(_trace_events)
+    trace = {"traceEvents": events, "displayTimeUnit": "ms"}
+    tmp_path = _trace_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as trace_file:
+        json.dump(trace, trace_file)
+    os.replace(tmp_path, _trace_path)
+
+
+def clear_trace():
+    # Drop the events recorded so far, the trace starts over
+    with _lock:
+        _trace_events.clear()
@@ -0,0 +1,176 @@
+import numpy as np
+
+# Snapshot background, roughly the grey of Blender's default world
+BACKGROUND = 0.05
+# Fragments (bounding box pixels of triangles) rasterised in one go
+FRAGMENT_CHUNK = 1 << 20
+
+
+def get_projection_basis(normal):
+    # Orthonormal (right, up, normal) basis of the plane perpendicular to normal
+    n = np.asarray(normal, dtype=np.float64)
+    n = n / (np.linalg.norm(n) or 1.0)
+    helper = np.array((0.0, 0.0, 1.0)) if abs(n[2]) < 0.9 else np.array((0.0, 1.0, 0.0))
+    right = np.cross(helper, n)
+    right /= np.linalg.norm(right)
+    up = np.cross(n, right)
+    return right, up, n
+
+
+def project_to_plane(coords, center, normal, size):
+    # Plane coordinates of coords in [0, 1] across a square of side size
+    # centered on center, plus the height of every point above the plane
+    right, up, n = get_projection_basis(normal)
+    offset = np.asarray(coords, dtype=np.float64) - np.asarray(center, dtype=np.float64)
+    u = offset @ right / size + 0.5
+    v = offset @ up / size + 0.5
+    height = offset @ n
+    return u, v, height
+
+
+def get_selected_triangles(mesh):
+    # Vertex coordinates, selected triangles and their face normals of a mesh
+    # in Object Mode, read with foreach_get
+    mesh.calc_loop_triangles()
+    coords = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+    mesh.vertices.foreach_get("co", coords)
+    tri_verts = np.empty(len(mesh.loop_triangles) * 3, dtype=np.int32)
+    mesh.loop_triangles.foreach_get("vertices", tri_verts)
+    tri_polys = np.empty(len(mesh.loop_triangles), dtype=np.int32)
+    mesh.loop_triangles.foreach_get("polygon_index", tri_polys)
+    selected = np.zeros(len(mesh.polygons), dtype=bool)
+    mesh.polygons.foreach_get("select", selected)
+    normals = np.empty(len(mesh.polygons) * 3, dtype=np.float32)
+    mesh.polygons.foreach_get("normal", normals)
+
+    tri_mask = selected[tri_polys]
+    triangles = tri_verts.reshape(-1, 3)[tri_mask]
+    tri_normals = normals.reshape(-1, 3)[tri_polys[tri_mask]]
+    return coords.reshape(-1, 3), triangles, tri_normals
+
+
+def rasterize(coords, triangles, tri_normals, center, normal, size, resolution=512, light=None):
+    # Orthographic z-buffered rasterisation of triangles seen along -normal.
+    # Returns, all top row first:
+    #   shaded  - (res, res, 4) uint8 RGBA, flat Lambert shading
+    #   depth   - (res, res) float32 height above the plane, -inf where empty
+    #   normals - (res, res, 3) float32 face normals in view space, 0 where empty
+    right, up, n = get_projection_basis(normal)
+    u, v, height = project_to_plane(coords, center, normal, size)
+    px = u * resolution - 0.5
+    py = (1.0 - v) * resolution - 0.5
+
+    depth = np.full((resolution, resolution), -np.inf, dtype=np.float32)
+    face_id = np.full((resolution, resolution), -1, dtype=np.int64)
+
+    tri_x = px[triangles]
+    tri_y = py[triangles]
+    tri_h = height[triangles]
+    x_min = np.clip(np.floor(tri_x.min(axis=1)).astype(np.int64), 0, resolution - 1)
+    x_max = np.clip(np.ceil(tri_x.max(axis=1)).astype(np.int64), 0, resolution - 1)
+    y_min = np.clip(np.floor(tri_y.min(axis=1)).astype(np.int64), 0, resolution - 1)
+    y_max = np.clip(np.ceil(tri_y.max(axis=1)).astype(np.int64), 0, resolution - 1)
+
+    # All triangles at once, in chunks of whole triangles to bound the
+    # memory. Barycentric weights are linear in the pixel position, so each
+    # triangle is reduced to w = a * x + b * y + c for its three weights and
+    # its height; on every row of its bounding box the weights give the span
+    # of pixels it covers, and only those become fragments.
+    x0, x1, x2 = tri_x.T
+    y0, y1, y2 = tri_y.T
+    area = (x1 - x0) * (y2 - y0) - (x2 - x0) * (y1 - y0)
+    valid = np.abs(area) >= 1e-12
+    area = np.where(valid, area, 1.0)
+    w0 = np.stack((y1 - y2, x2 - x1, x1 * y2 - x2 * y1)) / area
+    w1 = np.stack((y2 - y0, x0 - x2, x2 * y0 - x0 * y2)) / area
+    w2 = -w0 - w1
+    w2[2] += 1.0
+    h0, h1, h2 = tri_h.T
+    plane = w0 * h0 + w1 * h1 + w2 * h2
+
+    rows = np.where(valid, y_max - y_min + 1, 0)
+    boxes = rows * (x_max - x_min + 1)
+    ends = np.cumsum(boxes)
+    start = 0
+    while start < len(triangles):
+        stop = max(start + 1, int(np.searchsorted(ends, ends[start] - boxes[start] + FRAGMENT_CHUNK, 'right')))
+        chunk = np.arange(start, stop)
+        start = stop
+        chunk_rows = rows[chunk]
+        if not chunk_rows.sum():
+            continue
+        row_tri = np.repeat(chunk, chunk_rows)
+        row_y = y_min[row_tri] + np.arange(len(row_tri)) - np.repeat(np.cumsum(chunk_rows) - chunk_rows, chunk_rows)
+
+        # Span of every row where all three weights are positive, a pixel
+        # wider on both sides against rounding; the fragments are tested
+        # exactly below
+        low = x_min[row_tri].astype(np.float64)
+        high = x_max[row_tri].astype(np.float64)
+        for weight in (w0, w1, w2):
+            slope = weight[0][row_tri]
+            offset = weight[1][row_tri] * row_y + weight[2][row_tri]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                bound = -offset / slope
+            low = np.where(slope > 0, np.maximum(low, bound), low)
+            high = np.where(slope < 0, np.minimum(high, bound), high)
+            high = np.where((slope == 0) & (offset < 0), -np.inf, high)
+        low = np.maximum(np.floor(low) - 1, x_min[row_tri]).astype(np.int64)
+        high = np.minimum(np.ceil(high) + 1, x_max[row_tri])
+        counts = np.maximum(high - low + 1, 0).astype(np.int64)
+        if not counts.sum():
+            continue
+
+        row = np.repeat(np.arange(len(row_tri)), counts)
+        gx = low[row] + np.arange(len(row)) - np.repeat(np.cumsum(counts) - counts, counts)
+        gy = row_y[row]
+        tri = row_tri[row]
+
+        # Barycentric weights of the pixel centers
+        b0 = w0[0][tri] * gx + w0[1][tri] * gy + w0[2][tri]
+        b1 = w1[0][tri] * gx + w1[1][tri] * gy + w1[2][tri]
+        inside = (b0 >= 0) & (b1 >= 0) & (1.0 - b0 - b1 >= 0)
+        gx, gy, tri = gx[inside], gy[inside], tri[inside]
+        pixel = gy * resolution + gx
+        h = (plane[0][tri] * gx + plane[1][tri] * gy + plane[2][tri]).astype(depth.dtype)
+
+        # Nearest fragment of every pixel; of equal heights the first
+        # triangle wins, as when drawing them one after another
+        flat_depth = depth.ravel()
+        previous = flat_depth[pixel]
+        np.maximum.at(flat_depth, pixel, h)
+        won = (h == flat_depth[pixel]) & (h > previous)
+        first = np.full(resolution * resolution, len(triangles), dtype=np.int64)
+        np.minimum.at(first, pixel[won], tri[won])
+        updated = first < len(triangles)
+        face_id.ravel()[updated] = first[updated]
+
+    covered = face_id >= 0
+    tri_normals = np.asarray(tri_normals, dtype=np.float64)
+    view_normals = np.stack((tri_normals @ right, tri_normals @ up, tri_normals @ n), axis=1)
+    normals = np.zeros((resolution, resolution, 3), dtype=np.float32)
+    normals[covered] = view_normals[face_id[covered]]
+
+    # Light from the camera, tilted a little so flat panels are not uniform
+    if light is None:
+        light = np.array((0.3, 0.5, 1.0))
+    light = np.asarray(light, dtype=np.float64)
+    light = light / np.linalg.norm(light)
+    shade = np.full((resolution, resolution), BACKGROUND, dtype=np.float32)
+    shade[covered] = 0.2 + 0.8 * np.clip(normals[covered] @ light, 0.0, 1.0)
+
+    shaded = np.empty((resolution, resolution, 4), dtype=np.uint8)
+    shaded[..., :3] = (shade * 255.0 + 0.5).astype(np.uint8)[..., None]
+    shaded[..., 3] = 255
+    return shaded, depth, normals
+
+
+def depth_to_image(depth):
+    # Depth in the ControlNet convention, near is white and empty is black
+    covered = np.isfinite(depth)
+    image = np.zeros(depth.shape, dtype=np.uint8)
+    if covered.any():
+        low, high = depth[covered].min(), depth[covered].max()
+        scaled = (depth[covered] - low) / ((high - low) or 1.0)
+        image[covered] = (64 + 191 * scaled + 0.5).astype(np.uint8)
+    return image
@@ -0,0 +1,301 @@
+import hashlib
+import bpy
+import numpy as np
+from . import imagebuffers
+from . import meshdata
+from . import profiling
+
+# Images and materials created by the add-on carry OWNED_KEY, so they can be
+# reused, refreshed in place and purged without ever touching user data.
+# Images also carry the hash of their content, identical results share one
+# datablock instead of loading the same pixels again.
+OWNED_KEY = "greeble_owned"
+HASH_KEY = "greeble_hash"
+
+# Names of the nodes the add-on adds to its materials, used to find them again
+TEXTURE_NODE = "GreebleTexture"
+DEPTH_NODE = "GreebleDepthTexture"
+DISPLACEMENT_NODE = "GreebleDisplacement"
+NORMAL_NODE = "GreebleNormalTexture"
+NORMAL_MAP_NODE = "GreebleNormalMap"
+BUMP_NODE = "GreebleBump"
+
+# World space height of a white depth pixel in bump mode, at strength 1
+BUMP_DISTANCE = 0.05
+
+# Last memory_report(), drawn by the panel. Walking every image on each
+# redraw is too slow, it is recomputed after the add-on changed its data.
+_memory_report = None
+
+
+def mark_owned(id_data):
+    id_data[OWNED_KEY] = True
+    invalidate_memory_report()
+    return id_data
+
+
+def is_owned(id_data):
+    return bool(id_data.get(OWNED_KEY))
+
+
+def owned_images():
+    return [image for image in bpy.data.images if is_owned(image)]
+
+
+def owned_materials():
+    return [mat for mat in bpy.data.materials if is_owned(mat)]
+
+
+def result_hash(result):
+    # Content hash of a pipeline result, file path or ImageBuffer
+    if isinstance(result, imagebuffers.ImageBuffer):
+        return hashlib.sha256(result.png).hexdigest()
+    with open(result, "rb") as image_file:
+        return hashlib.sha256(image_file.read()).hexdigest()
+
+
+def find_image(digest):
+    for image in owned_images():
+        if image.get(HASH_KEY) == digest:
+            return image
+    return None
+
+
+def load_image(result, name, image=None):
+    # Blender image for a pipeline result. An owned image with the same
+    # content is reused as it is; otherwise image, when given, is refreshed in
+    # place and only without one a new datablock is created.
+    digest = result_hash(result)
+    existing = find_image(digest)
+    if existing is not None:
+        return existing
+
+    if image is not None and not is_owned(image):
+        image = None
+    if isinstance(result, imagebuffers.ImageBuffer):
+        if image is not None and image.source != 'GENERATED':
+            image = None
+        pixels = result.pixels
+        with profiling.stage("image load"):
+            image = imagebuffers.pixels_to_image(pixels, name, image)
+    elif image is not None and image.source == 'FILE' and not image.packed_file:
+        with profiling.stage("image load"):
+            image.filepath = result
+            image.reload()
+    else:
+        with profiling.stage("image load"):
+            image = bpy.data.images.load(result)
+    mark_owned(image)
+    image[HASH_KEY] = digest
+    return image
+
+
+def image_from_pixels(pixels, name):
+    # Owned image for float RGBA pixels, shared with any image of equal content
+    digest = hashlib.sha256(np.ascontiguousarray(pixels).tobytes()).hexdigest()
+    image = find_image(digest)
+    if image is None:
+        with profiling.stage("image load"):
+            image = mark_owned(imagebuffers.pixels_to_image(pixels, name))
+        image[HASH_KEY] = digest
+    return image
+
+
+def get_node_image(mat, node_name):
+    if mat is None or not mat.use_nodes:
+        return None
+    node = mat.node_tree.nodes.get(node_name)
+    return node.image if node is not None and node.type == 'TEX_IMAGE' else None
+
+
+def reusable_material(mesh, face_mask):
+    # Owned material of the faces in face_mask that no other faces or meshes
+    # use, so its images can be refreshed in place. None otherwise.
+    indices = meshdata.get_material_indices(mesh)
+    face_indices = np.unique(indices[face_mask])
+    if len(face_indices) != 1 or face_indices[0] >= len(mesh.materials):
+        return None
+    mat = mesh.materials[face_indices[0]]
+    if mat is None or not is_owned(mat) or mat.users > 1:
+        return None
+    if (indices[~np.asarray(face_mask, dtype=bool)] == face_indices[0]).any():
+        return None
+    return mat
+
+
+def get_texture_material(image, mat=None):
+    # Material showing image. mat, when given, gets its texture node pointed
+    # at image; otherwise an owned material already showing image is reused.
+    if mat is None:
+        for candidate in owned_materials():
+            if get_node_image(candidate, TEXTURE_NODE) == image:
+                return candidate
+        mat = mark_owned(bpy.data.materials.new(name="GreebleTextureMaterial"))
+        mat.use_nodes = True
+
+    nodes = mat.node_tree.nodes
+    tex_image = nodes.get(TEXTURE_NODE)
+    if tex_image is None:
+        tex_image = nodes.new('ShaderNodeTexImage')
+        tex_image.name = TEXTURE_NODE
+        mat.node_tree.links.new(nodes["Principled BSDF"].inputs['Base Color'], tex_image.outputs['Color'])
+    tex_image.image = image
+    return mat
+
+
+def get_named_node(mat, node_type, name):
+    # Node of mat added by the add-on, created on first use
+    node = mat.node_tree.nodes.get(name)
+    if node is None:
+        node = mat.node_tree.nodes.new(node_type)
+        node.name = name
+    return node
+
+
+def unlink_depth_outputs(mat):
+    # Disconnect the displacement, normal map and bump nodes of mat from the
+    # shader, so switching the depth mode leaves only one of them in use
+    links = mat.node_tree.links
+    for link in list(links):
+        if link.from_node.name in (DISPLACEMENT_NODE, NORMAL_MAP_NODE, BUMP_NODE):
+            links.remove(link)
+
+
+def set_depth_maps(mat, mode, depth_image, normal_image=None, strength=1.0):
+    # Connect a depth map to mat the way mode asks for:
+    #   DISPLACEMENT - true displacement through the Material Output
+    #   NORMAL       - normal_image, baked from the depth, as a normal map
+    #   BUMP         - the depth as a bump map, shading only
+    if mode == 'NORMAL' and normal_image is not None:
+        set_normal_image(mat, depth_image, normal_image)
+    elif mode == 'BUMP':
+        set_bump_image(mat, depth_image, strength)
+    else:
+        set_depth_image(mat, depth_image)
+
+
+def set_depth_image(mat, depth_image):
+    # Connect depth_image to the displacement of mat, reusing the nodes of an
+    # earlier depth map instead of adding new ones on every apply
+    mat.use_nodes = True
+    nodes = mat.node_tree.nodes
+    links = mat.node_tree.links
+    unlink_depth_outputs(mat)
+    displacement_node = get_named_node(mat, 'ShaderNodeDisplacement', DISPLACEMENT_NODE)
+    tex_image_depth = get_named_node(mat, 'ShaderNodeTexImage', DEPTH_NODE)
+    tex_image_depth.image = depth_image
+
+    # Connect the depth map to the Displacement input of the Material Output node
+    material_output = nodes.get('Material Output')
+    links.new(displacement_node.inputs['Height'], tex_image_depth.outputs['Color'])
+    links.new(material_output.inputs['Displacement'], displacement_node.outputs['Displacement'])
+
+
+def set_normal_image(mat, depth_image, normal_image):
+    # Shade mat with a tangent-space normal map baked from depth_image. The
+    # depth image stays in the material, unconnected, for saving.
+    mat.use_nodes = True
+    nodes = mat.node_tree.nodes
+    links = mat.node_tree.links
+    unlink_depth_outputs(mat)
+    get_named_node(mat, 'ShaderNodeTexImage', DEPTH_NODE).image = depth_image
+    # Normals are data, not colors
+    normal_image.colorspace_settings.name = 'Non-Color'
+    tex_image_normal = get_named_node(mat, 'ShaderNodeTexImage', NORMAL_NODE)
+    tex_image_normal.image = normal_image
+    normal_map = get_named_node(mat, 'ShaderNodeNormalMap', NORMAL_MAP_NODE)
+    normal_map.space = 'TANGENT'
+    links.new(normal_map.inputs['Color'], tex_image_normal.outputs['Color'])
+    links.new(nodes['Principled BSDF'].inputs['Normal'], normal_map.outputs['Normal'])
+
+
+def set_bump_image(mat, depth_image, strength=1.0):
+    # Shade mat with depth_image as a bump map, evaluated by the shader
+    mat.use_nodes = True
+    nodes = mat.node_tree.nodes
+    links = mat.node_tree.links
+    unlink_depth_outputs(mat)
+    tex_image_depth = get_named_node(mat, 'ShaderNodeTexImage', DEPTH_NODE)
+    tex_image_depth.image = depth_image
+    bump = get_named_node(mat, 'ShaderNodeBump', BUMP_NODE)
+    bump.inputs['Distance'].default_value = BUMP_DISTANCE * strength
+    links.new(bump.inputs['Height'], tex_image_depth.outputs['Color'])
+    links.new(nodes['Principled BSDF'].inputs['Normal'], bump.outputs['Normal'])
+
+
+def image_bytes(image):
+    # Approximate RAM held by an image: its pixel buffer plus a packed file
+    size = 0
+    if image.has_data:
+        width, height = image.size
+        size += width * height * image.channels * (4 if image.is_float else 1)
+    if image.packed_file:
+        size += image.packed_file.size
+    return size
+
+
+def remove_unused_slots():
+    # Drop owned materials from the material slots of meshes where no face
+    # uses them any more. Meshes in Edit Mode are skipped, their data is stale.
+    edited = {obj.data for obj in bpy.data.objects if obj.mode == 'EDIT'}
+    removed = 0
+    for mesh in bpy.data.meshes:
+        if mesh in edited or mesh.library is not None:
+            continue
+        used = np.unique(meshdata.get_material_indices(mesh))
+        # Highest index first, popping a slot shifts the indices above it
+        for index in reversed(range(len(mesh.materials))):
+            mat = mesh.materials[index]
+            if mat is not None and is_owned(mat) and index not in used:
+                mesh.materials.pop(index=index)
+                removed += 1
+    return removed
+
+
+def purge_orphans():
+    # Remove owned materials and images nobody uses. Returns the number of
+    # removed images and materials and the bytes reclaimed.
+    remove_unused_slots()
+    removed_materials = 0
+    for mat in owned_materials():
+        if mat.users == 0:
+            bpy.data.materials.remove(mat)
+            removed_materials += 1
+
+    removed_images = 0
+    reclaimed = 0
+    for image in owned_images():
+        if image.users == 0:
+            reclaimed += image_bytes(image)
+            bpy.data.images.remove(image)
+            removed_images += 1
+    invalidate_memory_report()
+    return removed_images, removed_materials, reclaimed
+
+
+def memory_report():
+    # Counts and approximate size of the owned datablocks, orphans included
+    images = owned_images()
+    materials = owned_materials()
+    orphan_images = [image for image in images if image.users == 0]
+    return {
+        "images": len(images),
+        "image_bytes": sum(image_bytes(image) for image in images),
+        "orphan_images": len(orphan_images),
+        "orphan_bytes": sum(image_bytes(image) for image in orphan_images),
+        "materials": len(materials),
+        "orphan_materials": sum(1 for mat in materials if mat.users == 0),
+    }
+
+
+def invalidate_memory_report():
+    global _memory_report
+    _memory_report = None
+
+
+def cached_memory_report():
+    # memory_report() as of the last change made by the add-on
+    global _memory_report
+    if _memory_report is None:
+        _memory_report = memory_report()
+    return _memory_report
@@ -0,0 +1,338 @@
+import threading
+import time
+from . import profiling
+
+# requests is imported by the first client, not when the add-on is enabled.
+# Nothing below catches its exceptions before a client exists.
+requests = None
+
+DEFAULT_URL = "http://127.0.0.1:7860"
+
+# Timeouts in seconds. Generation requests get a long timeout, everything
+# else is expected to answer quickly.
+DEFAULT_TIMEOUT = 10.0
+DEFAULT_GENERATION_TIMEOUT = 600.0
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+# Seconds between two health checks of the endpoints of a pool
+DEFAULT_HEALTH_INTERVAL = 10.0
+
+
+def import_requests():
+    global requests
+    if requests is None:
+        import requests as requests_module
+        requests = requests_module
+    return requests
+
+
+class SDClient:
+    # Keep-alive connection to one Stable Diffusion WebUI server.
+    #
+    # The checkpoint loaded on the server is cached, so /sdapi/v1/options is
+    # only written when the model actually has to change. The pool re-reads it
+    # with every health check, in case it was switched in the WebUI.
+    # The client never touches bpy and may be shared between threads.
+
+    def __init__(self, url=DEFAULT_URL, timeout=DEFAULT_TIMEOUT,
+                 generation_timeout=DEFAULT_GENERATION_TIMEOUT,
+                 retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.generation_timeout = generation_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.session = self._create_session()
+        self._checkpoint = None
+        self._options_lock = threading.Lock()
+
+    def _create_session(self):
+        # Connection errors are retried for every method. Read errors and
+        # 5xx answers are only retried for GET, re-posting an img2img request
+        # that may already be running would queue a second generation.
+        import_requests()
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        retry = Retry(
+            total=self.retries,
+            connect=self.retries,
+            read=self.retries,
+            status=self.retries,
+            backoff_factor=self.backoff,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset({'GET'}),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=4, pool_maxsize=8)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def close(self):
+        self.session.close()
+
+    def get(self, path, timeout=None, **kwargs):
+        response = self.session.get(f'{self.url}{path}', timeout=timeout or self.timeout, **kwargs)
+        response.raise_for_status()
+        return response.json()
+
+    def post(self, path, payload=None, timeout=None):
+        response = self.session.post(f'{self.url}{path}', json=payload, timeout=timeout or self.timeout)
+        response.raise_for_status()
+        return response.json() if response.content else None
+
+    def current_checkpoint(self, refresh=False):
+        if self._checkpoint is None or refresh:
+            self._checkpoint = self.get('/sdapi/v1/options').get('sd_model_checkpoint')
+        return self._checkpoint
+
+    def ensure_checkpoint(self, model_name):
+        # The server reports the checkpoint as "<name>.safetensors [hash]",
+        # a plain model name is considered loaded when it is a prefix of that
+        with self._options_lock:
+            current = self.current_checkpoint()
+            if current and current.startswith(model_name):
+                return False
+            # Only the changed key is posted, the server merges it into its options.
+            # Loading a checkpoint can take a while, use the generation timeout.
+            self.post('/sdapi/v1/options', {'sd_model_checkpoint': model_name},
+                      timeout=self.generation_timeout)
+            self._checkpoint = model_name
+            return True
+
+    def refresh_checkpoint(self):
+        # Re-read the checkpoint from the server. Skipped while ensure_checkpoint
+        # is loading one, the value it stores afterwards is the newer one.
+        if not self._options_lock.acquire(blocking=False):
+            return self._checkpoint
+        try:
+            return self.current_checkpoint(refresh=True)
+        finally:
+            self._options_lock.release()
+
+    @property
+    def cached_checkpoint(self):
+        # Checkpoint last seen on the server, None when not known yet
+        return self._checkpoint
+
+    def has_checkpoint(self, model_name):
+        # Whether model_name is known to be loaded, without asking the server
+        return bool(self._checkpoint and self._checkpoint.startswith(model_name))
+
+    def invalidate(self):
+        # Forget cached server state, e.g. after the model was changed in the WebUI
+        self._checkpoint = None
+
+    def img2img(self, payload):
+        try:
+            return self.post('/sdapi/v1/img2img', payload, timeout=self.generation_timeout)
+        except requests.RequestException:
+            self.invalidate()
+            raise
+
+    def detect(self, module, images, resolution=512):
+        # Run only a ControlNet preprocessor (annotator) on the images, no diffusion
+        payload = {
+            'controlnet_module': module,
+            'controlnet_input_images': images,
+            'controlnet_processor_res': resolution,
+        }
+        try:
+            return self.post('/controlnet/detect', payload, timeout=self.generation_timeout)
+        except requests.RequestException:
+            self.invalidate()
+            raise
+
+    def progress(self, skip_current_image=True):
+        params = {'skip_current_image': 'true' if skip_current_image else 'false'}
+        return self.get('/sdapi/v1/progress', params=params)
+
+    def interrupt(self):
+        self.post('/sdapi/v1/interrupt')
+
+
+class Endpoint:
+    # Health of one server of an EndpointPool, as seen by the last check
+    # and by the requests currently sent to it
+
+    def __init__(self, client):
+        self.client = client
+        self.alive = True
+        self.queue_depth = 0    # Jobs the server reports as running or queued
+        self.in_flight = 0      # Requests this process is waiting for
+        self.checked = 0.0
+        self.error = None
+
+    @property
+    def url(self):
+        return self.client.url
+
+    @property
+    def load(self):
+        return self.in_flight + self.queue_depth
+
+
+class EndpointPool:
+    # Routes requests over several Stable Diffusion WebUI servers.
+    #
+    #   r = pool.call(lambda client: client.img2img(payload), checkpoint=Model_name)
+    #
+    # Every request goes to the least loaded live endpoint, preferring those
+    # that already have the checkpoint loaded so no model switch is needed.
+    # When an endpoint cannot be reached it is marked dead and the request is
+    # sent to the next one. A daemon thread checks every endpoint with
+    # /sdapi/v1/progress each health_interval seconds to pick up queue depths
+    # and loaded checkpoints, and to bring recovered endpoints back. Never touches bpy.
+
+    def __init__(self, urls=(DEFAULT_URL,), health_interval=DEFAULT_HEALTH_INTERVAL, **client_settings):
+        urls = list(dict.fromkeys(url.rstrip('/') for url in urls if url)) or [DEFAULT_URL]
+        self.endpoints = [Endpoint(SDClient(url, **client_settings)) for url in urls]
+        self.health_interval = health_interval
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._health_thread = None
+        if health_interval > 0:
+            self._health_thread = threading.Thread(target=self._health_loop, daemon=True)
+            self._health_thread.start()
+
+    def close(self):
+        self._stop.set()
+        for endpoint in self.endpoints:
+            endpoint.client.close()
+
+    def check(self, endpoint):
+        # One health check: reachable, and how much work the server has
+        try:
+            r = endpoint.client.progress()
+            # The model may have been switched in the WebUI or the server
+            # restarted with another one since the last check
+            endpoint.client.refresh_checkpoint()
+        except requests.RequestException as e:
+            self._mark_dead(endpoint, e)
+            return False
+        state = r.get('state') or {}
+        busy = bool(state.get('job')) or float(r.get('progress') or 0.0) > 0.0
+        with self._lock:
+            endpoint.alive = True
+            endpoint.error = None
+            endpoint.queue_depth = max(int(state.get('job_count') or 0), int(busy))
+            endpoint.checked = time.monotonic()
+        return True
+
+    def check_all(self):
+        for endpoint in self.endpoints:
+            self.check(endpoint)
+
+    def _health_loop(self):
+        while not self._stop.is_set():
+            self.check_all()
+            self._stop.wait(self.health_interval)
+
+    def _mark_dead(self, endpoint, error):
+        with self._lock:
+            endpoint.alive = False
+            endpoint.error = error
+            endpoint.checked = time.monotonic()
+
+    def _candidates(self, checkpoint=None):
+        # Endpoints in the order they should be tried. Dead ones come last,
+        # they may have recovered since their last check.
+        def rank(endpoint):
+            has_model = checkpoint is None or endpoint.client.has_checkpoint(checkpoint)
+            return (not endpoint.alive, not has_model, endpoint.load)
+        with self._lock:
+            return sorted(self.endpoints, key=rank)
+
+    def call(self, request, checkpoint=None):
+        # Run request(client) on the best endpoint, loading checkpoint there
+        # first when given. Fails over to the next endpoint on connection
+        # errors only; a request that reached a server is never sent twice.
+        error = None
+        for endpoint in self._candidates(checkpoint):
+            with self._lock:
+                endpoint.in_flight += 1
+            try:
+                if checkpoint is not None:
+                    with profiling.stage("checkpoint switch"):
+                        endpoint.client.ensure_checkpoint(checkpoint)
+                with profiling.stage("http wait"):
+                    result = request(endpoint.client)
+            except requests.ConnectionError as e:
+                print(f"Greeble Generator: {endpoint.url} unreachable, trying the next server: {e}")
+                self._mark_dead(endpoint, e)
+                error = e
+                continue
+            finally:
+                with self._lock:
+                    endpoint.in_flight -= 1
+            with self._lock:
+                endpoint.alive = True
+            return result
+        raise error
+
+    def _busy_endpoints(self):
+        with self._lock:
+            return [endpoint for endpoint in self.endpoints if endpoint.in_flight]
+
+    def progress(self, skip_current_image=True):
+        # Progress of the server working on our requests, the least advanced
+        # one when several are
+        busy = self._busy_endpoints()
+        if not busy:
+            return self.call(lambda client: client.progress(skip_current_image))
+        results = []
+        for endpoint in busy:
+            try:
+                results.append(endpoint.client.progress(skip_current_image))
+            except requests.RequestException:
+                pass
+        if not results:
+            return {'progress': 0.0, 'eta_relative': 0.0}
+        return min(results, key=lambda r: float(r.get('progress') or 0.0))
+
+    def interrupt(self):
+        # Interrupt every server running one of our requests
+        for endpoint in self._busy_endpoints() or self.endpoints[:1]:
+            endpoint.client.interrupt()
+
+    def status(self):
+        # (url, alive, load, checkpoint) of every endpoint, for display
+        with self._lock:
+            return [(endpoint.url, endpoint.alive, endpoint.load, endpoint.client.cached_checkpoint)
+                    for endpoint in self.endpoints]
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_pool_settings = {}
+
+
+def configure_client(**settings):
+    # Replace the shared pool settings (urls, health_interval, timeout,
+    # generation_timeout, retries, backoff). The next get_pool() call creates
+    # a new pool.
+    global _pool
+    with _pool_lock:
+        _pool_settings.clear()
+        _pool_settings.update(settings)
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
+def close_client():
+    # Stop the health checks and close all connections, e.g. on unregister
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = EndpointPool(**_pool_settings)
+        return _pool
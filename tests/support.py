@@ -0,0 +1,35 @@
+# Imports modules of the add-on without running its __init__, which needs
+# Blender. Only modules that do not touch bpy at import time, apart from
+# handler decorators, can be tested this way.
+#
+#   python -m unittest discover -s tests      (from the add-on directory)
+#
+# Inside Blender the real bpy is used.
+import importlib
+import os
+import sys
+import types
+
+ADDON_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_DIR = os.path.join(ADDON_DIR, "benchmarks")
+PACKAGE = "greeble_generator_under_test"
+
+
+def load(name):
+    if PACKAGE not in sys.modules:
+        try:
+            import bpy  # noqa: F401
+        except ImportError:
+            bpy = types.ModuleType("bpy")
+            bpy.app = types.SimpleNamespace(handlers=types.SimpleNamespace(persistent=lambda func: func))
+            sys.modules["bpy"] = bpy
+        package = types.ModuleType(PACKAGE)
+        package.__path__ = [ADDON_DIR]
+        sys.modules[PACKAGE] = package
+    return importlib.import_module(f"{PACKAGE}.{name}")
+
+
+def load_mock_server():
+    if BENCH_DIR not in sys.path:
+        sys.path.insert(0, BENCH_DIR)
+    return importlib.import_module("mock_sdserver")
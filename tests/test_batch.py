@@ -0,0 +1,76 @@
+import unittest
+
+import numpy as np
+
+from support import load
+
+batch = load("batch")
+
+
+def spread(direction, count, angle, seed):
+    # count unit vectors within angle degrees of direction
+    rng = np.random.default_rng(seed)
+    direction = np.asarray(direction, dtype=np.float64)
+    jitter = rng.normal(size=(count, 3))
+    jitter -= np.outer(jitter @ direction, direction)
+    jitter /= np.linalg.norm(jitter, axis=1, keepdims=True)
+    tilt = np.radians(rng.uniform(0.0, angle, count))[:, None]
+    return np.cos(tilt) * direction + np.sin(tilt) * jitter
+
+
+class ClusterNormalsTest(unittest.TestCase):
+
+    def test_two_groups_are_separated(self):
+        normals = np.concatenate((spread((0, 0, 1), 30, 10, 0), spread((1, 0, 0), 20, 10, 1)))
+        centroids, labels = batch.cluster_normals(normals, 2)
+        self.assertEqual(len(set(labels[:30])), 1)
+        self.assertEqual(len(set(labels[30:])), 1)
+        self.assertNotEqual(labels[0], labels[30])
+        np.testing.assert_allclose(np.linalg.norm(centroids, axis=1), 1.0)
+        self.assertGreater(centroids[labels[0]] @ (0, 0, 1), 0.95)
+        self.assertGreater(centroids[labels[30]] @ (1, 0, 0), 0.95)
+
+    def test_result_is_deterministic(self):
+        normals = spread((0, 1, 0), 50, 80, 2)
+        first = batch.cluster_normals(normals, 3)
+        second = batch.cluster_normals(normals, 3)
+        np.testing.assert_array_equal(first[0], second[0])
+        np.testing.assert_array_equal(first[1], second[1])
+
+    def test_count_is_limited_to_the_normals(self):
+        centroids, labels = batch.cluster_normals(np.eye(3), 5)
+        self.assertEqual(len(centroids), 3)
+        self.assertEqual(sorted(labels), [0, 1, 2])
+
+    def test_single_cluster_follows_the_weights(self):
+        normals = np.array(((0.0, 0.0, 1.0), (1.0, 0.0, 0.0)))
+        centroids, _ = batch.cluster_normals(normals, 1, weights=(3.0, 1.0))
+        np.testing.assert_allclose(centroids[0], np.array((1.0, 0.0, 3.0)) / np.sqrt(10.0))
+
+    def test_opposite_normals_fall_back_to_the_first(self):
+        centroids, _ = batch.cluster_normals(np.array(((0.0, 0.0, 1.0), (0.0, 0.0, -1.0))), 1)
+        np.testing.assert_allclose(centroids[0], (0.0, 0.0, 1.0))
+
+
+class ViewClustersTest(unittest.TestCase):
+
+    def test_one_view_for_a_narrow_group(self):
+        views = batch.get_view_clusters(spread((0, 0, 1), 40, 20, 3), max_views=4)
+        self.assertEqual(len(views), 1)
+        self.assertEqual(len(views[0][0]), 40)
+
+    def test_as_many_views_as_needed(self):
+        normals = np.concatenate([spread(axis, 10, 5, seed) for seed, axis in enumerate(np.eye(3))])
+        views = batch.get_view_clusters(normals, max_views=6)
+        self.assertEqual(len(views), 3)
+        self.assertEqual(sorted(index for indices, _ in views for index in indices), list(range(30)))
+        for indices, direction in views:
+            self.assertTrue((normals[indices] @ direction >= np.cos(np.radians(batch.MAX_VIEW_ANGLE))).all())
+
+    def test_max_views_is_respected(self):
+        normals = np.concatenate([spread(axis, 10, 5, seed) for seed, axis in enumerate(np.eye(3))])
+        self.assertEqual(len(batch.get_view_clusters(normals, max_views=2)), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+import os
+import tempfile
+import unittest
+
+from support import load
+
+cache = load("cache")
+
+
+class MakeKeyTest(unittest.TestCase):
+
+    def test_parts_are_not_concatenated(self):
+        self.assertNotEqual(cache.make_key("ab", "c"), cache.make_key("a", "bc"))
+
+    def test_types_are_hashed_by_value(self):
+        self.assertEqual(cache.make_key("texture", b"png", 5, 7.5, {"b": 1, "a": 2}),
+                         cache.make_key("texture", b"png", 5, 7.5, {"a": 2, "b": 1}))
+        self.assertNotEqual(cache.make_key("texture", 5), cache.make_key("texture", 6))
+
+
+class GenerationCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def create(self, max_bytes=1000):
+        return cache.GenerationCache(self.directory.name, max_bytes)
+
+    def test_put_and_get(self):
+        generation_cache = self.create()
+        generation_cache.put("a", b"x" * 10)
+        self.assertEqual(generation_cache.get("a"), b"x" * 10)
+        self.assertIsNone(generation_cache.get("b"))
+        self.assertEqual((generation_cache.hits, generation_cache.misses), (1, 1))
+        self.assertEqual(generation_cache.total_bytes, 10)
+
+    def test_put_replaces_an_entry(self):
+        generation_cache = self.create()
+        generation_cache.put("a", b"x" * 10)
+        generation_cache.put("a", b"y" * 4)
+        self.assertEqual(generation_cache.get("a"), b"y" * 4)
+        self.assertEqual((len(generation_cache), generation_cache.total_bytes), (1, 4))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        generation_cache = self.create(max_bytes=30)
+        for key in "abc":
+            generation_cache.put(key, b"x" * 10)
+        generation_cache.get("a")
+        generation_cache.put("d", b"x" * 10)
+        self.assertIsNone(generation_cache.get("b"))
+        self.assertFalse(os.path.exists(os.path.join(self.directory.name, "b.png")))
+        for key in "acd":
+            self.assertIsNotNone(generation_cache.get(key))
+        self.assertEqual(generation_cache.total_bytes, 30)
+
+    def test_smaller_limit_evicts_at_once(self):
+        generation_cache = self.create()
+        for key in "abc":
+            generation_cache.put(key, b"x" * 10)
+        generation_cache.set_max_bytes(15)
+        self.assertEqual((len(generation_cache), generation_cache.total_bytes), (1, 10))
+        self.assertIsNotNone(generation_cache.get("c"))
+
+    def test_index_is_rebuilt_from_the_directory(self):
+        generation_cache = self.create()
+        for index, key in enumerate("abc"):
+            generation_cache.put(key, b"x" * 10)
+            # Modification times carry the LRU order, keep them apart
+            os.utime(os.path.join(self.directory.name, f"{key}.png"), (index, index))
+        reopened = self.create(max_bytes=20)
+        self.assertEqual(len(reopened), 2)
+        self.assertIsNone(reopened.get("a"))
+        self.assertEqual(reopened.get("c"), b"x" * 10)
+
+    def test_file_removed_behind_its_back_is_a_miss(self):
+        generation_cache = self.create()
+        generation_cache.put("a", b"x" * 10)
+        os.remove(os.path.join(self.directory.name, "a.png"))
+        self.assertIsNone(generation_cache.get("a"))
+        self.assertEqual((len(generation_cache), generation_cache.total_bytes, generation_cache.misses), (0, 0, 1))
+
+    def test_clear(self):
+        generation_cache = self.create()
+        generation_cache.put("a", b"x" * 10)
+        generation_cache.clear()
+        self.assertEqual((len(generation_cache), generation_cache.total_bytes), (0, 0))
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
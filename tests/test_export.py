@@ -0,0 +1,126 @@
+import os
+import struct
+import tempfile
+import unittest
+import zlib
+
+import numpy as np
+
+from support import load
+
+export = load("export")
+imagebuffers = load("imagebuffers")
+
+try:
+    import OpenEXR
+except ImportError:
+    OpenEXR = None
+
+
+def read_exr(data):
+    # Minimal reader for what encode_exr writes: the attributes and the
+    # single float channel, undoing the ZIP predictor of every block
+    if data[:4] != b"\x76\x2f\x31\x01":
+        raise ValueError("not an OpenEXR image")
+    position = 8
+    attributes = {}
+    while data[position] != 0:
+        name_end = data.index(b"\0", position)
+        type_end = data.index(b"\0", name_end + 1)
+        size, = struct.unpack_from("<i", data, type_end + 1)
+        value_start = type_end + 5
+        attributes[data[position:name_end].decode()] = data[value_start:value_start + size]
+        position = value_start + size
+    position += 1
+
+    x_min, y_min, x_max, y_max = struct.unpack("<iiii", attributes["dataWindow"])
+    width, height = x_max - x_min + 1, y_max - y_min + 1
+    blocks = (height + 15) // 16
+    offsets = struct.unpack_from(f"<{blocks}Q", data, position)
+    rows = []
+    for offset in offsets:
+        y, size = struct.unpack_from("<ii", data, offset)
+        block = data[offset + 8:offset + 8 + size]
+        raw_size = min(16, height - y) * width * 4
+        if size < raw_size:
+            predicted = np.frombuffer(zlib.decompress(block), dtype=np.uint8).astype(np.int64)
+            split = (np.cumsum(predicted[1:] - 128) + predicted[0]) & 0xff
+            split = np.concatenate((predicted[:1], split)).astype(np.uint8)
+            raw = np.empty(raw_size, dtype=np.uint8)
+            raw[0::2] = split[:(raw_size + 1) // 2]
+            raw[1::2] = split[(raw_size + 1) // 2:]
+            block = raw.tobytes()
+        rows.append(np.frombuffer(block, dtype="<f4").reshape(-1, width))
+    return attributes, np.concatenate(rows)
+
+
+class EncodeExrTest(unittest.TestCase):
+
+    def depth(self):
+        depth = np.random.default_rng(0).random((37, 21)).astype(np.float32)
+        # A flat region compresses, the noise is stored as it is
+        depth[:16] = 0.5
+        return depth
+
+    def test_round_trip(self):
+        depth = self.depth()
+        attributes, decoded = read_exr(export.encode_exr(depth))
+        self.assertEqual(attributes["compression"], b"\x03")
+        self.assertEqual(attributes["channels"][:2], b"Y\0")
+        np.testing.assert_array_equal(decoded, depth)
+
+    def test_single_row(self):
+        depth = np.linspace(0.0, 1.0, 8, dtype=np.float32)[None]
+        np.testing.assert_array_equal(read_exr(export.encode_exr(depth))[1], depth)
+
+    @unittest.skipIf(OpenEXR is None, "OpenEXR is not installed")
+    def test_readable_by_openexr(self):
+        depth = self.depth()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "depth.exr")
+            with open(path, "wb") as exr_file:
+                exr_file.write(export.encode_exr(depth))
+            with OpenEXR.File(path) as exr:
+                np.testing.assert_array_equal(exr.channels()["Y"].pixels, depth)
+
+
+class EncodeDepthTest(unittest.TestCase):
+
+    def pixels(self):
+        # Bottom row first, like bpy.types.Image.pixels
+        pixels = np.zeros((4, 6, 4), dtype=np.float32)
+        pixels[..., 0] = np.linspace(-0.5, 1.5, 24).reshape(4, 6)
+        return pixels
+
+    def test_png16_is_top_row_first_and_clipped(self):
+        pixels = self.pixels()
+        decoded = imagebuffers.decode_png_rgba(export.encode_depth(pixels, 'PNG16'))
+        np.testing.assert_allclose(decoded[..., 0], np.clip(pixels[::-1, :, 0], 0.0, 1.0), atol=1.0 / 65535.0)
+
+    def test_exr_keeps_the_float_values(self):
+        pixels = self.pixels()
+        _, decoded = read_exr(export.encode_depth(pixels, 'EXR'))
+        np.testing.assert_array_equal(decoded, np.clip(pixels[::-1, :, 0], 0.0, 1.0))
+
+
+class ExportResultTest(unittest.TestCase):
+
+    def test_file_is_named_by_content_and_written_once(self):
+        png = imagebuffers.encode_png(np.full((4, 4, 4), 128, dtype=np.uint8))
+        with tempfile.TemporaryDirectory() as directory:
+            source = os.path.join(directory, "output.png")
+            with open(source, "wb") as png_file:
+                png_file.write(png)
+            digest, path = export.export_result(source, "Greeble", directory, 'PNG')
+            self.assertTrue(os.path.basename(path).startswith("Greeble_"))
+            with open(path, "rb") as png_file:
+                self.assertEqual(png_file.read(), png)
+            modified = os.path.getmtime(path)
+            self.assertEqual(export.export_result(source, "Greeble", directory, 'PNG'), (digest, path))
+            self.assertEqual(os.path.getmtime(path), modified)
+            _, depth_path = export.export_result(source, "GreebleDepth", directory, 'EXR', depth=True)
+            self.assertTrue(depth_path.endswith(".exr"))
+
+
+if __name__ == "__main__":
+    unittest.main()
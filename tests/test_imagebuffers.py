@@ -0,0 +1,89 @@
+import io
+import unittest
+
+import numpy as np
+
+from support import load
+
+imagebuffers = load("imagebuffers")
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+def random_pixels(shape, dtype=np.uint8):
+    return np.random.default_rng(0).integers(0, np.iinfo(dtype).max + 1, shape, dtype=dtype)
+
+
+class PngCodecTest(unittest.TestCase):
+
+    def assert_round_trip(self, pixels):
+        decoded = imagebuffers.decode_png_rgba(imagebuffers.encode_png(pixels))
+        scale = float(np.iinfo(pixels.dtype).max)
+        values = pixels.reshape(pixels.shape[:2] + (-1,)).astype(np.float32) / scale
+        channels = values.shape[2]
+        expected = {
+            1: lambda: np.concatenate((values, values, values, np.ones_like(values)), axis=-1),
+            2: lambda: np.concatenate((values[..., :1],) * 3 + (values[..., 1:],), axis=-1),
+            3: lambda: np.concatenate((values, np.ones_like(values[..., :1])), axis=-1),
+            4: lambda: values,
+        }[channels]()
+        np.testing.assert_allclose(decoded, expected, atol=1e-6)
+
+    def test_round_trip_8_bit(self):
+        for shape in ((7, 5), (7, 5, 2), (7, 5, 3), (7, 5, 4)):
+            with self.subTest(shape=shape):
+                self.assert_round_trip(random_pixels(shape))
+
+    def test_round_trip_16_bit(self):
+        for shape in ((6, 9), (6, 9, 4)):
+            with self.subTest(shape=shape):
+                self.assert_round_trip(random_pixels(shape, np.uint16))
+
+    def test_decode_png_is_bottom_row_first(self):
+        pixels = random_pixels((4, 3, 4))
+        decoded = imagebuffers.decode_png(imagebuffers.encode_png(pixels))
+        np.testing.assert_allclose(decoded, pixels[::-1] / 255.0, atol=1e-6)
+
+    def test_not_a_png(self):
+        with self.assertRaises(ValueError):
+            imagebuffers.decode_png_rgba(b"GIF89a")
+
+    @unittest.skipIf(Image is None, "Pillow is not installed")
+    def test_decodes_filtered_rows(self):
+        # Pillow picks a filter per row, which exercises every predictor
+        gradient = np.add.outer(np.arange(40), np.arange(30)).astype(np.uint8) * 3
+        pixels = np.stack((gradient, random_pixels((40, 30)), gradient[::-1], np.full_like(gradient, 200)), axis=-1)
+        for mode, data in (('RGBA', pixels), ('RGB', pixels[..., :3]), ('L', pixels[..., 0])):
+            with self.subTest(mode=mode):
+                output = io.BytesIO()
+                Image.fromarray(data, mode).save(output, format='PNG', optimize=True)
+                decoded = imagebuffers.decode_png_rgba(output.getvalue())
+                expected = np.asarray(Image.open(io.BytesIO(output.getvalue())).convert('RGBA'))
+                np.testing.assert_allclose(decoded, expected / 255.0, atol=1e-6)
+
+    @unittest.skipIf(Image is None, "Pillow is not installed")
+    def test_decodes_palette_images(self):
+        image = Image.fromarray(random_pixels((8, 8, 3)) // 64 * 64, 'RGB').convert('P')
+        output = io.BytesIO()
+        image.save(output, format='PNG')
+        expected = np.asarray(image.convert('RGBA'))
+        np.testing.assert_allclose(imagebuffers.decode_png_rgba(output.getvalue()), expected / 255.0, atol=1e-6)
+
+
+class ResizeNearestTest(unittest.TestCase):
+
+    def test_same_size_is_returned_as_is(self):
+        pixels = random_pixels((4, 4, 4))
+        self.assertIs(imagebuffers.resize_nearest(pixels, 4), pixels)
+
+    def test_upscale_repeats_pixels(self):
+        pixels = np.arange(4).reshape(2, 2)
+        np.testing.assert_array_equal(imagebuffers.resize_nearest(pixels, 4),
+                                      np.repeat(np.repeat(pixels, 2, axis=0), 2, axis=1))
+
+
+if __name__ == "__main__":
+    unittest.main()
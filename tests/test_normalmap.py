@@ -0,0 +1,54 @@
+import unittest
+
+import numpy as np
+
+from support import load
+
+normalmap = load("normalmap")
+
+
+def depth_pixels(height):
+    pixels = np.ones(height.shape + (4,), dtype=np.float32)
+    pixels[..., :3] = height[..., None]
+    return pixels
+
+
+class DepthToNormalTest(unittest.TestCase):
+
+    def test_flat_depth_gives_a_flat_normal(self):
+        result = normalmap.depth_to_normal(depth_pixels(np.full((8, 8), 0.3, dtype=np.float32)))
+        self.assertEqual(result.shape, (8, 8, 4))
+        np.testing.assert_allclose(result, np.broadcast_to((0.5, 0.5, 1.0, 1.0), result.shape), atol=1e-6)
+
+    def test_normals_lean_away_from_higher_pixels(self):
+        ramp = np.linspace(0.0, 1.0, 16, dtype=np.float32)
+        along_u = normalmap.depth_to_normal(depth_pixels(np.tile(ramp, (16, 1))))
+        along_v = normalmap.depth_to_normal(depth_pixels(np.tile(ramp[:, None], (1, 16))))
+        # Rows go up along V, the OpenGL convention has +Y up
+        self.assertTrue((along_u[4:-4, 4:-4, 0] < 0.5).all())
+        np.testing.assert_allclose(along_u[..., 1], 0.5, atol=1e-6)
+        self.assertTrue((along_v[4:-4, 4:-4, 1] < 0.5).all())
+        np.testing.assert_allclose(along_v[..., 0], 0.5, atol=1e-6)
+
+    def test_normals_have_unit_length(self):
+        height = np.random.default_rng(0).random((12, 12)).astype(np.float32)
+        normals = normalmap.depth_to_normal(depth_pixels(height), strength=2.5)[..., :3] * 2.0 - 1.0
+        np.testing.assert_allclose(np.linalg.norm(normals, axis=-1), 1.0, atol=1e-5)
+
+    def test_strength_scales_the_slope(self):
+        height = np.tile(np.linspace(0.0, 0.1, 16, dtype=np.float32), (16, 1))
+        np.testing.assert_allclose(normalmap.depth_to_normal(depth_pixels(height), strength=0.0)[..., :3],
+                                   np.broadcast_to((0.5, 0.5, 1.0), (16, 16, 3)), atol=1e-6)
+        weak = normalmap.depth_to_normal(depth_pixels(height), strength=0.5)[8, 8, 0]
+        strong = normalmap.depth_to_normal(depth_pixels(height), strength=2.0)[8, 8, 0]
+        self.assertLess(strong, weak)
+
+    def test_sobel_of_a_linear_ramp(self):
+        height = np.add.outer(np.arange(6) * 2.0, np.arange(5) * 3.0)
+        dx, dy = normalmap.sobel(height)
+        np.testing.assert_allclose(dx[1:-1, 1:-1], 3.0)
+        np.testing.assert_allclose(dy[1:-1, 1:-1], 2.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,132 @@
+import unittest
+
+import numpy as np
+
+from support import load
+
+rasterizer = load("rasterizer")
+
+UP = (0.0, 0.0, 1.0)
+
+
+def quad(x0, y0, x1, y1, z):
+    coords = np.array(((x0, y0, z), (x1, y0, z), (x1, y1, z), (x0, y1, z)))
+    return coords, np.array(((0, 1, 2), (0, 2, 3))), np.tile(UP, (2, 1))
+
+
+def merge(*meshes):
+    coords, triangles, normals = [], [], []
+    offset = 0
+    for mesh_coords, mesh_triangles, mesh_normals in meshes:
+        coords.append(mesh_coords)
+        triangles.append(mesh_triangles + offset)
+        normals.append(mesh_normals)
+        offset += len(mesh_coords)
+    return np.concatenate(coords), np.concatenate(triangles), np.concatenate(normals)
+
+
+def reference_depth(coords, triangles, center, normal, size, resolution):
+    # One triangle after another, one pixel after another: the nearest
+    # fragment wins, of equal heights the first triangle drawn
+    u, v, height = rasterizer.project_to_plane(coords, center, normal, size)
+    px = u * resolution - 0.5
+    py = (1.0 - v) * resolution - 0.5
+    depth = np.full((resolution, resolution), -np.inf)
+    face_id = np.full((resolution, resolution), -1)
+    gy, gx = np.mgrid[0:resolution, 0:resolution]
+    for index, (a, b, c) in enumerate(triangles):
+        area = (px[b] - px[a]) * (py[c] - py[a]) - (px[c] - px[a]) * (py[b] - py[a])
+        if abs(area) < 1e-12:
+            continue
+        w0 = ((px[b] - gx) * (py[c] - gy) - (px[c] - gx) * (py[b] - gy)) / area
+        w1 = ((px[c] - gx) * (py[a] - gy) - (px[a] - gx) * (py[c] - gy)) / area
+        w2 = 1.0 - w0 - w1
+        h = w0 * height[a] + w1 * height[b] + w2 * height[c]
+        nearer = (w0 >= 0) & (w1 >= 0) & (w2 >= 0) & (h > depth)
+        depth[nearer] = h[nearer]
+        face_id[nearer] = index
+    return depth, face_id
+
+
+class RasterizeTest(unittest.TestCase):
+
+    def test_quad_covers_its_pixels(self):
+        coords, triangles, normals = quad(-0.5, -0.5, 0.5, 0.5, 0.25)
+        shaded, depth, view_normals = rasterizer.rasterize(coords, triangles, normals, (0, 0, 0), UP, 2.0,
+                                                           resolution=16)
+        covered = np.isfinite(depth)
+        self.assertTrue(covered[4:12, 4:12].all())
+        self.assertEqual(covered.sum(), 64)
+        np.testing.assert_allclose(depth[covered], 0.25, atol=1e-6)
+        np.testing.assert_allclose(view_normals[covered], np.broadcast_to(UP, (64, 3)), atol=1e-6)
+        self.assertTrue((view_normals[~covered] == 0.0).all())
+        self.assertTrue((shaded[..., 3] == 255).all())
+        self.assertTrue((shaded[~covered][:, 0] == int(rasterizer.BACKGROUND * 255.0 + 0.5)).all())
+        self.assertTrue((shaded[covered][:, 0] > shaded[~covered][:, 0].max()).all())
+
+    def test_image_is_top_row_first(self):
+        # A quad in the upper half of the view (+Y is up) lands in the first rows
+        coords, triangles, normals = quad(-1.0, 0.0, 1.0, 1.0, 0.0)
+        _, depth, _ = rasterizer.rasterize(coords, triangles, normals, (0, 0, 0), UP, 2.0, resolution=8)
+        self.assertTrue(np.isfinite(depth[:4]).all())
+        self.assertFalse(np.isfinite(depth[4:]).any())
+
+    def test_nearest_surface_wins(self):
+        coords, triangles, normals = merge(quad(-1.0, -1.0, 1.0, 1.0, 0.0), quad(-0.5, -0.5, 0.5, 0.5, 0.5),
+                                           quad(-1.0, -1.0, 0.0, 0.0, -0.5))
+        _, depth, _ = rasterizer.rasterize(coords, triangles, normals, (0, 0, 0), UP, 2.0, resolution=16)
+        np.testing.assert_allclose(depth[4:12, 4:12], 0.5)
+        np.testing.assert_allclose(depth[12:, :4], 0.0)
+
+    def test_matches_drawing_one_triangle_after_another(self):
+        rng = np.random.default_rng(0)
+        coords = rng.uniform(-1.2, 1.2, (60, 3))
+        triangles = rng.integers(0, len(coords), (40, 3))
+        normals = np.tile(UP, (40, 1))
+        center, normal, size, resolution = (0.1, -0.1, 0.0), (0.2, 0.1, 1.0), 2.0, 48
+        _, depth, _ = rasterizer.rasterize(coords, triangles, normals, center, normal, size, resolution=resolution)
+        expected, _ = reference_depth(coords, triangles, center, normal, size, resolution)
+        covered = np.isfinite(expected)
+        self.assertTrue(covered.any())
+        # Pixel centers exactly on an edge may go either way
+        agree = np.isfinite(depth) == covered
+        self.assertGreater(agree.mean(), 0.995)
+        both = agree & covered
+        np.testing.assert_allclose(depth[both], expected[both], atol=1e-4)
+
+    def test_chunks_give_the_same_result(self):
+        rng = np.random.default_rng(1)
+        coords = rng.uniform(-1.0, 1.0, (90, 3))
+        triangles = rng.integers(0, len(coords), (60, 3))
+        normals = rng.normal(size=(60, 3))
+        normals /= np.linalg.norm(normals, axis=1, keepdims=True)
+        whole = rasterizer.rasterize(coords, triangles, normals, (0, 0, 0), UP, 2.0, resolution=64)
+        chunk = rasterizer.FRAGMENT_CHUNK
+        rasterizer.FRAGMENT_CHUNK = 100
+        try:
+            chunked = rasterizer.rasterize(coords, triangles, normals, (0, 0, 0), UP, 2.0, resolution=64)
+        finally:
+            rasterizer.FRAGMENT_CHUNK = chunk
+        for first, second in zip(whole, chunked):
+            np.testing.assert_array_equal(first, second)
+
+    def test_degenerate_triangles_are_skipped(self):
+        coords = np.array(((0.0, 0.0, 0.0), (0.5, 0.5, 0.0), (1.0, 1.0, 0.0)))
+        _, depth, _ = rasterizer.rasterize(coords, np.array(((0, 1, 2),)), np.array((UP,)), (0, 0, 0), UP, 2.0,
+                                           resolution=16)
+        self.assertFalse(np.isfinite(depth).any())
+
+
+class DepthToImageTest(unittest.TestCase):
+
+    def test_near_is_white_and_empty_is_black(self):
+        depth = np.array(((-np.inf, 0.0), (0.5, 1.0)), dtype=np.float32)
+        np.testing.assert_array_equal(rasterizer.depth_to_image(depth), ((0, 64), (160, 255)))
+
+    def test_empty_depth(self):
+        depth = np.full((2, 2), -np.inf, dtype=np.float32)
+        self.assertFalse(rasterizer.depth_to_image(depth).any())
+
+
+if __name__ == "__main__":
+    unittest.main()
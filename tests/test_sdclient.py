@@ -0,0 +1,113 @@
+import contextlib
+import io
+import threading
+import time
+import unittest
+
+from support import load, load_mock_server
+
+sdclient = load("sdclient")
+mock_sdserver = load_mock_server()
+
+IMG2IMG = "/sdapi/v1/img2img"
+
+
+def url_of(server):
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def stop(server):
+    server.shutdown()
+    server.server_close()
+
+
+class EndpointPoolTest(unittest.TestCase):
+    # Two mock servers behind one pool. Health checks only run when a test
+    # calls check_all, and failed connections are not retried.
+
+    def setUp(self):
+        self.servers = [mock_sdserver.start_server(step_latency=0.01) for _ in range(2)]
+        self.pool = sdclient.EndpointPool([url_of(server) for server in self.servers], health_interval=0,
+                                          retries=0, backoff=0.0)
+
+    def tearDown(self):
+        self.pool.close()
+        for server in self.servers:
+            if server.socket.fileno() != -1:
+                stop(server)
+
+    def generate(self, steps=1, checkpoint=None):
+        payload = {"prompt": "panel", "init_images": [], "steps": steps}
+        return self.pool.call(lambda client: client.img2img(payload), checkpoint=checkpoint)
+
+    def start_long_job(self, steps=300):
+        # Runs on the first endpoint, the pool has no other load yet
+        thread = threading.Thread(target=self.generate, kwargs={"steps": steps})
+        thread.start()
+        deadline = time.monotonic() + 5.0
+        while not self.servers[0].state.step and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(self.servers[0].state.step, "the long job did not start")
+        return thread
+
+    def requests_of(self, server, path):
+        return server.state.requests.get(path, 0)
+
+    def test_least_loaded_endpoint_gets_the_request(self):
+        thread = self.start_long_job()
+        self.generate()
+        self.assertEqual(self.requests_of(self.servers[1], IMG2IMG), 1)
+        self.pool.interrupt()
+        thread.join()
+        self.assertEqual(self.requests_of(self.servers[0], IMG2IMG), 1)
+
+    def test_endpoint_with_the_checkpoint_is_preferred(self):
+        self.servers[0].state.checkpoint = "other-model.safetensors [0000000000]"
+        self.pool.check_all()
+        self.generate(checkpoint=mock_sdserver.DEFAULT_CHECKPOINT.split(".")[0])
+        self.assertEqual(self.requests_of(self.servers[0], IMG2IMG), 0)
+        self.assertEqual(self.requests_of(self.servers[1], IMG2IMG), 1)
+        # No model switch was needed anywhere
+        self.assertTrue(self.servers[0].state.checkpoint.startswith("other-model"))
+
+    def test_checkpoint_switched_in_the_webui_is_picked_up(self):
+        client = self.pool.endpoints[0].client
+        self.assertEqual(client.current_checkpoint(), mock_sdserver.DEFAULT_CHECKPOINT)
+        self.servers[0].state.checkpoint = "other-model.safetensors [0000000000]"
+        self.pool.check_all()
+        self.assertFalse(client.has_checkpoint(mock_sdserver.DEFAULT_CHECKPOINT))
+
+    def test_failover_after_a_server_stops(self):
+        stop(self.servers[0])
+        # The failover is reported on stdout
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertIsNotNone(self.generate())
+        self.assertEqual(self.requests_of(self.servers[1], IMG2IMG), 1)
+        statuses = self.pool.status()
+        self.assertFalse(statuses[0][1])
+        self.assertTrue(statuses[1][1])
+
+    def test_all_servers_down_raises(self):
+        for server in self.servers:
+            stop(server)
+        with self.assertRaises(sdclient.requests.ConnectionError), contextlib.redirect_stdout(io.StringIO()):
+            self.generate()
+
+    def test_progress_and_interrupt_go_to_the_busy_endpoint(self):
+        thread = self.start_long_job()
+        progress = self.pool.progress()
+        self.assertGreater(progress["progress"], 0.0)
+        self.assertEqual(progress["state"]["job"], "img2img")
+
+        started = time.monotonic()
+        self.pool.interrupt()
+        thread.join(5.0)
+        self.assertFalse(thread.is_alive())
+        # 300 steps of 10 ms would take 3 s
+        self.assertLess(time.monotonic() - started, 2.0)
+        self.assertEqual(self.requests_of(self.servers[0], "/sdapi/v1/interrupt"), 1)
+        self.assertEqual(self.requests_of(self.servers[1], "/sdapi/v1/interrupt"), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
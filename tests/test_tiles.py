@@ -0,0 +1,66 @@
+import unittest
+
+import numpy as np
+
+from support import load
+
+tiles = load("tiles")
+
+
+class TileLayoutTest(unittest.TestCase):
+
+    def test_resolution_round_trip(self):
+        for tiles_per_side in range(1, 5):
+            resolution = tiles.get_resolution(tiles_per_side)
+            self.assertEqual(tiles.get_tiles_from_resolution(resolution), tiles_per_side)
+
+    def test_tiles_cover_the_image(self):
+        for tiles_per_side in range(1, 4):
+            origins = tiles.get_tile_origins(tiles_per_side)
+            self.assertEqual(len(origins), tiles_per_side ** 2)
+            last = max(y for y, _ in origins) + tiles.TILE_SIZE
+            self.assertEqual(last, tiles.get_resolution(tiles_per_side))
+
+    def test_feather_weights_sum_to_one_over_overlaps(self):
+        first = tiles.feather_ramp(0, 2)
+        second = tiles.feather_ramp(1, 2)
+        overlap = first[tiles.TILE_STRIDE:] + second[:tiles.TILE_OVERLAP]
+        np.testing.assert_allclose(overlap, 1.0, atol=1e-6)
+
+
+class SplitBlendTest(unittest.TestCase):
+
+    def image(self, tiles_per_side):
+        resolution = tiles.get_resolution(tiles_per_side)
+        return np.random.default_rng(tiles_per_side).random((resolution, resolution, 4), dtype=np.float32)
+
+    def test_split_then_blend_is_lossless(self):
+        for tiles_per_side in range(1, 4):
+            with self.subTest(tiles_per_side=tiles_per_side):
+                pixels = self.image(tiles_per_side)
+                blended = tiles.blend_tiles(tiles.split_tiles(pixels, tiles_per_side), tiles_per_side)
+                np.testing.assert_allclose(blended, pixels, atol=1e-5)
+
+    def test_smaller_tiles_are_resized(self):
+        pixels = np.full((tiles.get_resolution(2),) * 2 + (4,), 0.25, dtype=np.float32)
+        small = [tile[::2, ::2] for tile in tiles.split_tiles(pixels, 2)]
+        np.testing.assert_allclose(tiles.blend_tiles(small, 2), 0.25, atol=1e-6)
+
+    def test_match_levels_evens_out_per_tile_normalisation(self):
+        pixels = self.image(2)
+        pixels[..., 3] = 1.0
+        split = tiles.split_tiles(pixels, 2)
+        # Every tile after the first normalised on its own
+        levels = [(1.0, 0.0), (0.5, 0.2), (2.0, -0.3), (0.8, 0.1)]
+        shifted = []
+        for tile, (scale, offset) in zip(split, levels):
+            tile = tile.copy()
+            tile[..., :3] = tile[..., :3] * scale + offset
+            shifted.append(tile)
+        blended = tiles.blend_tiles(shifted, 2, match_levels=True)
+        np.testing.assert_allclose(blended, pixels, atol=1e-4)
+        self.assertGreater(np.abs(tiles.blend_tiles(shifted, 2) - pixels).max(), 0.1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+import math
+import numpy as np
+from .imagebuffers import resize_nearest
+
+# Large selections are captured at a higher resolution and generated as a
+# grid of overlapping TILE_SIZE tiles. Neighbouring tiles share TILE_OVERLAP
+# pixels, which are feathered when the results are put back together.
+TILE_SIZE = 512
+TILE_OVERLAP = 64
+TILE_STRIDE = TILE_SIZE - TILE_OVERLAP
+
+
+def get_tiles_per_side(area, tile_world_size, max_tiles=4):
+    # Tiles per side for faces of the given world space area, so each tile
+    # covers roughly tile_world_size x tile_world_size
+    if tile_world_size <= 0:
+        return 1
+    return int(min(max(math.ceil(math.sqrt(area) / tile_world_size), 1), max_tiles))
+
+
+def get_resolution(tiles_per_side):
+    # Snapshot resolution that splits into exactly tiles_per_side tiles
+    return tiles_per_side * TILE_STRIDE + TILE_OVERLAP
+
+
+def get_tiles_from_resolution(resolution):
+    return max(1, (resolution - TILE_OVERLAP) // TILE_STRIDE)
+
+
+def get_tile_origins(tiles_per_side):
+    # (y, x) pixel origin of every tile, row by row
+    steps = [i * TILE_STRIDE for i in range(tiles_per_side)]
+    return [(y, x) for y in steps for x in steps]
+
+
+def split_tiles(pixels, tiles_per_side):
+    return [pixels[y:y + TILE_SIZE, x:x + TILE_SIZE] for y, x in get_tile_origins(tiles_per_side)]
+
+
+def feather_ramp(index, tiles_per_side):
+    # 1D blend weights of a tile: a linear ramp across each overlap that is
+    # shared with a neighbour, 1 everywhere else
+    ramp = np.ones(TILE_SIZE, dtype=np.float32)
+    fade = (np.arange(TILE_OVERLAP, dtype=np.float32) + 0.5) / TILE_OVERLAP
+    if index > 0:
+        ramp[:TILE_OVERLAP] = fade
+    if index < tiles_per_side - 1:
+        ramp[-TILE_OVERLAP:] = fade[::-1]
+    return ramp
+
+
+def blend_tiles(tiles, tiles_per_side, match_levels=False):
+    # Put float (TILE_SIZE, TILE_SIZE, channels) tiles back together with a
+    # weighted average over the overlaps. With match_levels every tile is
+    # first scaled and offset to agree with the tiles already placed, which
+    # evens out depth maps that were normalised per tile.
+    resolution = get_resolution(tiles_per_side)
+    channels = tiles[0].shape[2]
+    total = np.zeros((resolution, resolution, channels), dtype=np.float32)
+    weights = np.zeros((resolution, resolution, 1), dtype=np.float32)
+
+    for index, ((y, x), tile) in enumerate(zip(get_tile_origins(tiles_per_side), tiles)):
+        tile = resize_nearest(np.asarray(tile, dtype=np.float32), TILE_SIZE)
+        row, col = divmod(index, tiles_per_side)
+        weight = np.outer(feather_ramp(row, tiles_per_side), feather_ramp(col, tiles_per_side))[..., None]
+        region = (slice(y, y + TILE_SIZE), slice(x, x + TILE_SIZE))
+
+        if match_levels and index:
+            placed = weights[region][..., 0] > 0
+            if placed.any():
+                current = total[region][placed] / weights[region][placed]
+                ours = tile[placed]
+                scale = current[..., :3].std() / (ours[..., :3].std() or 1.0)
+                offset = current[..., :3].mean() - scale * ours[..., :3].mean()
+                tile = tile.copy()
+                tile[..., :3] = tile[..., :3] * scale + offset
+
+        total[region] += tile * weight
+        weights[region] += weight
+
+    return total / np.maximum(weights, 1e-6)
@@ -1,4 +1,9 @@
 import bpy
+from .resources import cached_memory_report
+from . import profiling
+from . import editsession
+from . import variations
+from . import dependencies
 
 class GreebleGeneratorPanel(bpy.types.Panel):
     bl_label = "Greeble Generator"
@@ -12,6 +17,15 @@ class GreebleGeneratorPanel(bpy.types.Panel):
         scene = context.scene
 
         # Button for Snapshot Operator
+        layout.prop(scene, "greeble_capture_mode")
+        if scene.greeble_capture_mode == 'RASTER':
+            layout.prop(scene, "greeble_geometry_depth")
+        else:
+            layout.prop(scene, "greeble_capture_engine")
+        layout.prop(scene, "greeble_tiled")
+        if scene.greeble_tiled:
+            layout.prop(scene, "greeble_tile_world_size")
+            layout.prop(scene, "greeble_max_tiles")
         layout.operator("object.snapshot_operator", text="Take Snapshot")
 
         # Textbox for the prompt
@@ -24,16 +38,106 @@ class GreebleGeneratorPanel(bpy.types.Panel):
         # Slider for denoising strength
         layout.prop(scene, "greeble_denoising_strength", slider=True)
 
+        # Seed, a fixed seed makes results reproducible and cacheable
+        layout.prop(scene, "greeble_seed")
+
+        # Checkbox for the in-memory image pipeline
+        layout.prop(scene, "greeble_in_memory")
+
+        # Steps, and the quick draft that can be refined with the same seed
+        layout.prop(scene, "greeble_steps")
+        row = layout.row()
+        row.prop(scene, "greeble_draft")
+        row.prop(scene, "greeble_live_preview")
+        if scene.greeble_draft:
+            layout.prop(scene, "greeble_draft_steps")
+
+        # Checkbox for packing all islands into one atlas material
+        layout.prop(scene, "greeble_use_atlas")
+
         # Button for Apply Greeble Texture Operator
         layout.operator("object.apply_greeble_texture", text="Apply Greeble Texture")
+        if scene.greeble_draft:
+            row = layout.row()
+            row.enabled = scene.greeble_last_seed >= 0
+            row.operator("object.apply_greeble_texture", text=f"Refine (Seed {scene.greeble_last_seed})").refine = True
+
+        # Several candidates from one request, each applied without another
+        box = layout.box()
+        row = box.row()
+        row.prop(scene, "greeble_variation_count")
+        row.operator("object.generate_greeble_variations", text="Generate Variations")
+        if variations.candidates:
+            grid = box.grid_flow(columns=2, even_columns=True, align=True)
+            for index, variation in enumerate(variations.candidates):
+                column = grid.column(align=True)
+                column.template_icon(icon_value=variations.get_thumbnail_icon(variation), scale=5.0)
+                column.operator("object.apply_greeble_variation", text=f"Seed {variation.seed}").index = index
+
+        # Dropdown for the depth estimation source
+        layout.prop(scene, "greeble_depth_source")
+        row = layout.row(align=True)
+        row.prop(scene, "greeble_depth_mode", text="")
+        sub = row.row(align=True)
+        sub.enabled = scene.greeble_depth_mode != 'DISPLACEMENT'
+        sub.prop(scene, "greeble_depth_strength", text="Strength")
 
         # Button for Apply Depth Map Operator
         layout.operator("object.apply_depth_map", text="Apply Depth Map")
 
+        # Batch greebling of all selected face islands
+        box = layout.box()
+        box.prop(scene, "greeble_batch_concurrency")
+        box.prop(scene, "greeble_batch_pack_size")
+        box.operator("object.batch_greeble", text="Batch Greeble Selection")
+        row = box.row(align=True)
+        row.prop(scene, "greeble_view_count")
+        row.operator("object.batch_greeble", text="Multi-View Greeble").multi_view = True
+
+        # Progress of the running generation
+        if scene.greeble_job_running:
+            box = layout.box()
+            box.label(text=f"{scene.greeble_job_label}...")
+            row = box.row()
+            row.enabled = False
+            row.prop(scene, "greeble_job_progress", slider=True)
+            box.operator("object.cancel_greeble_job", text="Cancel", icon='CANCEL')
+
         # Slider for texture scale
         layout.prop(scene, "greeble_texture_scale")
         layout.operator("object.scale_uv_operator", text="Scale UV")
 
-        # Button for Save Textures Operator
+        # Formats and button for Save Textures Operator
+        row = layout.row()
+        row.prop(scene, "greeble_color_format", text="")
+        if scene.greeble_color_format != 'PNG':
+            row.prop(scene, "greeble_export_quality")
+            if not dependencies.is_available("PIL"):
+                layout.label(text="WebP and JPEG need Pillow, see the add-on preferences", icon='ERROR')
+        layout.prop(scene, "greeble_depth_format")
         layout.operator("object.save_textures_operator", text="Save Textures")
 
+        # Stage breakdown of the last operator run
+        layout.prop(scene, "greeble_show_timings")
+        run = profiling.last_run
+        if scene.greeble_show_timings and run is not None:
+            box = layout.box()
+            box.label(text=f"{run.label}: {run.seconds:.2f} s")
+            col = box.column(align=True)
+            for name, seconds, count in run.breakdown():
+                col.label(text=f"{name}: {seconds:.3f} s" + (f" ({count}x)" if count > 1 else ""))
+            # Edit/Object Mode syncs of the last run of every operator
+            col = box.column(align=True)
+            for label, (mesh_syncs, seconds) in editsession.last_runs.items():
+                col.label(text=f"{label}: {mesh_syncs} mesh syncs, {seconds:.2f} s")
+
+        # Memory held by greeble images, and the button to free unused ones
+        report = cached_memory_report()
+        box = layout.box()
+        row = box.row()
+        row.label(text=f"{report['images']} images, {report['image_bytes'] / 2**20:.1f} MB")
+        row.operator("object.refresh_greeble_memory_report", text="", icon='FILE_REFRESH')
+        if report['orphan_images'] or report['orphan_materials']:
+            box.label(text=f"{report['orphan_images']} unused images, {report['orphan_bytes'] / 2**20:.1f} MB")
+        box.operator("object.purge_greeble_data", text="Purge Unused Data", icon='TRASH')
+
@@ -0,0 +1,61 @@
+import bpy
+from . import apihandler
+from . import imagebuffers
+
+# Candidate textures of the current snapshot, generated together by one
+# img2img request. Each one keeps its seed and decoded pixels, so applying
+# a candidate never calls the server again. Runtime only, like the stage
+# buffers in imagebuffers.
+
+THUMBNAIL_SIZE = 128
+THUMBNAIL_IMAGE = "GreebleVariation"
+
+
+class Variation:
+
+    def __init__(self, seed, png):
+        self.seed = seed
+        self.texture = imagebuffers.ImageBuffer(png)
+        self.thumbnail_name = None
+
+
+candidates = []
+
+
+def generate(prompt, count=4, steps=5, cfg_scale=7.0, denoising_strength=0.8, seed=-1, in_memory=False):
+    # Worker thread side: request the candidates and decode them, the main
+    # thread only has to copy pixels into the thumbnails. Returns the list of
+    # Variation or None without a snapshot.
+    results = apihandler.generate_variations(prompt, count=count, steps=steps, cfg_scale=cfg_scale,
+                                             denoising_strength=denoising_strength, seed=seed,
+                                             in_memory=in_memory)
+    if results is None:
+        return None
+    variations = [Variation(candidate_seed, png) for candidate_seed, png in results]
+    for variation in variations:
+        variation.texture.pixels
+    return variations
+
+
+def set_candidates(variations):
+    # Replace the candidates and refill their thumbnails. Main thread only.
+    candidates[:] = variations
+    for index, variation in enumerate(variations):
+        name = f"{THUMBNAIL_IMAGE}{index}"
+        pixels = imagebuffers.resize_nearest(variation.texture.pixels, THUMBNAIL_SIZE)
+        image = imagebuffers.pixels_to_image(pixels, name, bpy.data.images.get(name))
+        # Thumbnails are only shown in the panel, never saved with the .blend
+        image["greeble_pack_on_save"] = False
+        image.preview_ensure()
+        image.preview.reload()
+        variation.thumbnail_name = image.name
+
+
+def get_thumbnail_icon(variation):
+    # Icon id of a candidate's thumbnail for layout.template_icon, 0 once
+    # the image is gone
+    image = bpy.data.images.get(variation.thumbnail_name or "")
+    if image is None or image.preview is None:
+        return 0
+    return image.preview.icon_id
+
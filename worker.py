@@ -0,0 +1,106 @@
+import base64
+import threading
+import time
+from .apihandler import get_progress, interrupt
+from .imagebuffers import ImageBuffer
+
+# Seconds between two /sdapi/v1/progress polls
+PROGRESS_POLL_INTERVAL = 0.5
+
+# The job currently driven by a modal operator, if any
+active_job = None
+
+
+def interrupt_async():
+    # The interrupt request itself is blocking, keep it off the main thread
+    threading.Thread(target=_interrupt, daemon=True).start()
+
+
+def _interrupt():
+    try:
+        interrupt()
+    except Exception as e:
+        print(f"Greeble Generator: interrupt failed: {e}")
+
+
+class GenerationJob:
+    # Runs one blocking Stable Diffusion call on a background thread while a
+    # second thread polls the server for progress. Nothing in here may touch
+    # bpy; the modal operator that owns the job reads its state on the main
+    # thread and applies the result there.
+    #
+    # With wants_preview set the poller also fetches the intermediate image
+    # of the running job and decodes it into preview, an ImageBuffer the
+    # operator can show while the job runs.
+    wants_preview = False
+
+    def __init__(self, label, target, *args, **kwargs):
+        self.label = label
+        self.target = target
+        self.args = args
+        self.kwargs = kwargs
+        self.state = 'PENDING'  # PENDING, RUNNING, DONE, FAILED, CANCELLED
+        self.progress = 0.0
+        self.eta = 0.0
+        self.result = None
+        self.error = None
+        self.preview = None
+        self._preview_data = None
+        self._cancel_requested = False
+        self._thread = None
+        self._poller = None
+
+    @property
+    def finished(self):
+        return self.state in {'DONE', 'FAILED', 'CANCELLED'}
+
+    def start(self):
+        global active_job
+        active_job = self
+        self.state = 'RUNNING'
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._poller = threading.Thread(target=self._poll_progress, daemon=True)
+        self._thread.start()
+        self._poller.start()
+
+    def cancel(self):
+        if self.finished or self._cancel_requested:
+            return
+        self._cancel_requested = True
+        interrupt_async()
+
+    def _run(self):
+        global active_job
+        try:
+            result = self.target(*self.args, **self.kwargs)
+        except Exception as e:
+            self.error = e
+            self.state = 'CANCELLED' if self._cancel_requested else 'FAILED'
+        else:
+            # An interrupted img2img still returns the partial image; drop it
+            if self._cancel_requested:
+                self.state = 'CANCELLED'
+            else:
+                self.result = result
+                self.progress = 1.0
+                self.state = 'DONE'
+        if active_job is self:
+            active_job = None
+
+    def _poll_progress(self):
+        while not self.finished:
+            try:
+                r = get_progress(skip_current_image=not self.wants_preview)
+                self.progress = max(self.progress, float(r.get('progress', 0.0)))
+                self.eta = float(r.get('eta_relative', 0.0))
+                image = r.get('current_image')
+                if image and image != self._preview_data:
+                    self._preview_data = image
+                    preview = ImageBuffer(base64.b64decode(image))
+                    # Decode here, the main thread only copies the pixels
+                    preview.pixels
+                    self.preview = preview
+            except Exception:
+                # The server is busy or briefly unreachable; try again later
+                pass
+            time.sleep(PROGRESS_POLL_INTERVAL)